@@ -0,0 +1,427 @@
+"""
+Benchmarks of the endpoint pair combination extractor, the policy network,
+the segment pair probabilities and the environment transitions on synthetic
+triangulations of growing size, and optionally of the rollout throughput of
+RolloutWorkers for growing numbers of workers.
+
+Usage, from the root of the repository:
+    python -m benchmarks.benchmark --sizes 16 64 256 1024 \
+        --output report.json --baseline previous_report.json
+    python -m benchmarks.benchmark --rollout-workers 1 2 4
+
+Exits with a non-zero status when the report violates the thresholds of
+benchmarks/thresholds.json, or is slower than the baseline report beyond the
+tolerance.
+"""
+
+import argparse
+import json
+import os
+import pickle
+import platform
+import sys
+import threading
+import tracemalloc
+from time import perf_counter
+
+import dgl
+import numpy as np
+import tensorflow as tf
+
+from core.agent import _calculate_segment_pair_probabilities
+from core.endpoint_pair_combinations import extract_endpoint_pair_combinations
+from core.environment import TriangulationEnvironment
+from core.policy_network import HeteroGraphPolicyNetwork, prepare_fused_inputs
+from core.rollout_workers import RolloutWorkers
+from core.trainer import _get_action_candidates, log_n_triangles
+from core.triangulation_generator import generate_triangulation
+
+DEFAULT_SIZES = (16, 64, 256)
+DEFAULT_THRESHOLDS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "thresholds.json"
+)
+
+# Seconds between two samples of the resident memory
+_MEMORY_SAMPLING_INTERVAL = 1e-3
+
+# Smallest value of each metric compared with the baseline, below which the
+# measurements are noise
+_BASELINE_FLOORS = {"median_seconds": 1e-4, "peak_rss_bytes": 2**20}
+
+
+def _setup_extract_endpoint_pair_combinations(triangulation):
+    return lambda: extract_endpoint_pair_combinations(triangulation)
+
+
+def _setup_policy_network_call(triangulation):
+    policy_network = HeteroGraphPolicyNetwork()
+    return lambda: policy_network(triangulation)
+
+
+def _setup_calculate_segment_pair_probabilities(triangulation):
+    point_logits, _ = HeteroGraphPolicyNetwork()(triangulation)
+    combinations = _get_action_candidates(triangulation)
+    segment_pairs = tf.concat(
+        [combinations[0][:, 1:], combinations[1][:, 1:]], axis=0
+    )
+    return lambda: _calculate_segment_pair_probabilities(
+        point_logits, segment_pairs
+    )
+
+
+def _setup_environment_step(triangulation):
+    environment = TriangulationEnvironment()
+    combinations = _get_action_candidates(triangulation)
+    action_type = next(
+        action_type
+        for action_type, pairs in enumerate(combinations)
+        if pairs.shape[0] > 0
+    )
+    action = (action_type, combinations[action_type][0, 1:])
+
+    def step():
+        environment.state = triangulation
+        return environment.step(action)
+
+    return step
+
+
+# Name of each benchmark -> function returning the benchmarked call for a
+# triangulation
+BENCHMARKS = {
+    "extract_endpoint_pair_combinations": (
+        _setup_extract_endpoint_pair_combinations
+    ),
+    "policy_network_call": _setup_policy_network_call,
+    "calculate_segment_pair_probabilities": (
+        _setup_calculate_segment_pair_probabilities
+    ),
+    "environment_step": _setup_environment_step,
+}
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, benchmarks=None, n_repeats=5, seed=0):
+    """
+    Runs every benchmark on a synthetic triangulation of each size. The
+    peak memory is measured on the first call, the time as the median and
+    minimum of n_repeats calls after it.
+
+    Parameters
+    ----------
+    sizes: Sequence[int]
+        Numbers of points of the synthetic triangulations
+    benchmarks: Sequence[str]
+        Names of the benchmarks to run, all of BENCHMARKS by default
+    n_repeats: int
+    seed: int
+        Seed of the synthetic triangulations, see generate_triangulation
+
+    Returns
+    -------
+    report: Dict
+        -> report["environment"]: versions and platform
+        -> report["results"]: one entry per benchmark and size with the
+            number of points and triangles, median_seconds, min_seconds,
+            peak_rss_bytes (increase of the resident memory) and
+            peak_traced_bytes (python and numpy allocations)
+    """
+    benchmarks = benchmarks or list(BENCHMARKS)
+    results = []
+    for n_points in sizes:
+        triangulation = generate_triangulation(n_points, seed)
+        for name in benchmarks:
+            call = BENCHMARKS[name](triangulation)
+            with _PeakMemory() as peak_memory:
+                call()
+            durations = []
+            for _ in range(n_repeats):
+                start = perf_counter()
+                call()
+                durations.append(perf_counter() - start)
+            results.append(
+                {
+                    "benchmark": name,
+                    "n_points": triangulation.num_nodes("point"),
+                    "n_triangles": triangulation.num_nodes("triangle"),
+                    "median_seconds": float(np.median(durations)),
+                    "min_seconds": float(np.min(durations)),
+                    "peak_rss_bytes": peak_memory.rss_bytes,
+                    "peak_traced_bytes": peak_memory.traced_bytes,
+                }
+            )
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "tensorflow": tf.__version__,
+            "dgl": dgl.__version__,
+            "platform": platform.platform(),
+            "seed": seed,
+            "n_repeats": n_repeats,
+        },
+        "results": results,
+    }
+
+
+def run_rollout_benchmark(
+    n_workers=(1, 2, 4), n_trajectories=64, n_envs=16, max_steps=8, seed=0
+):
+    """
+    Measures the trajectories per second the learner receives from
+    RolloutWorkers for each number of workers. The workers are timed after
+    they delivered their first trajectory, so that the startup of the
+    processes (importing tensorflow, tracing the policy network) is left out.
+    The costs outside of the sampling are measured on the learner: pickling
+    and unpickling the received trajectories, which the queue does once per
+    trajectory, and pickling the weights sent by update_weights, once per
+    worker.
+
+    Parameters
+    ----------
+    n_workers: Sequence[int]
+    n_trajectories: int
+        Number of trajectories timed per number of workers
+    n_envs: int
+        Number of triangulations each worker samples in parallel
+    max_steps: int
+    seed: int
+
+    Returns
+    -------
+    results: List[Dict]
+        One entry per number of workers with trajectories_per_second,
+        speedup and efficiency (speedup per worker) relative to the first
+        number of workers, pickle_seconds_per_trajectory,
+        bytes_per_trajectory, weight_broadcast_seconds and
+        weight_broadcast_bytes
+    """
+    tf.random.set_seed(seed)
+    policy_network = HeteroGraphPolicyNetwork()
+    # Creates the variables of the policy network
+    policy_network.fused_call(
+        prepare_fused_inputs(TriangulationEnvironment().reset())
+    )
+    weights = policy_network.get_weights()
+
+    results = []
+    for n in n_workers:
+        with RolloutWorkers(
+            policy_network,
+            log_n_triangles,
+            n,
+            n_envs=n_envs,
+            max_steps=max_steps,
+            seed=seed,
+        ) as workers:
+            workers.get_trajectories(n)
+            start = perf_counter()
+            trajectories = workers.get_trajectories(n_trajectories)
+            seconds = perf_counter() - start
+
+        start = perf_counter()
+        pickled = [pickle.dumps(trajectory) for trajectory in trajectories]
+        for data in pickled:
+            pickle.loads(data)
+        pickle_seconds = perf_counter() - start
+
+        start = perf_counter()
+        pickled_weights = [pickle.dumps(weights) for _ in range(n)]
+        weight_broadcast_seconds = perf_counter() - start
+
+        results.append(
+            {
+                "n_workers": n,
+                "trajectories_per_second": n_trajectories / seconds,
+                "pickle_seconds_per_trajectory": pickle_seconds
+                / n_trajectories,
+                "bytes_per_trajectory": float(
+                    np.mean([len(data) for data in pickled])
+                ),
+                "weight_broadcast_seconds": weight_broadcast_seconds,
+                "weight_broadcast_bytes": sum(map(len, pickled_weights)),
+            }
+        )
+    for result in results:
+        result["speedup"] = (
+            result["trajectories_per_second"]
+            / results[0]["trajectories_per_second"]
+        )
+        result["efficiency"] = (
+            result["speedup"] * results[0]["n_workers"] / result["n_workers"]
+        )
+    return results
+
+
+def check_report(report, thresholds, baseline=None, tolerance=0.25):
+    """
+    Regressions of a report
+
+    Parameters
+    ----------
+    report: Dict
+        See run_benchmarks
+    thresholds: Dict[str, Dict[str, float]]
+        Per benchmark, optional limits of:
+            -> "max_scaling_exponent": the slope of log(median_seconds)
+                against log(n_points), fitted over all the sizes
+            -> "max_seconds": median_seconds at any size
+    baseline: Dict
+        Previous report, whose median_seconds and peak_rss_bytes at the same
+        benchmark and number of points must not be exceeded by more than the
+        tolerance (values below 0.1 ms and 1 MiB are not compared)
+    tolerance: float
+        Relative tolerance of the comparison with the baseline
+
+    Returns
+    -------
+    violations: List[str]
+    """
+    violations = []
+    results_by_name = {}
+    for result in report["results"]:
+        results_by_name.setdefault(result["benchmark"], []).append(result)
+
+    for name, results in results_by_name.items():
+        limits = thresholds.get(name, {})
+        for result in results:
+            if result["median_seconds"] > limits.get("max_seconds", np.inf):
+                violations.append(
+                    f"{name} at {result['n_points']} points: "
+                    f"{result['median_seconds']:.4g}s > "
+                    f"{limits['max_seconds']:.4g}s"
+                )
+        exponent = scaling_exponent(results)
+        if exponent > limits.get("max_scaling_exponent", np.inf):
+            violations.append(
+                f"{name}: scaling exponent {exponent:.2f} > "
+                f"{limits['max_scaling_exponent']:.2f}"
+            )
+
+    if baseline is not None:
+        baseline_results = {
+            (result["benchmark"], result["n_points"]): result
+            for result in baseline["results"]
+        }
+        for result in report["results"]:
+            key = (result["benchmark"], result["n_points"])
+            if key not in baseline_results:
+                continue
+            for metric, floor in _BASELINE_FLOORS.items():
+                value = result[metric]
+                baseline_value = baseline_results[key][metric]
+                if value > (1 + tolerance) * max(baseline_value, floor):
+                    violations.append(
+                        f"{key[0]} at {key[1]} points: {metric} {value:.4g} "
+                        f"> {1 + tolerance:.2f} x baseline "
+                        f"{baseline_value:.4g}"
+                    )
+    return violations
+
+
+def scaling_exponent(results):
+    """
+    Least squares slope of log(median_seconds) against log(n_points), or 0
+    for less than two sizes
+    """
+    n_points = np.array([result["n_points"] for result in results])
+    if len(np.unique(n_points)) < 2:
+        return 0.0
+    seconds = np.array([result["median_seconds"] for result in results])
+    return float(np.polyfit(np.log(n_points), np.log(seconds), 1)[0])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES)
+    )
+    parser.add_argument(
+        "--benchmarks", nargs="+", choices=list(BENCHMARKS), default=None
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_report.json")
+    parser.add_argument("--thresholds", default=DEFAULT_THRESHOLDS)
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--rollout-workers", type=int, nargs="+", default=None)
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(
+        args.sizes, args.benchmarks, n_repeats=args.repeats, seed=args.seed
+    )
+    if args.rollout_workers is not None:
+        report["environment"]["n_cores"] = len(os.sched_getaffinity(0))
+        report["rollout"] = run_rollout_benchmark(
+            args.rollout_workers, seed=args.seed
+        )
+    with open(args.thresholds) as file:
+        thresholds = json.load(file)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    report["violations"] = check_report(
+        report, thresholds, baseline, args.tolerance
+    )
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    for result in report["results"]:
+        print(
+            f"{result['benchmark']:<40} {result['n_points']:>7} points "
+            f"{1e3 * result['median_seconds']:>10.3f} ms "
+            f"{result['peak_rss_bytes'] / 2**20:>9.1f} MiB"
+        )
+    for result in report.get("rollout", []):
+        print(
+            f"{'rollout':<27} {result['n_workers']:>3} workers "
+            f"{result['trajectories_per_second']:>8.2f} trajectories/s "
+            f"x{result['speedup']:.2f} "
+            f"{1e3 * result['pickle_seconds_per_trajectory']:>8.3f} ms "
+            f"pickled per trajectory"
+        )
+    for violation in report["violations"]:
+        print(f"REGRESSION: {violation}")
+    return 1 if report["violations"] else 0
+
+
+class _PeakMemory:
+    """
+    Peak increase of the resident memory while in the context, sampled by a
+    thread as tensorflow allocates outside of the python allocator, and peak
+    of the allocations traced by tracemalloc (python objects and numpy
+    arrays). The resident memory is only available on Linux, and 0 elsewhere.
+    """
+
+    def __enter__(self):
+        self._start_rss = self._peak_rss = _get_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        _, self.traced_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self._stop.set()
+        self._thread.join()
+        self._peak_rss = max(self._peak_rss, _get_rss())
+        self.rss_bytes = self._peak_rss - self._start_rss
+
+    def _sample(self):
+        while not self._stop.wait(_MEMORY_SAMPLING_INTERVAL):
+            self._peak_rss = max(self._peak_rss, _get_rss())
+
+
+def _get_rss():
+    try:
+        with open("/proc/self/statm") as file:
+            n_pages = int(file.read().split()[1])
+    except OSError:
+        return 0
+    return n_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
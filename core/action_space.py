@@ -0,0 +1,230 @@
+from typing import NamedTuple, Sequence
+
+import tensorflow as tf
+
+from core.agent import _segment_log_softmax
+from core.environment import NEW_TRIANGLE_ACTIONS, TERMINATE_ACTION
+from core.profiling import profiled
+
+# Number of action types: the six endpoint pair combinations and terminating
+N_ACTION_TYPES = TERMINATE_ACTION + 1
+
+# Number of points (a0, a1, b0, b1) whose logits determine the logit of an
+# action
+N_ACTION_POINTS = 4
+
+# Point index of the points of the new triangles, whose logits are taken as 0
+NEW_POINT = -1
+
+
+class ActionSpace(NamedTuple):
+    """
+    Flat index of every action of every triangulation of a batch. The actions
+    are ordered by action type, then as the rows of the endpoint pair
+    combinations of that type, and terminating comes last with one action per
+    triangulation.
+
+    graph_ids: tf.Tensor
+        Tensor of shape (n_actions, ) of the triangulation of each action
+    action_types: tf.Tensor
+        Tensor of shape (n_actions, )
+    ranks: tf.Tensor
+        Tensor of shape (n_actions, ) of the index of each action among the
+        actions of the same type and triangulation, as in Trajectory.actions
+    point_indices: tf.Tensor
+        Tensor of shape (n_actions, 4) of the points (a0, a1, b0, b1) of the
+        batched graph glued by each action, indexing point_logits:
+            -> (a0, a1, b0, b1) for the current time-like and space-like
+                pairs, where a0 and b0 (a1 and b1) are merged
+            -> (a0, a1, NEW_POINT, NEW_POINT) for the pairs of new triangles
+            -> NEW_POINT only for terminating
+    type_indices: tf.Tensor
+        Tensor of shape (n_actions, 2) of the (triangulation, action type) of
+        each action, indexing triangulation_logits
+    has_actions: tf.Tensor
+        Boolean tensor of shape (batch_size, 7) of the action types with at
+        least one action in each triangulation
+    """
+
+    graph_ids: tf.Tensor
+    action_types: tf.Tensor
+    ranks: tf.Tensor
+    point_indices: tf.Tensor
+    type_indices: tf.Tensor
+    has_actions: tf.Tensor
+
+
+@profiled("action_space.build")
+def build_action_space(
+    combinations: Sequence[tf.Tensor], batch_size: int
+) -> ActionSpace:
+    """
+    Flattens the endpoint pair combinations of a batch into an ActionSpace,
+    once per state
+
+    Parameters
+    ----------
+    combinations: Sequence[tf.Tensor]
+        The six batched endpoint pair combinations, with a leading graph
+        column (see extract_batched_endpoint_pair_combinations)
+    batch_size: int
+        Number of triangulations in the batch
+    """
+    graph_ids, action_types, point_indices = [], [], []
+    for action_type, pairs in enumerate(combinations):
+        points = tf.cast(pairs[:, 1:], tf.int64)
+        graph_ids.append(tf.cast(pairs[:, 0], tf.int32))
+        action_types.append(tf.fill(tf.shape(pairs)[:1], action_type))
+        point_indices.append(
+            tf.pad(
+                points,
+                [[0, 0], [0, N_ACTION_POINTS - points.shape[1]]],
+                constant_values=NEW_POINT,
+            )
+        )
+    graph_ids.append(tf.range(batch_size))
+    action_types.append(tf.fill([batch_size], TERMINATE_ACTION))
+    point_indices.append(
+        tf.fill(
+            [batch_size, N_ACTION_POINTS], tf.constant(NEW_POINT, tf.int64)
+        )
+    )
+
+    graph_ids = tf.concat(graph_ids, axis=0)
+    action_types = tf.concat(action_types, axis=0)
+    groups = graph_ids * N_ACTION_TYPES + action_types
+    n_groups = batch_size * N_ACTION_TYPES
+    n_actions_per_group = tf.math.bincount(
+        groups, minlength=n_groups, maxlength=n_groups
+    )
+    return ActionSpace(
+        graph_ids=graph_ids,
+        action_types=action_types,
+        ranks=_rank_within_segments(groups, n_groups),
+        point_indices=tf.concat(point_indices, axis=0),
+        type_indices=tf.stack([graph_ids, action_types], axis=1),
+        has_actions=tf.reshape(
+            tf.math.greater(n_actions_per_group, 0),
+            [batch_size, N_ACTION_TYPES],
+        ),
+    )
+
+
+def calculate_action_logits(
+    action_space: ActionSpace, point_logits: tf.Tensor
+) -> tf.Tensor:
+    """
+    Logit of every action, -|tanh(l[a0] - l[b0]) + tanh(l[a1] - l[b1])|, with
+    the logits of NEW_POINT taken as 0. This is the logit of
+    _calculate_segment_pair_logits for gluing current segments,
+    -|tanh(l[a0]) + tanh(l[a1])| for adding a new triangle, and 0 for
+    terminating.
+
+    Returns
+    -------
+    action_logits: tf.Tensor
+        Tensor of shape (n_actions, )
+    """
+    n_points = tf.shape(point_logits, out_type=tf.int64)[0]
+    padded_point_logits = tf.concat(
+        [point_logits[:, 0], tf.zeros([1], dtype=point_logits.dtype)], axis=0
+    )
+    point_indices = action_space.point_indices
+    logits = tf.gather(
+        padded_point_logits,
+        tf.where(
+            tf.math.equal(point_indices, NEW_POINT), n_points, point_indices
+        ),
+    )
+    return -tf.math.abs(
+        tf.reduce_sum(tf.math.tanh(logits[:, :2] - logits[:, 2:]), axis=1)
+    )
+
+
+@profiled("action_space.masked_log_softmax")
+def masked_action_log_softmax(
+    action_space: ActionSpace,
+    point_logits: tf.Tensor,
+    triangulation_logits: tf.Tensor,
+    must_terminate: tf.Tensor,
+) -> tf.Tensor:
+    """
+    Log probabilities of every action of an ActionSpace.
+        log P(action) = log P(action type) + log P(endpoint pair | action type)
+    where the action types without actions are masked out, and only
+    terminating is left for the triangulations that must terminate. Both
+    terms are computed for all the action types at once, the second one as a
+    log softmax over the actions sharing their triangulation and type.
+
+    Parameters
+    ----------
+    action_space: ActionSpace
+    point_logits: tf.Tensor
+        Tensor of shape (n_points, 1)
+    triangulation_logits: tf.Tensor
+        Tensor of shape (batch_size, 7)
+    must_terminate: tf.Tensor
+        Boolean tensor of shape (batch_size, )
+
+    Returns
+    -------
+    log_probs: tf.Tensor
+        Tensor of shape (n_actions, )
+    """
+    is_terminate_action = tf.math.equal(
+        tf.range(N_ACTION_TYPES), TERMINATE_ACTION
+    )
+    is_valid_type = tf.math.logical_and(
+        action_space.has_actions,
+        tf.math.logical_or(
+            tf.expand_dims(tf.math.logical_not(must_terminate), 1),
+            is_terminate_action,
+        ),
+    )
+    type_log_probs = tf.nn.log_softmax(
+        tf.where(
+            is_valid_type,
+            triangulation_logits,
+            tf.fill(tf.shape(triangulation_logits), -float("inf")),
+        ),
+        axis=1,
+    )
+    batch_size = tf.shape(triangulation_logits)[0]
+    pair_log_probs = _segment_log_softmax(
+        calculate_action_logits(action_space, point_logits),
+        action_space.graph_ids * N_ACTION_TYPES + action_space.action_types,
+        batch_size * N_ACTION_TYPES,
+    )
+    return (
+        tf.gather_nd(type_log_probs, action_space.type_indices)
+        + pair_log_probs
+    )
+
+
+def get_action(action_space: ActionSpace, index: int):
+    """
+    The action at an index of an ActionSpace, as taken by
+    VecTriangulationEnvironment.step
+    """
+    action_type = int(action_space.action_types[index])
+    if action_type == TERMINATE_ACTION:
+        return TERMINATE_ACTION, None
+    points = action_space.point_indices[index]
+    if action_type in NEW_TRIANGLE_ACTIONS:
+        points = points[:2]
+    return action_type, points
+
+
+def _rank_within_segments(segment_ids, n_segments):
+    """Index of each entry among the entries sharing its segment id"""
+    order = tf.argsort(segment_ids, stable=True)
+    counts = tf.math.bincount(
+        segment_ids, minlength=n_segments, maxlength=n_segments
+    )
+    starts = tf.math.cumsum(counts, exclusive=True)
+    sorted_ranks = tf.range(tf.shape(segment_ids)[0]) - tf.gather(
+        starts, tf.gather(segment_ids, order)
+    )
+    return tf.scatter_nd(
+        tf.expand_dims(order, 1), sorted_ranks, tf.shape(segment_ids)
+    )
@@ -0,0 +1,18 @@
+# Segment types of the base triangle segments (p0, p1), (p1, p2) and (p2, p0)
+TSS_SEGMENT_TYPES = (0, 1, 1)
+STT_SEGMENT_TYPES = (1, 0, 0)
+
+# Actions follow the order of the endpoint pair combinations:
+#   0, 1 -> Join current time-like / space-like segments
+#   2, 3 -> Join with the time-like / space-like segment of a new tss triangle
+#   4, 5 -> Join with the time-like / space-like segment of a new stt triangle
+# For the actions adding a new triangle: the segment types of the new triangle
+# and the index k of its segment (p_k, p_k+1) glued to the chosen endpoints
+NEW_TRIANGLE_ACTIONS = {
+    2: (TSS_SEGMENT_TYPES, 0),
+    3: (TSS_SEGMENT_TYPES, 1),
+    4: (STT_SEGMENT_TYPES, 1),
+    5: (STT_SEGMENT_TYPES, 0),
+}
+# Stop growing the triangulation
+TERMINATE_ACTION = 6
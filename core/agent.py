@@ -1,8 +1,7 @@
-import dgl
-import dgl.function as fn
 import tensorflow as tf
 
 from core.policy_network import HeteroGraphPolicyNetwork
+from core.profiling import profiled
 
 
 class Agent:
@@ -11,66 +10,98 @@ class Agent:
         self.policy_network = HeteroGraphPolicyNetwork()
 
 
-def _construct_segment_pair_auxillary_graph(original_graph, segment_pair):
-    seg_a_pt0 = segment_pair[:, 0]
-    seg_a_pt1 = segment_pair[:, 1]
-    seg_b_pt0 = segment_pair[:, 2]
-    seg_b_pt1 = segment_pair[:, 3]
-
-    n_seg_pairs = segment_pair.shape[0]
-    aux_join_pt0 = tf.range(0, n_seg_pairs, dtype=tf.int64)
-    aux_join_pt1 = tf.range(n_seg_pairs, 2 * n_seg_pairs, dtype=tf.int64)
-    aux_join_pairs = tf.range(0, n_seg_pairs, dtype=tf.int64)
-
-    seg_inds, pt_inds = original_graph.edges(etype="segment_has_point")
-    aux_graph = dgl.heterograph(
-        {
-            ("point", "in", "segment"): (pt_inds, seg_inds),
-            ("point", "join", "aux_pt_pair"): (
-                tf.concat(
-                    [seg_a_pt0, seg_a_pt1, seg_b_pt0, seg_b_pt1], axis=0
-                ),
-                tf.concat(
-                    [aux_join_pt0, aux_join_pt1, aux_join_pt0, aux_join_pt1],
-                    axis=0,
-                ),
-            ),
-            ("aux_pt_pair", "join", "seg_pairs"): (
-                tf.concat([aux_join_pt0, aux_join_pt1], axis=0),
-                tf.concat([aux_join_pairs, aux_join_pairs], axis=0),
-            ),
-        }
-    )  # .long()
-    aux_graph.edges[("point", "join", "aux_pt_pair")].data[
-        "weight"
-    ] = tf.concat(
-        [tf.ones(shape=(2 * n_seg_pairs)), -tf.ones(shape=(2 * n_seg_pairs))],
-        axis=0,
+@profiled("agent.segment_pair_probabilities")
+def _calculate_segment_pair_probabilities(point_logits, segment_pair):
+    """
+    Probabilities of gluing the segment pairs [(a0, a1), (b0, b1)] of one
+    triangulation, where the points a0 and b0 (a1 and b1) are merged:
+        p ~ exp(-|tanh(l[a0] - l[b0]) + tanh(l[a1] - l[b1])|)
+
+    Parameters
+    ----------
+    point_logits: tf.Tensor
+        Tensor of shape (n_points, 1)
+    segment_pair: tf.Tensor
+        Tensor of shape (n_segment_pairs, 4) of the point indices
+        (a0, a1, b0, b1)
+
+    Returns
+    -------
+    probabilities: tf.Tensor
+        Tensor of shape (n_segment_pairs, 1)
+    """
+    seg_pair_logits = _calculate_segment_pair_logits(
+        point_logits, segment_pair
     )
-    return aux_graph
+    probabilities = tf.nn.softmax(seg_pair_logits, axis=0)
+    return probabilities
 
 
-def _calculate_segment_pair_probabilities(aux_graph, point_logits):
-    with aux_graph.local_scope():
-        aux_graph.nodes["point"].data["logit"] = point_logits
+@profiled("agent.batched_segment_pair_probabilities")
+def _calculate_batched_segment_pair_probabilities(
+    point_logits, segment_pairs, batch_size
+):
+    """
+    Batched version of _calculate_segment_pair_probabilities, where the
+    probabilities are normalized within each triangulation
 
-        aux_graph.update_all(
-            message_func=fn.u_mul_e("logit", "weight", "m"),
-            reduce_func=fn.sum("m", "pt_pair_logit"),
-            etype=("point", "join", "aux_pt_pair"),
-        )
-        aux_graph.nodes["aux_pt_pair"].data["pt_pair_logit"] = tf.math.tanh(
-            aux_graph.nodes["aux_pt_pair"].data["pt_pair_logit"]
-        )
-        aux_graph.update_all(
-            message_func=fn.copy_u("pt_pair_logit", "m"),
-            reduce_func=fn.sum("m", "seg_pair_logit"),
-            etype=("aux_pt_pair", "join", "seg_pairs"),
-        )
-        aux_graph.nodes["seg_pairs"].data["seg_pair_logit"] = -tf.math.abs(
-            aux_graph.nodes["seg_pairs"].data["seg_pair_logit"]
-        )
-        probabilities = dgl.softmax_nodes(
-            aux_graph, "seg_pair_logit", ntype="seg_pairs"
+    Parameters
+    ----------
+    point_logits: tf.Tensor
+        Tensor of shape (n_points, 1) of the points of a batched graph
+    segment_pairs: tf.Tensor
+        Tensor of shape (n_segment_pairs, 5) of the triangulation in the batch
+        followed by the point indices (a0, a1, b0, b1) in the batched graph
+        (as returned by extract_batched_endpoint_pair_combinations)
+    batch_size: int
+        Number of triangulations in the batch
+
+    Returns
+    -------
+    probabilities: tf.Tensor
+        Tensor of shape (n_segment_pairs, 1)
+    """
+    seg_pair_logits = _calculate_segment_pair_logits(
+        point_logits, segment_pairs[:, 1:]
+    )
+    probabilities = _segment_softmax(
+        seg_pair_logits, segment_pairs[:, 0], batch_size
+    )
+    return probabilities
+
+
+def _calculate_segment_pair_logits(point_logits, segment_pair):
+    """-|tanh(l[a0] - l[b0]) + tanh(l[a1] - l[b1])| of each segment pair"""
+    pair_logits = tf.gather(point_logits, segment_pair[:, :2]) - tf.gather(
+        point_logits, segment_pair[:, 2:]
+    )
+    seg_pair_logits = -tf.math.abs(
+        tf.reduce_sum(tf.math.tanh(pair_logits), axis=1)
+    )
+    return seg_pair_logits
+
+
+def _segment_log_softmax(logits, segment_ids, n_segments):
+    """Log softmax of the logits over the entries sharing a segment id"""
+    segment_ids = tf.cast(segment_ids, tf.int32)
+    max_logits = tf.stop_gradient(
+        tf.math.unsorted_segment_max(logits, segment_ids, n_segments)
+    )
+    shifted_logits = logits - tf.gather(max_logits, segment_ids)
+    log_sum_exp_logits = tf.math.log(
+        tf.math.unsorted_segment_sum(
+            tf.math.exp(shifted_logits), segment_ids, n_segments
         )
-        return probabilities
+    )
+    return shifted_logits - tf.gather(log_sum_exp_logits, segment_ids)
+
+
+def _segment_softmax(logits, segment_ids, n_segments):
+    """Softmax of the logits over the entries sharing a segment id"""
+    segment_ids = tf.cast(segment_ids, tf.int32)
+    max_logits = tf.math.unsorted_segment_max(logits, segment_ids, n_segments)
+    exp_logits = tf.math.exp(logits - tf.gather(max_logits, segment_ids))
+    sum_exp_logits = tf.math.unsorted_segment_sum(
+        exp_logits, segment_ids, n_segments
+    )
+    return exp_logits / tf.gather(sum_exp_logits, segment_ids)
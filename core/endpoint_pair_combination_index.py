@@ -0,0 +1,452 @@
+from bisect import bisect_right, insort
+from collections import Counter, defaultdict
+from typing import Iterable, Set, Tuple
+
+import tensorflow as tf
+
+from core.actions import NEW_TRIANGLE_ACTIONS
+from core.sparse_endpoint_pair_combinations import (
+    NEW_POINTS_N_LIGHT_CROSSINGS,
+    NEW_POINTS_WITH_VALID_SEGMENT,
+)
+
+# Endpoint pair types (q0, q1) of new triangles, in the order used by
+# _get_compatible_endpoint_pair_combinations: (segment type, (q0, q1) types)
+# with point types 0: A, 1: B, 2: C
+NEW_ENDPOINT_PAIR_TYPES = (
+    (0, (0, 0)),
+    (0, (0, 1)),
+    (0, (1, 0)),
+    (1, (0, 2)),
+    (1, (2, 0)),
+    (1, (0, 0)),
+)
+
+Edge = Tuple[int, int]
+
+
+class EndpointPairCombinationIndex:
+    """
+    Stateful version of extract_endpoint_pair_combinations attached to one
+    triangulation. The endpoint adjacency of valid segments, the light cone
+    crossings and the compatible endpoint pairs are kept as sparse Python
+    containers. Gluing segments or adding a tss/stt triangle only revisits the
+    entries touching the few points involved, instead of rebuilding every
+    filter from scratch. The endpoint pairs of valid segments are also kept
+    in buckets of the light cone crossings of their points, so that an updated
+    pair is only matched against the pairs sharing one of its points and those
+    whose crossings leave room for its own. The cost of a step then scales
+    with the number of combinations that can change, instead of with the
+    whole boundary.
+
+    Points keep the index they had when they were added to the index. Points
+    merged away are recorded, and the node indices of the triangulation (where
+    removed nodes are compacted, as with dgl.remove_nodes) are recovered when
+    the combinations are returned.
+    """
+
+    def __init__(self, triangulation):
+        seg_inds, pt_inds = triangulation.edges(etype="segment_has_point")
+        order = tf.argsort(seg_inds, stable=True)
+        segment_endpts = tf.reshape(tf.gather(pt_inds, order), (-1, 2))
+        segment_endpts = segment_endpts.numpy().tolist()
+        boundary = triangulation.nodes["segment"].data["boundary"].numpy()
+        segment_type = (
+            triangulation.nodes["segment"].data["segment_type"].numpy()
+        )
+        n_light_cone_angle = (
+            triangulation.nodes["point"].data["n_light_cone_angle"].numpy()
+        )
+
+        self._next_point = triangulation.num_nodes("point")
+        self._next_segment = triangulation.num_nodes("segment")
+        self._removed_points = []
+        self._n_light_crossings = dict(enumerate(n_light_cone_angle.tolist()))
+        self._neighbors = defaultdict(Counter)
+        # Boundary segment -> (segment type, p0, p1)
+        self._boundary_segments = {}
+        self._boundary_segments_at_pt = defaultdict(set)
+        # Endpoint adjacency of valid segments for each segment type
+        self._valid_neighbors = [defaultdict(Counter), defaultdict(Counter)]
+        # Endpoint pairs (p0, p1), p0 > p1, of valid segments for each segment
+        # type, keyed by the light cone crossings of (p0, p1)
+        self._lower_endpts_by_crossings = [defaultdict(set), defaultdict(set)]
+
+        # Compatible endpoint pairs for each segment type:
+        # (p0, p1) -> {(p0', p1'), ...} and the reverse lookup
+        self._current_pair_combos = [defaultdict(set), defaultdict(set)]
+        self._matched_by = [defaultdict(set), defaultdict(set)]
+        # Compatible endpoint pairs (p0, p1) for each new endpoint pair type
+        self._new_tri_pair_combos = [set() for _ in NEW_ENDPOINT_PAIR_TYPES]
+        # Tensors returned by combinations, until the next update
+        self._combinations = None
+
+        for segment, (p0, p1) in enumerate(segment_endpts):
+            self._add_neighbors(p0, p1)
+            if boundary[segment] == 1:
+                self._add_boundary_segment(
+                    segment, int(segment_type[segment]), p0, p1
+                )
+        self._revalidate(self._boundary_segments_at_pt.keys())
+
+    def combinations(
+        self,
+    ) -> Tuple[
+        tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor
+    ]:
+        """
+        Returns the same six tensors as extract_endpoint_pair_combinations for
+        the current state of the triangulation
+        """
+        if self._combinations is None:
+            self._combinations = self._get_combinations()
+        return self._combinations
+
+    def _get_combinations(self):
+        timelike_pairs, spacelike_pairs = [
+            self._to_tensor(
+                [
+                    endpts + other_endpts
+                    for endpts in sorted(pair_combos)
+                    for other_endpts in sorted(pair_combos[endpts])
+                ],
+                4,
+            )
+            for pair_combos in self._current_pair_combos
+        ]
+        new_tri_pair_combos = [
+            self._to_tensor(sorted(pair_combos), 2)
+            for pair_combos in self._new_tri_pair_combos
+        ]
+        return (
+            timelike_pairs,
+            spacelike_pairs,
+            new_tri_pair_combos[0],
+            tf.concat(
+                [new_tri_pair_combos[3], new_tri_pair_combos[4][:, ::-1]],
+                axis=0,
+            ),
+            tf.concat(
+                [new_tri_pair_combos[1], new_tri_pair_combos[2][:, ::-1]],
+                axis=0,
+            ),
+            new_tri_pair_combos[5],
+        )
+
+    def glue_segments(self, segment_type: int, endpoint_pairs):
+        """
+        Glues the boundary segments s = (p0, p1) and s' = (p0', p1') of the
+        given type, as chosen from the current time-like or space-like pairs.
+        The points p0' and p1' are merged into p0 and p1 and s' is merged into
+        s, which becomes an internal segment.
+
+        Parameters
+        ----------
+        segment_type: int
+            0 for time-like segments, 1 for space-like segments
+        endpoint_pairs:
+            Node indices (p0, p1, p0', p1') of the triangulation
+        """
+        p0, p1, other_p0, other_p1 = [
+            self._to_index(int(pt)) for pt in endpoint_pairs
+        ]
+        segment = self._find_boundary_segment(segment_type, p0, p1)
+        other_segment = self._find_boundary_segment(
+            segment_type, other_p0, other_p1, exclude=segment
+        )
+        self._glue(
+            segment_type,
+            (segment, p0, p1),
+            (other_segment, other_p0, other_p1),
+        )
+
+    def add_triangle(self, action_type: int, endpoint_pair):
+        """
+        Adds a new tss or stt triangle and glues one of its segments
+        (q0, q1) to the boundary segment (p0, p1), as chosen from the pairs
+        returned for new triangles. The new points q0 and q1 are merged into p0
+        and p1.
+
+        Parameters
+        ----------
+        action_type: int
+            Index of the pairs the endpoint pair was chosen from (2 to 5), see
+            core.actions.NEW_TRIANGLE_ACTIONS
+        endpoint_pair:
+            Node indices (p0, p1) of the triangulation
+        """
+        segment_types, glued_segment = NEW_TRIANGLE_ACTIONS[action_type]
+        p0, p1 = [self._to_index(int(pt)) for pt in endpoint_pair]
+
+        new_pts = [self._next_point + i for i in range(3)]
+        new_segments = [self._next_segment + i for i in range(3)]
+        self._next_point += 3
+        self._next_segment += 3
+        for i, seg_type in enumerate(segment_types):
+            self._n_light_crossings[new_pts[i]] = float(
+                segment_types[i - 1] != seg_type
+            )
+        for i, (segment, seg_type) in enumerate(
+            zip(new_segments, segment_types)
+        ):
+            q0, q1 = new_pts[i], new_pts[(i + 1) % 3]
+            self._add_neighbors(q0, q1)
+            self._add_boundary_segment(segment, seg_type, q0, q1)
+
+        segment_type = segment_types[glued_segment]
+        self._glue(
+            segment_type,
+            (self._find_boundary_segment(segment_type, p0, p1), p0, p1),
+            (
+                new_segments[glued_segment],
+                new_pts[glued_segment],
+                new_pts[(glued_segment + 1) % 3],
+            ),
+            new_points=[new_pts[(glued_segment + 2) % 3]],
+        )
+
+    def _glue(self, segment_type, segment, other_segment, new_points=()):
+        segment, p0, p1 = segment
+        other_segment, other_p0, other_p1 = other_segment
+        self._combinations = None
+        self._invalidate({p0, p1, other_p0, other_p1})
+
+        # s becomes an internal segment and s' is merged into it
+        self._remove_boundary_segment(segment)
+        self._remove_boundary_segment(other_segment)
+        self._remove_neighbors(other_p0, other_p1)
+        for pt, other_pt in [(p0, other_p0), (p1, other_p1)]:
+            if pt != other_pt:
+                self._merge_points(pt, other_pt)
+
+        self._revalidate({p0, p1, *new_points})
+
+    def _merge_points(self, point, other_point):
+        for neighbor, multiplicity in self._neighbors.pop(other_point).items():
+            self._neighbors[neighbor][other_point] -= multiplicity
+            del self._neighbors[neighbor][other_point]
+            self._neighbors[neighbor][point] += multiplicity
+            self._neighbors[point][neighbor] += multiplicity
+        for segment in list(self._boundary_segments_at_pt[other_point]):
+            segment_type, p0, p1 = self._boundary_segments[segment]
+            self._remove_boundary_segment(segment)
+            self._add_boundary_segment(
+                segment,
+                segment_type,
+                point if p0 == other_point else p0,
+                point if p1 == other_point else p1,
+            )
+        del self._boundary_segments_at_pt[other_point]
+        self._set_n_light_crossings(
+            point,
+            self._n_light_crossings[point]
+            + self._n_light_crossings.pop(other_point),
+        )
+        insort(self._removed_points, other_point)
+
+    def _set_n_light_crossings(self, point, n_light_crossings):
+        """Updates the crossings of a point and the buckets of its pairs"""
+        lower_endpts = [
+            self._get_lower_endpts_of_points(segment_type, [point])
+            for segment_type in range(2)
+        ]
+        for segment_type, endpts in enumerate(lower_endpts):
+            for pair in endpts:
+                self._discard_from_bucket(segment_type, pair)
+        self._n_light_crossings[point] = n_light_crossings
+        for segment_type, endpts in enumerate(lower_endpts):
+            for pair in endpts:
+                self._add_to_bucket(segment_type, pair)
+
+    def _invalidate(self, points: Iterable[int]):
+        """Removes the compatible endpoint pairs involving the points"""
+        for segment_type, new_pair_types in enumerate([(0, 1, 2), (3, 4, 5)]):
+            pair_combos = self._current_pair_combos[segment_type]
+            matched_by = self._matched_by[segment_type]
+            for endpts in self._get_lower_endpts_of_points(
+                segment_type, points
+            ):
+                for ordered_endpts in [endpts, endpts[::-1]]:
+                    for other_endpts in pair_combos.pop(ordered_endpts, ()):
+                        matched_by[other_endpts].discard(ordered_endpts)
+                for other_endpts in matched_by.pop(endpts, ()):
+                    pair_combos[other_endpts].discard(endpts)
+                for new_pair_type in new_pair_types:
+                    self._new_tri_pair_combos[new_pair_type].discard(endpts)
+
+    def _revalidate(self, points: Iterable[int]):
+        """Adds the compatible endpoint pairs involving the points"""
+        for segment_type in range(2):
+            pair_combos = self._current_pair_combos[segment_type]
+            matched_by = self._matched_by[segment_type]
+            updated_lower_endpts = self._get_lower_endpts_of_points(
+                segment_type, points
+            )
+            matches = []
+            for endpts in updated_lower_endpts:
+                candidates = self._get_candidate_endpts(segment_type, endpts)
+                matches += [
+                    (ordered_endpts, other_endpts)
+                    for ordered_endpts in [endpts, endpts[::-1]]
+                    for other_endpts in candidates
+                ] + [
+                    (ordered_endpts, endpts)
+                    for other_endpts in candidates - updated_lower_endpts
+                    for ordered_endpts in [other_endpts, other_endpts[::-1]]
+                ]
+            for ordered_endpts, other_endpts in matches:
+                if self._are_compatible(
+                    segment_type, ordered_endpts[0], other_endpts[0]
+                ) and self._are_compatible(
+                    segment_type, ordered_endpts[1], other_endpts[1]
+                ):
+                    pair_combos[ordered_endpts].add(other_endpts)
+                    matched_by[other_endpts].add(ordered_endpts)
+
+            for new_pair_type, (seg_type, new_pt_types) in enumerate(
+                NEW_ENDPOINT_PAIR_TYPES
+            ):
+                if seg_type != segment_type or not all(
+                    NEW_POINTS_WITH_VALID_SEGMENT[seg_type][new_pt_type]
+                    for new_pt_type in new_pt_types
+                ):
+                    continue
+                for endpts in updated_lower_endpts:
+                    if all(
+                        self._n_light_crossings[pt]
+                        + NEW_POINTS_N_LIGHT_CROSSINGS[new_pt_type]
+                        <= 4
+                        for pt, new_pt_type in zip(endpts, new_pt_types)
+                    ):
+                        self._new_tri_pair_combos[new_pair_type].add(endpts)
+
+    def _are_compatible(self, segment_type, point, other_point) -> bool:
+        """
+        Entry of the lower triangular part of the consolidated point
+        combination filter, see _are_compatible_existing_points
+        """
+        if other_point == point:
+            n_vseg = sum(self._valid_neighbors[segment_type][point].values())
+            return n_vseg >= 2 and self._n_light_crossings[point] == 4
+        return (
+            other_point < point
+            and self._n_light_crossings[point]
+            + self._n_light_crossings[other_point]
+            <= 4
+            and other_point not in self._neighbors[point]
+        )
+
+    def _get_candidate_endpts(
+        self, segment_type: int, endpts: Edge
+    ) -> Set[Edge]:
+        """
+        Endpoint pairs (p0, p1), p0 > p1, of valid segments that can be
+        compatible with the endpoint pair in either orientation: the pairs
+        sharing one of its points, and the pairs whose crossings added to
+        those of its points are at most 4
+        """
+        n_free_0, n_free_1 = [4 - self._n_light_crossings[pt] for pt in endpts]
+        candidates = self._get_lower_endpts_of_points(segment_type, endpts)
+        for (n_0, n_1), bucket in self._lower_endpts_by_crossings[
+            segment_type
+        ].items():
+            if (n_0 <= n_free_0 and n_1 <= n_free_1) or (
+                n_1 <= n_free_0 and n_0 <= n_free_1
+            ):
+                candidates |= bucket
+        return candidates
+
+    def _add_to_bucket(self, segment_type: int, endpts: Edge):
+        key = tuple(self._n_light_crossings[pt] for pt in endpts)
+        self._lower_endpts_by_crossings[segment_type][key].add(endpts)
+
+    def _discard_from_bucket(self, segment_type: int, endpts: Edge):
+        key = tuple(self._n_light_crossings[pt] for pt in endpts)
+        buckets = self._lower_endpts_by_crossings[segment_type]
+        buckets[key].discard(endpts)
+        if not buckets[key]:
+            del buckets[key]
+
+    def _get_lower_endpts_of_points(
+        self, segment_type: int, points: Iterable[int]
+    ) -> Set[Edge]:
+        """Endpoint pairs (p0, p1), p0 > p1, of valid segments at the points"""
+        valid_neighbors = self._valid_neighbors[segment_type]
+        return {
+            (max(pt, neighbor), min(pt, neighbor))
+            for pt in points
+            for neighbor in valid_neighbors.get(pt, ())
+        }
+
+    def _find_boundary_segment(self, segment_type, p0, p1, exclude=None):
+        """
+        Lowest indexed boundary segment of the given type between the points.
+        A segment paired with itself (which the point combination filters
+        allow) has no other segment to be glued to.
+        """
+        segments = [
+            segment
+            for segment in self._boundary_segments_at_pt[p0]
+            if segment != exclude
+            and self._boundary_segments[segment][0] == segment_type
+            and set(self._boundary_segments[segment][1:]) == {p0, p1}
+        ]
+        if not segments:
+            raise ValueError(
+                f"No boundary segment of type {segment_type} left between "
+                f"points {p0} and {p1} to be glued"
+            )
+        return min(segments)
+
+    def _add_boundary_segment(self, segment, segment_type, p0, p1):
+        self._boundary_segments[segment] = (segment_type, p0, p1)
+        valid_neighbors = self._valid_neighbors[segment_type]
+        for pt, other_pt in [(p0, p1), (p1, p0)]:
+            self._boundary_segments_at_pt[pt].add(segment)
+            valid_neighbors[pt][other_pt] += 1
+        self._add_to_bucket(segment_type, (max(p0, p1), min(p0, p1)))
+
+    def _remove_boundary_segment(self, segment):
+        segment_type, p0, p1 = self._boundary_segments.pop(segment)
+        valid_neighbors = self._valid_neighbors[segment_type]
+        for pt, other_pt in [(p0, p1), (p1, p0)]:
+            self._boundary_segments_at_pt[pt].discard(segment)
+            valid_neighbors[pt][other_pt] -= 1
+            if valid_neighbors[pt][other_pt] == 0:
+                del valid_neighbors[pt][other_pt]
+            if not valid_neighbors[pt]:
+                del valid_neighbors[pt]
+        if p1 not in valid_neighbors.get(p0, ()):
+            self._discard_from_bucket(segment_type, (max(p0, p1), min(p0, p1)))
+
+    def _add_neighbors(self, p0, p1):
+        self._neighbors[p0][p1] += 1
+        self._neighbors[p1][p0] += 1
+
+    def _remove_neighbors(self, p0, p1):
+        for pt, other_pt in [(p0, p1), (p1, p0)]:
+            self._neighbors[pt][other_pt] -= 1
+            if self._neighbors[pt][other_pt] == 0:
+                del self._neighbors[pt][other_pt]
+
+    def _to_index(self, node_index: int) -> int:
+        """Index of the point with the given node index in the triangulation"""
+        index = node_index
+        while True:
+            shifted = node_index + bisect_right(self._removed_points, index)
+            if shifted == index:
+                return index
+            index = shifted
+
+    def _to_tensor(self, rows, n_columns: int) -> tf.Tensor:
+        """Rows of point indices as node indices of the triangulation"""
+        indices = tf.reshape(
+            tf.constant(rows, dtype=tf.int64), (-1, n_columns)
+        )
+        n_removed_before = tf.searchsorted(
+            tf.constant(self._removed_points, dtype=tf.int64),
+            tf.reshape(indices, [-1]),
+            side="left",
+            out_type=tf.int64,
+        )
+        return indices - tf.reshape(n_removed_before, (-1, n_columns))
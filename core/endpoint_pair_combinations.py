@@ -1,34 +1,176 @@
-from typing import Tuple
+from typing import Optional, Tuple
 
 import tensorflow as tf
 
+from core.point_adjacency import construct_point_adjacency, get_segment_points
+from core.profiling import profiled
 
+# Smallest padded number of points and of segments in compiled mode
+MIN_BUCKET_SIZE = 16
+
+# Bytes of the filter of one endpoint pair per (p0', p1') combination: the
+# boolean combinations of p0' and p1', their float32 cast, the gathered float32
+# neighbours of the valid segments and their float32 product
+FILTER_BYTES_PER_COMBINATION = 13
+# Bytes per (n_points + 3, n_points) point pair of the tensors that are kept
+# while the endpoint pairs are filtered, chunked or not: the float32 endpoint
+# adjacency of the valid segments and its lower triangle (8 + 8 bytes for the
+# two segment types), the boolean point combination filter and its lower
+# triangle (2 + 2 bytes). This also bounds the temporaries of
+# _consolidate_point_combination_filters, at most 17 bytes per point pair
+POINT_PAIR_BYTES = 20
+
+
+@profiled("extractor")
 def extract_endpoint_pair_combinations(
     triangulation,
+    chunk_size: Optional[int] = None,
+    max_peak_bytes: Optional[int] = None,
 ) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
+    """
+    By default, the combinations of all the endpoint pairs are filtered at
+    once with a (N+6, n_points, n_points) filter. Given chunk_size or
+    max_peak_bytes, the endpoint pairs are instead filtered chunk by chunk,
+    so the filter only takes O(chunk_size * n_points ** 2) memory, and the
+    returned tensors are identical (values and ordering).
+
+    Chunking does not remove the O(n_points ** 2) point pair filters and
+    endpoint adjacencies the chunks are built from, see POINT_PAIR_BYTES.
+    max_peak_bytes accounts for them, so it cannot be lower than their
+    floor. The indices of the returned combinations grow with the number of
+    combinations found and are not part of the cap.
+
+    Parameters
+    ----------
+    triangulation: dgl.DGLHeteroGraph
+    chunk_size: int
+        Number of endpoint pairs filtered at once
+    max_peak_bytes: int
+        Memory cap of the point pair tensors and of the filter of a chunk,
+        from which the chunk size is derived when chunk_size is not given
+    """
+    n_points = triangulation.num_nodes("point")
+    if chunk_size is None and max_peak_bytes is not None:
+        chunk_size = _get_chunk_size(n_points, max_peak_bytes)
+
     # ------------------ Get relevant data from triangulation ------------------
-    segment_to_point_adj = tf.sparse.to_dense(
-        tf.sparse.reorder(triangulation.adj(etype="segment_has_point"))
+    return _extract_endpoint_pair_combinations(
+        get_segment_points(triangulation),
+        triangulation.nodes["segment"].data["segment_type"],
+        triangulation.nodes["segment"].data["boundary"],
+        triangulation.nodes["point"].data["n_light_cone_angle"],
+        chunk_size,
     )
-    encoded_segment_type = tf.one_hot(
-        tf.cast(triangulation.nodes["segment"].data["segment_type"], tf.int32),
-        2,
+
+
+def _get_chunk_size(n_points: int, max_peak_bytes: int) -> int:
+    """
+    Largest number of endpoint pairs whose filter fits in max_peak_bytes
+    next to the point pair tensors
+
+    Raises
+    ------
+    ValueError
+        If max_peak_bytes does not fit the point pair tensors and the filter
+        of a single endpoint pair
+    """
+    point_pair_bytes = POINT_PAIR_BYTES * (n_points + 3) * n_points
+    filter_bytes = FILTER_BYTES_PER_COMBINATION * n_points**2
+    if max_peak_bytes < point_pair_bytes + filter_bytes:
+        raise ValueError(
+            f"max_peak_bytes={max_peak_bytes} is below the "
+            f"{point_pair_bytes + filter_bytes} bytes taken by the point pair "
+            f"tensors and the filter of one endpoint pair of {n_points} points"
+        )
+    return (max_peak_bytes - point_pair_bytes) // filter_bytes
+
+
+@profiled("extractor.compiled")
+def extract_compiled_endpoint_pair_combinations(
+    triangulation,
+) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
+    """
+    Compiled counterpart of extract_endpoint_pair_combinations. The numbers of
+    points and segments are padded up to the next power of two (at least
+    MIN_BUCKET_SIZE), so the extractor is traced once per bucket and then runs
+    as a single graph for every triangulation falling into that bucket.
+
+    The padded segments are masked out by being neither boundary segments nor
+    connecting two points, and the padded points are masked out by having no
+    valid segments. They can then never be part of a combination, so the six
+    returned tensors are identical (values and ordering) to the ones returned
+    by extract_endpoint_pair_combinations.
+    """
+    n_segments = triangulation.num_nodes("segment")
+    n_points = triangulation.num_nodes("point")
+    n_padded_segments = _get_bucket_size(n_segments)
+    n_padded_points = _get_bucket_size(n_points)
+
+    return _compiled_extract_endpoint_pair_combinations(
+        _pad(get_segment_points(triangulation), n_padded_segments),
+        _pad(
+            triangulation.nodes["segment"].data["segment_type"],
+            n_padded_segments,
+        ),
+        _pad(
+            triangulation.nodes["segment"].data["boundary"], n_padded_segments
+        ),
+        _pad(
+            triangulation.nodes["point"].data["n_light_cone_angle"],
+            n_padded_points,
+        ),
     )
-    segment_type = tf.expand_dims(tf.transpose(encoded_segment_type), 2)
-    boundary_segments = tf.expand_dims(
-        triangulation.nodes["segment"].data["boundary"], 1
+
+
+@tf.function
+def _compiled_extract_endpoint_pair_combinations(
+    segment_points: tf.Tensor,
+    segment_type: tf.Tensor,
+    boundary: tf.Tensor,
+    n_light_crossings_per_pt: tf.Tensor,
+) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
+    """
+    Traced once per bucket: every input has a static (padded) shape, the
+    padded segments have both endpoints at point 0
+    """
+    return _extract_endpoint_pair_combinations(
+        segment_points, segment_type, boundary, n_light_crossings_per_pt
     )
+
+
+def _get_bucket_size(n: int) -> int:
+    """Smallest power of two that is at least n and MIN_BUCKET_SIZE"""
+    return max(MIN_BUCKET_SIZE, 1 << (n - 1).bit_length())
+
+
+def _pad(values: tf.Tensor, size: int) -> tf.Tensor:
+    """Pads the first dimension of values with zeros up to size"""
+    paddings = [[0, size - values.shape[0]]] + [[0, 0]] * (
+        len(values.shape) - 1
+    )
+    return tf.pad(values, paddings)
+
+
+def _extract_endpoint_pair_combinations(
+    segment_points: tf.Tensor,
+    segment_type: tf.Tensor,
+    boundary: tf.Tensor,
+    n_light_crossings_per_pt: tf.Tensor,
+    chunk_size: Optional[int] = None,
+) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
+    encoded_segment_type = tf.one_hot(tf.cast(segment_type, tf.int32), 2)
+    segment_type = tf.transpose(encoded_segment_type)
+    boundary_segments = tf.reshape(tf.cast(boundary, tf.float32), [1, -1])
     valid_segments = boundary_segments * segment_type
-    n_light_crossings_per_pt = triangulation.nodes["point"].data[
-        "n_light_cone_angle"
-    ]
+    # The node data may be stored in integer dtypes, see compact_node_data
+    n_light_crossings_per_pt = tf.cast(n_light_crossings_per_pt, tf.float32)
 
     # ------------------------ Extract combinations ----------------------------
     endpt_adj_of_vseg = _construct_endpoint_adjacency_of_valid_segments(
-        segment_to_point_adj, valid_segments
+        segment_points, valid_segments, n_light_crossings_per_pt.shape[0]
     )
     valid_point_combinations_filter = _consolidate_point_combination_filters(
-        segment_to_point_adj,
+        segment_points,
         endpt_adj_of_vseg,
         n_light_crossings_per_pt,
     )
@@ -36,19 +178,30 @@ def extract_endpoint_pair_combinations(
     segment_endpts = _get_valid_segment_endpoints_to_connect(
         endpt_adj_of_vseg,
     )
-    valid_endpt_pair_combinations_filter = (
-        _create_combination_filter_for_each_endpoint_pair(
+    if chunk_size is None:
+        valid_endpt_pair_combinations_filter = (
+            _create_combination_filter_for_each_endpoint_pair(
+                segment_endpts,
+                valid_point_combinations_filter,
+                endpt_adj_of_vseg,
+            )
+        )
+        (
+            current_pair_combos,
+            new_tri_pair_combos,
+        ) = _get_compatible_endpoint_pair_combinations(
+            segment_endpts, valid_endpt_pair_combinations_filter
+        )
+    else:
+        (
+            current_pair_combos,
+            new_tri_pair_combos,
+        ) = _get_chunked_compatible_endpoint_pair_combinations(
             segment_endpts,
             valid_point_combinations_filter,
             endpt_adj_of_vseg,
+            chunk_size,
         )
-    )
-    (
-        current_pair_combos,
-        new_tri_pair_combos,
-    ) = _get_compatible_endpoint_pair_combinations(
-        segment_endpts, valid_endpt_pair_combinations_filter
-    )
 
     # --------------------- Group combinations per type ------------------------
 
@@ -102,6 +255,7 @@ def _get_pair_combos_per_type(
     return pair_combos_per_type
 
 
+@profiled("extractor.where_combinations")
 def _get_compatible_endpoint_pair_combinations(
     segment_endpts: tf.Tensor, valid_endpt_pair_combinations_filter: tf.Tensor
 ) -> Tuple[tf.Tensor, tf.Tensor]:
@@ -161,11 +315,58 @@ def _get_compatible_endpoint_pair_combinations(
                 -> new_tri_pair_combos[:, [1, 2]] refer to the endpoint pairs
                     that can be matched to the new endpoint pair types
     """
-    valid_combos_for_connected_endpt_pairs = tf.where(
-        valid_endpt_pair_combinations_filter[:-6, :, :]
+    return _gather_compatible_endpoint_pair_combinations(
+        segment_endpts, tf.where(valid_endpt_pair_combinations_filter)
     )
+
+
+@profiled("extractor.chunked_where_combinations")
+def _get_chunked_compatible_endpoint_pair_combinations(
+    segment_endpts: tf.Tensor,
+    valid_point_combinations_filter: tf.Tensor,
+    endpt_adj_of_vseg: tf.Tensor,
+    chunk_size: int,
+) -> Tuple[tf.Tensor, tf.Tensor]:
+    """
+    Streaming counterpart of _create_combination_filter_for_each_endpoint_pair
+    followed by _get_compatible_endpoint_pair_combinations. The filter is
+    created for chunk_size endpoint pairs of segment_endpts at a time, and the
+    indices of its nonzero entries are offset by the first endpoint pair of
+    the chunk. Concatenating them gives the indices of the full filter in the
+    same (row major) order.
+    """
+    combination_indices = []
+    for start in range(0, segment_endpts.shape[0], chunk_size):
+        chunk_filter = _create_combination_filter_for_each_endpoint_pair(
+            segment_endpts[start : start + chunk_size],
+            valid_point_combinations_filter,
+            endpt_adj_of_vseg,
+        )
+        combination_indices.append(
+            tf.where(chunk_filter) + tf.constant([start, 0, 0], dtype=tf.int64)
+        )
+    return _gather_compatible_endpoint_pair_combinations(
+        segment_endpts, tf.concat(combination_indices, axis=0)
+    )
+
+
+def _gather_compatible_endpoint_pair_combinations(
+    segment_endpts: tf.Tensor, combination_indices: tf.Tensor
+) -> Tuple[tf.Tensor, tf.Tensor]:
+    """
+    Splits the indices of the nonzero entries of the (N+6, n_points, n_points)
+    filter of _create_combination_filter_for_each_endpoint_pair, in row major
+    order, into the current_pair_combos and new_tri_pair_combos of
+    _get_compatible_endpoint_pair_combinations
+    """
+    n_current_endpts = tf.shape(segment_endpts, out_type=tf.int64)[0] - 6
+    is_current = tf.math.less(combination_indices[:, 0], n_current_endpts)
+    n_current_combos = tf.reduce_sum(tf.cast(is_current, tf.int32))
+    valid_combos_for_connected_endpt_pairs = combination_indices[
+        :n_current_combos
+    ]
     endpoint_pairs_being_considered = tf.gather(
-        segment_endpts[:-6, :],
+        segment_endpts,
         valid_combos_for_connected_endpt_pairs[:, 0],
     )
     current_pair_combos = tf.concat(
@@ -176,12 +377,14 @@ def _get_compatible_endpoint_pair_combinations(
         axis=1,
     )
 
-    new_tri_pair_combos = tf.where(
-        valid_endpt_pair_combinations_filter[-6:, :, :]
+    # The new triangle types are the indices of the last 6 endpoint pairs
+    new_tri_pair_combos = combination_indices[n_current_combos:] - tf.stack(
+        [n_current_endpts, 0, 0]
     )
     return current_pair_combos, new_tri_pair_combos
 
 
+@profiled("extractor.endpoint_pair_filter")
 def _create_combination_filter_for_each_endpoint_pair(
     segment_endpts: tf.Tensor,
     valid_point_combinations_filter: tf.Tensor,
@@ -280,6 +483,7 @@ def _get_combination_filter_for_each_point(
     return combination_filter_for_each_pt
 
 
+@profiled("extractor.segment_endpoints")
 def _get_valid_segment_endpoints_to_connect(
     endpt_adj_of_vseg: tf.Tensor,
 ) -> tf.Tensor:
@@ -348,8 +552,9 @@ def _get_valid_segment_endpoints_to_connect(
     return segment_endpts
 
 
+@profiled("extractor.point_combination_filters")
 def _consolidate_point_combination_filters(
-    segment_to_point_adj: tf.Tensor,
+    segment_points: tf.Tensor,
     endpt_adj_of_vseg: tf.Tensor,
     n_light_crossings_per_pt: tf.Tensor,
 ) -> tf.Tensor:
@@ -364,9 +569,8 @@ def _consolidate_point_combination_filters(
 
     Parameters
     ----------
-    segment_to_point_adj: tf.Tensor
-        Tensor of shape (n_segments, n_points) representing which segments
-        contain which points
+    segment_points: tf.Tensor
+        Tensor of shape (n_segments, 2) of the endpoints of each segment
     endpt_adj_of_vseg: tf.Tensor
         Tensor of shape (n_segment_types, n_points, n_points) representing the
         points connected through a boundary segment of a particular type
@@ -382,7 +586,7 @@ def _consolidate_point_combination_filters(
     """
     non_neighbor_points_filter = (
         _create_filter_for_non_neighbor_point_combinations(
-            segment_to_point_adj
+            segment_points, n_light_crossings_per_pt.shape[0]
         )
     )
     endpoints_of_valid_segments_filter = (
@@ -405,7 +609,7 @@ def _consolidate_point_combination_filters(
 
 
 def _create_filter_for_non_neighbor_point_combinations(
-    segment_to_point_adj: tf.Tensor,
+    segment_points: tf.Tensor, n_points: int
 ) -> tf.Tensor:
     """
     Filters out point pair combinations that are connected by a segment. What
@@ -420,9 +624,9 @@ def _create_filter_for_non_neighbor_point_combinations(
 
     Parameters
     ----------
-    segment_to_point_adj: tf.Tensor
-        Tensor of shape (n_segments, n_points) representing which segments
-        contain which points
+    segment_points: tf.Tensor
+        Tensor of shape (n_segments, 2) of the endpoints of each segment
+    n_points: int
 
     Returns
     -------
@@ -430,16 +634,16 @@ def _create_filter_for_non_neighbor_point_combinations(
         Boolean tensor of shape (n_points+3, n_points) representing whether
         the point pairs are not connected by a segment
     """
-    pt_to_pt = _construct_pt_to_pt_adjacency(segment_to_point_adj)
+    pt_to_pt = construct_point_adjacency(
+        segment_points, tf.ones(tf.shape(segment_points)[:1]), n_points
+    )
     # non-neighbor points are points that are not connected by a segment
     non_neighbor_points_filter = tf.math.equal(pt_to_pt, 0)
 
     # points for new triangle
     # 3 point types for tss or stt triangle
     # new points are always initially disconnected
-    disconnected_new_points = tf.cast(
-        tf.ones(shape=(3, segment_to_point_adj.shape[1])), tf.bool
-    )
+    disconnected_new_points = tf.cast(tf.ones(shape=(3, n_points)), tf.bool)
     non_neighbor_points_filter = tf.concat(
         [non_neighbor_points_filter, disconnected_new_points], axis=0
     )
@@ -568,8 +772,9 @@ def _create_filter_for_point_combinations_obeying_local_causality(
     return light_cones_filter
 
 
+@profiled("extractor.endpoint_adjacency")
 def _construct_endpoint_adjacency_of_valid_segments(
-    segment_to_point_adj: tf.Tensor, valid_segments: tf.Tensor
+    segment_points: tf.Tensor, valid_segments: tf.Tensor, n_points: int
 ) -> tf.Tensor:
     """
     Constructs the adjacency matrix of points connected by boundary segments
@@ -577,16 +782,16 @@ def _construct_endpoint_adjacency_of_valid_segments(
 
     Parameters
     ----------
-    segment_to_point_adj: tf.Tensor
-        Tensor of shape (n_segments, n_points) representing which segments
-        contain which points
+    segment_points: tf.Tensor
+        Tensor of shape (n_segments, 2) of the endpoints of each segment
     valid_segments: tf.Tensor
-        Tensor of shape (n_segment_types, n_segments, 1) representing whether
+        Tensor of shape (n_segment_types, n_segments) representing whether
         the segment is a boundary segment and of a particular type
         - Boundary segments: Segments that are contained in only one triangle
         - Segment types: Time-like type or Space-like type
-            -> valid_segments[0, :, :] represent time-like boundary segments
-            -> valid_segments[1, :, :] represent space-like boundary segments
+            -> valid_segments[0, :] represent time-like boundary segments
+            -> valid_segments[1, :] represent space-like boundary segments
+    n_points: int
 
     Returns
     -------
@@ -594,31 +799,7 @@ def _construct_endpoint_adjacency_of_valid_segments(
         Tensor of shape (n_segment_types, n_points, n_points) representing the
         points connected through a boundary segment of a particular type
     """
-    vseg_to_pt = valid_segments * segment_to_point_adj
-    endpt_adj_of_vseg = _construct_pt_to_pt_adjacency(vseg_to_pt)
+    endpt_adj_of_vseg = construct_point_adjacency(
+        segment_points, valid_segments, n_points
+    )
     return endpt_adj_of_vseg
-
-
-def _construct_pt_to_pt_adjacency(
-    segment_to_point_adj: tf.Tensor,
-) -> tf.Tensor:
-    """
-    Constructs the adjacency matrix of points connected by segments
-
-    Parameters
-    ----------
-    segment_to_point_adj: tf.Tensor
-        Tensor of shape (n_segments, n_points) representing which segments
-        contain which points
-
-    Returns
-    -------
-    pt_to_pt_adj: tf.Tensor
-        Tensor of shape (n_points, n_points) representing the points connected
-        through a segment
-    """
-    pt_degrees = tf.reduce_sum(segment_to_point_adj, axis=-2)
-    pt_to_pt_adj = tf.linalg.matmul(
-        segment_to_point_adj, segment_to_point_adj, transpose_a=True
-    ) - tf.linalg.diag(pt_degrees)
-    return pt_to_pt_adj
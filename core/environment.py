@@ -4,23 +4,314 @@ import dgl
 import dgl.function as fn
 import tensorflow as tf
 
+from core.actions import (
+    NEW_TRIANGLE_ACTIONS,
+    STT_SEGMENT_TYPES,
+    TERMINATE_ACTION,
+    TSS_SEGMENT_TYPES,
+)
+from core.endpoint_pair_combination_index import EndpointPairCombinationIndex
+from core.endpoint_pair_combinations import extract_endpoint_pair_combinations
+from core.profiling import profiled
+from core.tensor_utils import boolean_mask
+
+# Process-wide store of the base triangles with their data already computed,
+# keyed by their segment types and storage. Filled on first use, see
+# _get_base_triangle
+_BASE_TRIANGLES = {}
+
+# Integer dtypes of the node data in compact storage. The angle types are
+# stored as codes rather than one-hot encodings
+COMPACT_NODE_DATA_DTYPES = {
+    "angle": {"angle_type": tf.int8, "light_cone_angle": tf.int8},
+    "point": {"n_angle_types": tf.int16, "n_light_cone_angle": tf.int16},
+    "segment": {"boundary": tf.bool, "segment_type": tf.int8},
+    "triangle": {"triangle_type": tf.int8},
+}
+
 
 class TriangulationEnvironment:
-    def __init__(self):
-        triangle = _create_base_triangle()
-        self.tss_triangle = _create_tss_triangle(triangle)
-        self.stt_triangle = _create_stt_triangle(triangle)
+    def __init__(
+        self,
+        feature_cache=None,
+        compact_storage=False,
+        combination_index=False,
+    ):
+        # Whether the node data is stored in the integer dtypes of
+        # COMPACT_NODE_DATA_DTYPES instead of float32
+        self.compact_storage = compact_storage
+        self.tss_triangle = _get_base_triangle(
+            TSS_SEGMENT_TYPES, compact_storage
+        )
+        self.stt_triangle = _get_base_triangle(
+            STT_SEGMENT_TYPES, compact_storage
+        )
+        # Optional FeatureCache of the transitions, keyed by the state and
+        # the action
+        self.feature_cache = feature_cache
+        # Whether the endpoint pair combinations are kept by an
+        # EndpointPairCombinationIndex updated by every step, instead of being
+        # extracted from every state, see combinations
+        self.combination_index = combination_index
+        self._index = None
+        self._indexed_state = None
 
         self.state = None
+        self.done = False
 
     def reset(self):
         random_start = tf.random.uniform(shape=(), minval=0, maxval=1)
         self.state = tf.case(
-            [(tf.math.less(random_start, 0.5), lambda: self.tss_triangle)],
-            default=lambda: self.stt_triangle,
+            [
+                (
+                    tf.math.less(random_start, 0.5),
+                    lambda: _clone_triangulation(self.tss_triangle),
+                )
+            ],
+            default=lambda: _clone_triangulation(self.stt_triangle),
         )
+        self.done = False
         return self.state
 
+    def combinations(self):
+        """
+        The endpoint pair combinations of the current state, as returned by
+        extract_endpoint_pair_combinations. With combination_index, they are
+        read from the index, which is only rebuilt when the state was replaced
+        by something else than a step.
+        """
+        if not self.combination_index:
+            return extract_endpoint_pair_combinations(self.state)
+        if self._indexed_state is not self.state:
+            self._index = EndpointPairCombinationIndex(self.state)
+            self._indexed_state = self.state
+        return self._index.combinations()
+
+    def step(self, action):
+        """
+        Applies an action chosen from the endpoint pair combinations of the
+        current state. Two boundary segments s = (p0, p1) and s' = (p0', p1')
+        are glued by merging p0' into p0, p1' into p1 and s' into s. For the
+        actions adding a new triangle, the triangle is appended first and its
+        segment (q0, q1) plays the role of s'.
+
+        The gluing is done directly on the index arrays of the heterograph.
+        Only the data of the merged points and of the glued segment are
+        refreshed, the appended triangle already carries its data, so no
+        update_all is run.
+
+        Parameters
+        ----------
+        action: Tuple[int, tf.Tensor]
+            The action type (see NEW_TRIANGLE_ACTIONS and TERMINATE_ACTION) and
+            the chosen row of the corresponding endpoint pair combinations:
+                -> (p0, p1, p0', p1') for the current time-like or space-like
+                    pairs
+                -> (p0, p1) for the pairs of new triangles
+
+        Returns
+        -------
+        Tuple:
+            state: dgl.DGLHeteroGraph
+                The triangulation after the action
+            done: bool
+                Whether the triangulation is terminated
+        """
+        if action[0] == TERMINATE_ACTION:
+            self.done = True
+            return self.state, self.done
+
+        is_indexed = self._indexed_state is self.state
+        if self.feature_cache is None:
+            self.state = self._apply_action(self.state, *action)
+        else:
+            next_state = self.feature_cache.get_or_compute(
+                self.state,
+                "step",
+                self._apply_action,
+                action[0],
+                tuple(int(pt) for pt in action[1]),
+            )
+            # The cached state is shared, later changes go to the clone
+            self.state = _clone_triangulation(next_state)
+        if is_indexed:
+            action_type, endpoint_pairs = action
+            if action_type < 2:
+                self._index.glue_segments(action_type, endpoint_pairs)
+            else:
+                self._index.add_triangle(action_type, endpoint_pairs)
+            self._indexed_state = self.state
+        return self.state, self.done
+
+    def _apply_action(self, state, action_type, endpoint_pairs):
+        return _apply_actions(
+            state,
+            [(action_type, endpoint_pairs)],
+            self.tss_triangle,
+            self.stt_triangle,
+        )
+
+
+class VecTriangulationEnvironment:
+    """
+    Holds n_envs triangulations as one dgl.batch'ed heterograph. The batched
+    states can be passed directly to HeteroGraphPolicyNetwork and to
+    extract_batched_endpoint_pair_combinations, and all the actions of a step
+    are applied to the batched graph at once. Terminated triangulations are
+    replaced by a new starting triangle within the same batched graph.
+
+    Parameters
+    ----------
+    n_envs: int
+    compact_storage: bool
+        Whether the node data is stored in the integer dtypes of
+        COMPACT_NODE_DATA_DTYPES instead of float32, see compact_node_data
+    """
+
+    def __init__(self, n_envs, compact_storage=False):
+        self.compact_storage = compact_storage
+        self.tss_triangle = _get_base_triangle(
+            TSS_SEGMENT_TYPES, compact_storage
+        )
+        self.stt_triangle = _get_base_triangle(
+            STT_SEGMENT_TYPES, compact_storage
+        )
+        self.n_envs = n_envs
+
+        self.states = None
+
+    def reset(self):
+        self.states = dgl.batch(self._sample_starting_triangles(self.n_envs))
+        return self.states
+
+    def step(self, actions):
+        """
+        Applies one action per triangulation, see TriangulationEnvironment.step
+
+        Parameters
+        ----------
+        actions: List[Tuple[int, tf.Tensor]]
+            The action of each triangulation, with the endpoint pairs given as
+            node indices of the batched states (as returned by
+            extract_batched_endpoint_pair_combinations, without the graph
+            column)
+
+        Returns
+        -------
+        Tuple:
+            states: dgl.DGLHeteroGraph
+                The batched triangulations after the actions, where terminated
+                triangulations are already reset
+            dones: tf.Tensor
+                Boolean tensor of shape (n_envs, ) of the terminated
+                triangulations
+            terminal_states: List[dgl.DGLHeteroGraph]
+                The terminated triangulations, before being reset
+        """
+        dones = tf.constant(
+            [action[0] == TERMINATE_ACTION for action in actions]
+        )
+        terminated = tf.where(dones)[:, 0].numpy().tolist()
+        terminal_states = [
+            dgl.slice_batch(self.states, graph) for graph in terminated
+        ]
+        states = _apply_actions(
+            self.states, actions, self.tss_triangle, self.stt_triangle
+        )
+        if terminated:
+            states, _, _ = _rebatch(
+                states,
+                list(
+                    zip(
+                        terminated,
+                        self._sample_starting_triangles(len(terminated)),
+                    )
+                ),
+                removed_graphs=terminated,
+            )
+        self.states = states
+        return self.states, dones, terminal_states
+
+    def _sample_starting_triangles(self, n_triangles):
+        random_starts = tf.random.uniform(
+            shape=(n_triangles,), minval=0, maxval=1
+        )
+        return [
+            self.tss_triangle if random_start < 0.5 else self.stt_triangle
+            for random_start in random_starts
+        ]
+
+
+def _get_base_triangle(segment_types, compact_storage=False):
+    """
+    The base triangle with the given segment types from the process-wide
+    store. The triangle and its data are only created the first time, the
+    stored triangle must be cloned (see _clone_triangulation) before being
+    changed.
+    """
+    key = (segment_types, compact_storage)
+    if key not in _BASE_TRIANGLES:
+        if compact_storage:
+            triangle = _clone_triangulation(_get_base_triangle(segment_types))
+            for ntype, data in compact_node_data(
+                {
+                    ntype: triangle.nodes[ntype].data
+                    for ntype in triangle.ntypes
+                }
+            ).items():
+                triangle.nodes[ntype].data.update(data)
+            _BASE_TRIANGLES[key] = triangle
+        elif segment_types == TSS_SEGMENT_TYPES:
+            _BASE_TRIANGLES[key] = _create_tss_triangle(
+                _create_base_triangle()
+            )
+        else:
+            _BASE_TRIANGLES[key] = _create_stt_triangle(
+                _create_base_triangle()
+            )
+    return _BASE_TRIANGLES[key]
+
+
+def compact_node_data(node_data):
+    """
+    Converts the node data to the integer dtypes of COMPACT_NODE_DATA_DTYPES,
+    with the one-hot angle types converted to codes. The node data holds
+    small integers only, so no information is lost. The float features and
+    one-hot encodings are only produced by the policy network, see
+    _compute_local_features.
+
+    Parameters
+    ----------
+    node_data: Dict[str, Dict[str, tf.Tensor]]
+        The node data of each node type
+
+    Returns
+    -------
+    compact_node_data: Dict[str, Dict[str, tf.Tensor]]
+    """
+    compact_data = {}
+    for ntype, data in node_data.items():
+        dtypes = COMPACT_NODE_DATA_DTYPES.get(ntype, {})
+        compact_data[ntype] = {}
+        for key, value in data.items():
+            if key == "angle_type" and value.shape.rank == 2:
+                value = tf.math.argmax(value, axis=1)
+            if key in dtypes:
+                value = tf.cast(value, dtypes[key])
+            compact_data[ntype][key] = value
+    return compact_data
+
+
+def _clone_triangulation(triangulation):
+    """
+    Copy-on-write clone of a triangulation. The clone shares the graph
+    structure and the feature tensors with the original, but has its own
+    feature frames. Setting node data or changing the structure of the clone
+    replaces its own references only (tf.Tensors are never modified in
+    place), so the original is left untouched without copying any data.
+    """
+    return triangulation.local_var()
+
 
 def _create_base_triangle():
     triangle = dgl.heterograph(
@@ -52,7 +343,9 @@ def _create_base_triangle():
 
 def _create_tss_triangle(triangle):
     tss_triangle = deepcopy(triangle)
-    tss_triangle.nodes["segment"].data["segment_type"] = tf.constant([0, 1, 1])
+    tss_triangle.nodes["segment"].data["segment_type"] = tf.constant(
+        TSS_SEGMENT_TYPES, dtype=tf.float32
+    )
     tss_triangle = _create_triangle_data(tss_triangle)
     tss_triangle = _update_triangulation_data(tss_triangle)
     return tss_triangle
@@ -60,7 +353,9 @@ def _create_tss_triangle(triangle):
 
 def _create_stt_triangle(triangle):
     stt_triangle = deepcopy(triangle)
-    stt_triangle.nodes["segment"].data["segment_type"] = tf.constant([1, 0, 0])
+    stt_triangle.nodes["segment"].data["segment_type"] = tf.constant(
+        STT_SEGMENT_TYPES, dtype=tf.float32
+    )
     stt_triangle = _create_triangle_data(stt_triangle)
     stt_triangle = _update_triangulation_data(stt_triangle)
     return stt_triangle
@@ -126,4 +421,459 @@ def _update_triangulation_data(triangulation):
         reduce_func=fn.sum("m", "n_angle_types"),
         etype="angle_at_point",
     )
-    return triangulation
\ No newline at end of file
+    return triangulation
+
+
+@profiled("environment.apply_actions")
+def _apply_actions(triangulations, actions, tss_triangle, stt_triangle):
+    """
+    Applies one action per triangulation of a (possibly batched) heterograph.
+    New triangles are inserted first, then all the segment pairs are glued at
+    once. Triangulations whose action is TERMINATE_ACTION are left as is.
+    """
+    segment_types, endpts, other_endpts, new_triangles = [], [], [], []
+    for graph, (action_type, endpoint_pairs) in enumerate(actions):
+        if action_type == TERMINATE_ACTION:
+            continue
+        endpoint_pairs = [int(pt) for pt in endpoint_pairs]
+        if action_type in NEW_TRIANGLE_ACTIONS:
+            triangle_segment_types, glued_segment = NEW_TRIANGLE_ACTIONS[
+                action_type
+            ]
+            segment_types.append(triangle_segment_types[glued_segment])
+            new_triangles.append(
+                (
+                    len(endpts),
+                    graph,
+                    (
+                        tss_triangle
+                        if triangle_segment_types == TSS_SEGMENT_TYPES
+                        else stt_triangle
+                    ),
+                    glued_segment,
+                )
+            )
+            other_endpts.append(None)
+        else:
+            segment_types.append(action_type)
+            other_endpts.append(endpoint_pairs[2:])
+        endpts.append(endpoint_pairs[:2])
+    if not endpts:
+        return triangulations
+
+    # ------------------------- Append new triangles ---------------------------
+    other_segments = [None] * len(endpts)
+    if new_triangles:
+        triangulations, node_maps, new_node_inds = _rebatch(
+            triangulations,
+            [(graph, triangle) for _, graph, triangle, _ in new_triangles],
+        )
+        point_map = node_maps["point"].numpy()
+        endpts = [point_map[pts].tolist() for pts in endpts]
+        other_endpts = [
+            None if pts is None else point_map[pts].tolist()
+            for pts in other_endpts
+        ]
+        new_points = new_node_inds["point"].numpy()
+        new_segments = new_node_inds["segment"].numpy()
+        point_offset = segment_offset = 0
+        for i, _, triangle, glued_segment in new_triangles:
+            other_endpts[i] = [
+                int(new_points[point_offset + glued_segment]),
+                int(new_points[point_offset + (glued_segment + 1) % 3]),
+            ]
+            other_segments[i] = int(
+                new_segments[segment_offset + glued_segment]
+            )
+            point_offset += triangle.num_nodes("point")
+            segment_offset += triangle.num_nodes("segment")
+
+    # ---------------------------- Glue segments -------------------------------
+    segments = _find_boundary_segments(
+        triangulations, segment_types, endpts
+    ).numpy()
+    current = [
+        i for i, segment in enumerate(other_segments) if segment is None
+    ]
+    if current:
+        found_segments = _find_boundary_segments(
+            triangulations,
+            [segment_types[i] for i in current],
+            [other_endpts[i] for i in current],
+            excluded_segments=segments[current],
+        ).numpy()
+        for i, segment in zip(current, found_segments):
+            other_segments[i] = segment
+    return _glue_segments(
+        triangulations,
+        segments,
+        other_segments,
+        [pt for pts in endpts for pt in pts],
+        [pt for pts in other_endpts for pt in pts],
+    )
+
+
+@profiled("environment.find_boundary_segments")
+def _find_boundary_segments(
+    triangulations, segment_types, endpts, excluded_segments=None
+):
+    """
+    Finds, for each (segment type, (p0, p1)), the lowest indexed boundary
+    segment of the given type between the points p0 and p1. The excluded
+    segments are skipped, as a segment cannot be glued to itself.
+    """
+    n_points = tf.cast(triangulations.num_nodes("point"), tf.int64)
+    seg_inds, pt_inds = triangulations.edges(etype="segment_has_point")
+    segment_endpts = tf.cast(
+        tf.reshape(
+            tf.gather(pt_inds, tf.argsort(seg_inds, stable=True)), (-1, 2)
+        ),
+        tf.int64,
+    )
+    boundary_segments = tf.where(
+        tf.cast(triangulations.nodes["segment"].data["boundary"], tf.bool)
+    )[:, 0]
+    keys = _segment_keys(
+        tf.gather(
+            triangulations.nodes["segment"].data["segment_type"],
+            boundary_segments,
+        ),
+        tf.gather(segment_endpts, boundary_segments),
+        n_points,
+    )
+    order = tf.argsort(keys, stable=True)
+    keys = tf.gather(keys, order)
+    boundary_segments = tf.gather(boundary_segments, order)
+
+    query_keys = _segment_keys(
+        tf.constant(segment_types),
+        tf.constant(endpts, dtype=tf.int64),
+        n_points,
+    )
+    first = tf.searchsorted(keys, query_keys, side="left", out_type=tf.int64)
+    last = tf.searchsorted(keys, query_keys, side="right", out_type=tf.int64)
+    if excluded_segments is not None:
+        is_excluded = tf.math.equal(
+            tf.gather(
+                tf.concat(
+                    [boundary_segments, tf.constant([-1], dtype=tf.int64)],
+                    axis=0,
+                ),
+                first,
+            ),
+            excluded_segments,
+        )
+        first += tf.cast(is_excluded, tf.int64)
+    is_found = tf.math.less(first, last)
+    if not tf.reduce_all(is_found):
+        missing = tf.where(tf.math.logical_not(is_found))[0, 0]
+        raise ValueError(
+            f"No boundary segment of type {segment_types[missing]} left "
+            f"between points {endpts[missing]} to be glued"
+        )
+    return tf.gather(boundary_segments, first)
+
+
+def _segment_keys(segment_types, segment_endpts, n_points):
+    """int64 keys of (segment type, unordered endpoints)"""
+    segment_types = tf.cast(segment_types, tf.int64)
+    return (
+        segment_types * n_points + tf.math.reduce_min(segment_endpts, axis=1)
+    ) * n_points + tf.math.reduce_max(segment_endpts, axis=1)
+
+
+@profiled("environment.rebatch")
+def _rebatch(triangulations, new_graphs, removed_graphs=()):
+    """
+    Rearranges the nodes of a (possibly batched) heterograph, where every node
+    of the removed graphs is removed and the nodes of each new graph are
+    inserted after the nodes of the graph in the batch it is added to. The
+    nodes and edges of each graph in the batch stay contiguous, so the
+    batch_num_nodes and batch_num_edges remain valid. The node data of the
+    new graphs is complete, so nothing needs to be recomputed.
+
+    Parameters
+    ----------
+    triangulations: dgl.DGLHeteroGraph
+    new_graphs: List[Tuple[int, dgl.DGLHeteroGraph]]
+        The graphs to insert and the index of the graph in the batch they are
+        added to
+    removed_graphs: List[int]
+        The indices of the graphs in the batch whose nodes are removed
+
+    Returns
+    -------
+    Tuple:
+        graph: dgl.DGLHeteroGraph
+        node_maps: Dict[str, tf.Tensor]
+            The new node index of each node for each node type (-1 for removed
+            nodes)
+        new_node_inds: Dict[str, tf.Tensor]
+            The node indices of the inserted nodes for each node type, in the
+            order of the new graphs
+    """
+    batch_size = triangulations.batch_size
+    is_removed_graph = tf.math.bincount(
+        tf.constant(removed_graphs, dtype=tf.int32),
+        minlength=batch_size,
+        maxlength=batch_size,
+    )
+    # All the new graphs are inserted at once
+    new_batch = dgl.batch([graph for _, graph in new_graphs])
+    graph_inds_of_new_graphs = tf.constant(
+        [graph_ind for graph_ind, _ in new_graphs], dtype=tf.int32
+    )
+
+    node_maps = {}
+    new_node_inds = {}
+    graph_of_nodes = {}
+    node_data = {}
+    batch_num_nodes = {}
+    for ntype in triangulations.ntypes:
+        n_nodes = triangulations.num_nodes(ntype)
+        graph_of_node = _get_graph_of_nodes(triangulations, ntype)
+        kept_nodes = tf.cast(
+            tf.where(
+                tf.math.equal(tf.gather(is_removed_graph, graph_of_node), 0)
+            )[:, 0],
+            tf.int32,
+        )
+        graph_of_all_nodes = tf.concat(
+            [
+                tf.gather(graph_of_node, kept_nodes),
+                tf.repeat(
+                    graph_inds_of_new_graphs,
+                    tf.cast(new_batch.batch_num_nodes(ntype), tf.int32),
+                ),
+            ],
+            axis=0,
+        )
+        order = tf.argsort(graph_of_all_nodes, stable=True)
+        new_inds = tf.math.invert_permutation(order)
+
+        n_kept = kept_nodes.shape[0]
+        node_maps[ntype] = tf.tensor_scatter_nd_update(
+            tf.fill([n_nodes], -1),
+            tf.expand_dims(kept_nodes, 1),
+            new_inds[:n_kept],
+        )
+        new_node_inds[ntype] = new_inds[n_kept:]
+
+        graph_of_nodes[ntype] = tf.gather(graph_of_all_nodes, order)
+        batch_num_nodes[ntype] = tf.math.bincount(
+            graph_of_all_nodes, minlength=batch_size, maxlength=batch_size
+        )
+        node_data[ntype] = {
+            key: tf.gather(
+                tf.concat(
+                    [
+                        tf.gather(value, kept_nodes),
+                        new_batch.nodes[ntype].data[key],
+                    ],
+                    axis=0,
+                ),
+                order,
+            )
+            for key, value in triangulations.nodes[ntype].data.items()
+        }
+
+    graph_data = {}
+    batch_num_edges = {}
+    for etype in triangulations.canonical_etypes:
+        src_type, _, dst_type = etype
+        src, dst = triangulations.edges(etype=etype)
+        src = tf.gather(node_maps[src_type], src)
+        dst = tf.gather(node_maps[dst_type], dst)
+        is_kept_edge = tf.math.greater_equal(src, 0)
+        new_src, new_dst = new_batch.edges(etype=etype)
+        src = tf.concat(
+            [
+                boolean_mask(src, is_kept_edge),
+                tf.gather(new_node_inds[src_type], new_src),
+            ],
+            axis=0,
+        )
+        dst = tf.concat(
+            [
+                boolean_mask(dst, is_kept_edge),
+                tf.gather(new_node_inds[dst_type], new_dst),
+            ],
+            axis=0,
+        )
+        graph_of_edge = tf.gather(graph_of_nodes[src_type], src)
+        order = tf.argsort(graph_of_edge, stable=True)
+        graph_data[etype] = (tf.gather(src, order), tf.gather(dst, order))
+        batch_num_edges[etype] = tf.math.bincount(
+            graph_of_edge, minlength=batch_size, maxlength=batch_size
+        )
+
+    graph = _create_batched_graph(
+        triangulations, graph_data, node_data, batch_num_nodes, batch_num_edges
+    )
+    return graph, node_maps, new_node_inds
+
+
+@profiled("environment.glue_segments")
+def _glue_segments(
+    triangulations, segments, other_segments, points, other_points
+):
+    """
+    Glues each boundary segment of other_segments into the corresponding
+    segment of segments and merges each point of other_points into the
+    corresponding point of points. The index arrays of every relation are
+    relabeled and the merged nodes are removed (compacting the node indices,
+    as with dgl.remove_nodes).
+
+    Only the affected node data is refreshed:
+        - The glued segments are now contained in two triangles, so they are
+            no longer boundary segments
+        - The point data are sums over the angles at the point, so the data of
+            a merged point is added to the point it is merged into
+    """
+    points = tf.constant(points, dtype=tf.int32)
+    other_points = tf.constant(other_points, dtype=tf.int32)
+    is_merged = tf.math.not_equal(points, other_points)
+    kept = {
+        "segment": tf.constant(segments, dtype=tf.int32),
+        "point": boolean_mask(points, is_merged),
+    }
+    removed = {
+        "segment": tf.constant(other_segments, dtype=tf.int32),
+        "point": boolean_mask(other_points, is_merged),
+    }
+
+    node_maps = {}
+    is_removed = {}
+    batch_num_nodes = {}
+    for ntype in triangulations.ntypes:
+        n_nodes = triangulations.num_nodes(ntype)
+        batch_num_nodes[ntype] = triangulations.batch_num_nodes(ntype)
+        if ntype not in removed:
+            continue
+        is_removed[ntype] = tf.scatter_nd(
+            tf.expand_dims(removed[ntype], 1),
+            tf.ones_like(removed[ntype]),
+            [n_nodes],
+        )
+        remaining_inds = tf.math.cumsum(1 - is_removed[ntype], exclusive=True)
+        node_maps[ntype] = tf.gather(
+            remaining_inds,
+            tf.tensor_scatter_nd_update(
+                tf.range(n_nodes),
+                tf.expand_dims(removed[ntype], 1),
+                kept[ntype],
+            ),
+        )
+        batch_num_nodes[ntype] = batch_num_nodes[ntype] - tf.cast(
+            _count_per_graph(
+                triangulations,
+                tf.gather(
+                    _get_graph_of_nodes(triangulations, ntype), removed[ntype]
+                ),
+            ),
+            batch_num_nodes[ntype].dtype,
+        )
+
+    graph_data = {}
+    batch_num_edges = {}
+    for etype in triangulations.canonical_etypes:
+        src_type, etype_name, dst_type = etype
+        src, dst = triangulations.edges(etype=etype)
+        batch_num_edges[etype] = triangulations.batch_num_edges(etype)
+        if etype_name == "segment_has_point":
+            # The merged segments share the points of the glued segments
+            is_removed_edge = tf.cast(
+                tf.gather(is_removed["segment"], src), tf.bool
+            )
+            batch_num_edges[etype] = batch_num_edges[etype] - tf.cast(
+                _count_per_graph(
+                    triangulations,
+                    tf.gather(
+                        _get_graph_of_nodes(triangulations, src_type),
+                        boolean_mask(src, is_removed_edge),
+                    ),
+                ),
+                batch_num_edges[etype].dtype,
+            )
+            src = boolean_mask(src, tf.math.logical_not(is_removed_edge))
+            dst = boolean_mask(dst, tf.math.logical_not(is_removed_edge))
+        if src_type in node_maps:
+            src = tf.gather(node_maps[src_type], src)
+        if dst_type in node_maps:
+            dst = tf.gather(node_maps[dst_type], dst)
+        graph_data[etype] = (src, dst)
+
+    node_data = {}
+    for ntype in triangulations.ntypes:
+        node_data[ntype] = {}
+        for key, value in triangulations.nodes[ntype].data.items():
+            if ntype == "point":
+                value = tf.tensor_scatter_nd_add(
+                    value,
+                    tf.expand_dims(kept["point"], 1),
+                    tf.gather(value, removed["point"]),
+                )
+            if ntype == "segment" and key == "boundary":
+                value = tf.tensor_scatter_nd_update(
+                    value,
+                    tf.expand_dims(kept["segment"], 1),
+                    tf.zeros_like(kept["segment"], dtype=value.dtype),
+                )
+            if ntype in is_removed:
+                value = boolean_mask(
+                    value, tf.math.equal(is_removed[ntype], 0)
+                )
+            node_data[ntype][key] = value
+
+    return _create_batched_graph(
+        triangulations, graph_data, node_data, batch_num_nodes, batch_num_edges
+    )
+
+
+def _create_batched_graph(
+    triangulations, graph_data, node_data, batch_num_nodes, batch_num_edges
+):
+    graph = dgl.heterograph(
+        graph_data,
+        num_nodes_dict={
+            ntype: (
+                next(iter(data.values())).shape[0]
+                if data
+                else int(tf.reduce_sum(batch_num_nodes[ntype]))
+            )
+            for ntype, data in node_data.items()
+        },
+        idtype=triangulations.idtype,
+    )
+    for ntype, data in node_data.items():
+        for key, value in data.items():
+            graph.nodes[ntype].data[key] = value
+    graph.set_batch_num_nodes(
+        {
+            ntype: tf.cast(n_nodes, tf.int64)
+            for ntype, n_nodes in batch_num_nodes.items()
+        }
+    )
+    graph.set_batch_num_edges(
+        {
+            etype: tf.cast(n_edges, tf.int64)
+            for etype, n_edges in batch_num_edges.items()
+        }
+    )
+    return graph
+
+
+def _get_graph_of_nodes(triangulations, ntype):
+    """Index of the graph in the batch containing each node"""
+    return tf.repeat(
+        tf.range(triangulations.batch_size),
+        tf.cast(triangulations.batch_num_nodes(ntype), tf.int32),
+    )
+
+
+def _count_per_graph(triangulations, graph_inds):
+    return tf.math.bincount(
+        graph_inds,
+        minlength=triangulations.batch_size,
+        maxlength=triangulations.batch_size,
+    )
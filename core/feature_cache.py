@@ -0,0 +1,93 @@
+import hashlib
+from collections import OrderedDict
+
+
+class FeatureCache:
+    """
+    Bounded LRU cache of the values derived from triangulations, e.g. the
+    features of the policy network, the endpoint pair combinations or the
+    next state of a transition. One cache can be shared by the environment,
+    the policy network and the action masking, every value being stored
+    under its own name.
+
+    Values are keyed by the exact content of the triangulation (see
+    state_key), so equal states built separately share their values. The
+    cached values are returned as is and must not be modified.
+
+    Parameters
+    ----------
+    max_size: int
+        Number of values kept, the least recently used one is evicted first
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get_or_compute(self, triangulation, name, compute_fn, *args):
+        """
+        Cached value of compute_fn(triangulation, *args)
+
+        Parameters
+        ----------
+        triangulation: dgl.DGLHeteroGraph
+        name: str
+            Name of the value, e.g. the name of compute_fn
+        compute_fn: Callable
+        args: Hashable
+            Other arguments of compute_fn, which are part of the key
+        """
+        key = (state_key(triangulation), name, args)
+        if key in self._values:
+            self.hits += 1
+            self._values.move_to_end(key)
+            return self._values[key]
+
+        self.misses += 1
+        value = compute_fn(triangulation, *args)
+        self._values[key] = value
+        if len(self._values) > self.max_size:
+            self._values.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._values.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+def state_key(triangulation):
+    """
+    Digest of the node counts, the edges and the segment types of a (batched)
+    triangulation, which determine all of its data. Unlike the hashes of
+    core.triangulation_hash, it depends on the node labels, as do the
+    features indexed by node
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for ntype in triangulation.ntypes:
+        digest.update(triangulation.batch_num_nodes(ntype).numpy().tobytes())
+    for etype in triangulation.canonical_etypes:
+        digest.update(triangulation.batch_num_edges(etype).numpy().tobytes())
+        for ids in triangulation.edges(etype=etype):
+            digest.update(ids.numpy().tobytes())
+    digest.update(
+        triangulation.nodes["segment"].data["segment_type"].numpy().tobytes()
+    )
+    return digest.digest()
+
+
+def cached(feature_cache, triangulation, compute_fn, *args):
+    """
+    compute_fn(triangulation, *args), cached under the name of compute_fn
+    when a feature cache is given
+    """
+    if feature_cache is None:
+        return compute_fn(triangulation, *args)
+    return feature_cache.get_or_compute(
+        triangulation, compute_fn.__name__, compute_fn, *args
+    )
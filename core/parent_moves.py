@@ -0,0 +1,365 @@
+from typing import Tuple
+
+import dgl
+import numpy as np
+import tensorflow as tf
+
+from core.point_adjacency import get_segment_points
+from core.profiling import profiled
+from core.tensor_utils import boolean_mask
+from core.triangulation_hash import _mix
+
+# Number of light cone crossings around an internal point
+INTERNAL_POINT_N_LIGHT_CROSSINGS = 4.0
+
+
+@profiled("parent_moves")
+def extract_batched_parent_moves(
+    triangulations,
+) -> Tuple[tf.Tensor, tf.Tensor]:
+    """
+    Enumerates the un-gluing moves of every triangulation in a dgl.batch'ed
+    heterograph in one vectorized call, which lead to its parent states. Each
+    move undoes one forward action of extract_endpoint_pair_combinations:
+        - Cutting a segment: an internal segment S = (P0, P1) is cut open into
+            two boundary segments, which undoes gluing them (actions 0 and 1).
+            Its endpoints on the boundary are split back into the two points
+            glued into them:
+                - P0 internal and P1 on the boundary undoes closing P0 by
+                    gluing its two boundary segments
+                - Both on the boundary undoes gluing two segments with four
+                    distinct endpoints. The cut then splits the triangulation
+                    in two when S is its only connection between the two
+                    triangles of S, in which case it is left out
+            Segments between two internal points are not cut, as gluing two
+            segments between the same points is not an action candidate of
+            the trainer.
+        - Removing a triangle: a triangle whose apex r is in no other
+            triangle and whose opposite segment s = (p0, p1) is internal is
+            removed along with r, which leaves s on the boundary. This undoes
+            gluing a new triangle on s (actions 2 to 5).
+
+    Every state reached by a step then has at least one parent move, the
+    one undoing that step.
+
+    Returns
+    -------
+    Tuple:
+        cut_segments: tf.Tensor
+            Tensor of shape (M, 5), where the node indices are those of the
+            batched graph:
+                -> cut_segments[:, 0] is the triangulation in the batch
+                -> cut_segments[:, 1] is the action type being undone
+                -> cut_segments[:, 2] is the segment S being cut open
+                -> cut_segments[:, [3, 4]] are the points (P0, P1), the
+                    internal point first when there is exactly one
+        removed_triangles: tf.Tensor
+            Tensor of shape (M', 5), with the same leading columns:
+                -> removed_triangles[:, 0] is the triangulation in the batch
+                -> removed_triangles[:, 1] is the action type being undone
+                -> removed_triangles[:, 2] is the triangle being removed
+                -> removed_triangles[:, 3] is the segment s left on the
+                    boundary
+                -> removed_triangles[:, 4] is the apex r being removed
+    """
+    segment_points = get_segment_points(triangulations)
+    segment_data = triangulations.nodes["segment"].data
+    is_boundary_segment = tf.cast(segment_data["boundary"], tf.bool)
+    segment_type = tf.cast(segment_data["segment_type"], tf.int64)
+    graph_of_segment = _get_graph_of_nodes(triangulations, "segment")
+
+    cut_segments = _get_cut_segments(
+        triangulations,
+        segment_points,
+        is_boundary_segment,
+        segment_type,
+        graph_of_segment,
+    )
+    removed_triangles = _get_removed_triangles(
+        triangulations,
+        segment_points,
+        is_boundary_segment,
+        segment_type,
+        graph_of_segment,
+    )
+    return cut_segments, removed_triangles
+
+
+def count_parent_moves(triangulations) -> tf.Tensor:
+    """
+    Number of un-gluing moves of each triangulation in a batched graph, see
+    extract_batched_parent_moves
+
+    Returns
+    -------
+    n_parent_moves: tf.Tensor
+        Tensor of shape (batch_size, )
+    """
+    batch_size = triangulations.batch_size
+    graph_of_moves = tf.concat(
+        [
+            moves[:, 0]
+            for moves in extract_batched_parent_moves(triangulations)
+        ],
+        axis=0,
+    )
+    return tf.math.bincount(
+        tf.cast(graph_of_moves, tf.int32),
+        minlength=batch_size,
+        maxlength=batch_size,
+    )
+
+
+def uniform_log_backward_prob(trajectory) -> float:
+    """
+    Sum of the log backward probabilities of a trajectory under the uniform
+    backward policy, P_B(s|s') = 1 / (number of parent moves of s'). The
+    states reached by every step but terminating are batched, so their parent
+    moves are counted in one call. Can be passed as the log_backward_prob_fn
+    of TrajectoryBalanceTrainer.
+
+    Raises
+    ------
+    tf.errors.InvalidArgumentError
+        If a state reached by a step has no parent move, i.e. the step is not
+        undone by any move of extract_batched_parent_moves
+    """
+    next_states = trajectory.states[1:]
+    if not next_states:
+        return 0.0
+    n_parent_moves = count_parent_moves(dgl.batch(next_states))
+    tf.debugging.assert_positive(
+        n_parent_moves, message="A state reached by a step has no parent move"
+    )
+    return -float(
+        tf.reduce_sum(tf.math.log(tf.cast(n_parent_moves, tf.float32)))
+    )
+
+
+def _get_cut_segments(
+    triangulations,
+    segment_points: tf.Tensor,
+    is_boundary_segment: tf.Tensor,
+    segment_type: tf.Tensor,
+    graph_of_segment: tf.Tensor,
+) -> tf.Tensor:
+    """
+    Internal segments with one internal endpoint, which obeys local
+    causality, and one boundary endpoint, or with two boundary endpoints when
+    their cut does not disconnect their triangulation. See
+    extract_batched_parent_moves for the columns.
+    """
+    n_points = triangulations.num_nodes("point")
+    seg_inds, pt_inds = triangulations.edges(etype="segment_has_point")
+    # A point is on the boundary if it is the endpoint of a boundary segment
+    is_boundary_point = tf.math.greater(
+        tf.math.unsorted_segment_max(
+            tf.cast(tf.gather(is_boundary_segment, seg_inds), tf.int32),
+            pt_inds,
+            n_points,
+        ),
+        0,
+    )
+    is_internal_point = tf.math.logical_and(
+        tf.math.logical_not(is_boundary_point),
+        tf.math.equal(
+            tf.cast(
+                triangulations.nodes["point"].data["n_light_cone_angle"],
+                tf.float32,
+            ),
+            INTERNAL_POINT_N_LIGHT_CROSSINGS,
+        ),
+    )
+    is_internal_endpt = tf.gather(is_internal_point, segment_points)
+    is_boundary_endpt = tf.gather(is_boundary_point, segment_points)
+    is_opened = tf.math.logical_xor(
+        is_internal_endpt[:, 0], is_internal_endpt[:, 1]
+    )
+    # Both endpoints are split, which disconnects the triangulation if the
+    # segment is a bridge
+    is_split = tf.math.logical_and(
+        tf.reduce_all(is_boundary_endpt, axis=1),
+        tf.math.logical_not(
+            _get_bridge_segments(triangulations, is_boundary_segment)
+        ),
+    )
+    is_cut = tf.math.logical_and(
+        tf.math.logical_not(is_boundary_segment),
+        tf.math.logical_or(is_opened, is_split),
+    )
+    segments = tf.where(is_cut)[:, 0]
+    endpts = tf.gather(segment_points, segments)
+    # The internal point comes first
+    endpts = tf.where(
+        tf.gather(is_internal_endpt[:, 1:], segments), endpts[:, ::-1], endpts
+    )
+    return tf.concat(
+        [
+            tf.stack(
+                [
+                    tf.gather(graph_of_segment, segments),
+                    tf.gather(segment_type, segments),
+                    segments,
+                ],
+                axis=1,
+            ),
+            endpts,
+        ],
+        axis=1,
+    )
+
+
+def _get_bridge_segments(triangulations, is_boundary_segment) -> tf.Tensor:
+    """
+    Whether each segment is an internal segment whose cut disconnects its
+    triangulation, i.e. a bridge of the graph of the triangles adjacent
+    through internal segments. The bridges of the whole batch are found at
+    once: a spanning forest is grown breadth first from the first triangle of
+    every triangulation, and every internal segment left out of it closes a
+    cycle and XORs a pseudo random 64 bit label into its two triangles. A
+    segment of the forest is a bridge when the labels of the subtree below it
+    cancel out, as no cycle then crosses it. A crossing cycle is missed with
+    a probability of 2 ** -64.
+
+    Returns
+    -------
+    is_bridge: tf.Tensor
+        Boolean tensor of shape (n_segments, )
+    """
+    n_triangles = triangulations.num_nodes("triangle")
+    seg_inds, tri_inds = [
+        inds.numpy()
+        for inds in triangulations.edges(etype="segment_in_triangle")
+    ]
+    # The two triangles of each internal segment
+    is_internal = np.logical_not(is_boundary_segment.numpy()[seg_inds])
+    order = np.argsort(seg_inds[is_internal], kind="stable")
+    internal_segments = seg_inds[is_internal][order][::2]
+    triangle_pairs = tri_inds[is_internal][order].reshape(-1, 2)
+
+    n_triangles_per_graph = triangulations.batch_num_nodes("triangle").numpy()
+    roots = (np.cumsum(n_triangles_per_graph) - n_triangles_per_graph)[
+        n_triangles_per_graph > 0
+    ]
+    # Both directions of every pair
+    triangles = np.concatenate([triangle_pairs[:, 0], triangle_pairs[:, 1]])
+    neighbors = np.concatenate([triangle_pairs[:, 1], triangle_pairs[:, 0]])
+    pairs = np.tile(np.arange(len(triangle_pairs)), 2)
+    depth = np.full(n_triangles, -1)
+    depth[roots] = 0
+    parent = np.full(n_triangles, -1)
+    parent_pair = np.full(n_triangles, -1)
+    n_levels = 0
+    while True:
+        is_next = (depth[triangles] == n_levels) & (depth[neighbors] < 0)
+        if not np.any(is_next):
+            break
+        children, first = np.unique(neighbors[is_next], return_index=True)
+        depth[children] = n_levels + 1
+        parent[children] = triangles[is_next][first]
+        parent_pair[children] = pairs[is_next][first]
+        n_levels += 1
+
+    is_cycle_pair = np.ones(len(triangle_pairs), dtype=bool)
+    is_cycle_pair[parent_pair[depth > 0]] = False
+    cycle_pairs = np.flatnonzero(is_cycle_pair)
+    labels = np.zeros(n_triangles, dtype=np.uint64)
+    for column in range(2):
+        np.bitwise_xor.at(
+            labels,
+            triangle_pairs[cycle_pairs, column],
+            _mix(cycle_pairs.astype(np.uint64)),
+        )
+    # XOR of the labels of each subtree, from the deepest level up
+    for level in range(n_levels, 0, -1):
+        children = np.flatnonzero(depth == level)
+        np.bitwise_xor.at(labels, parent[children], labels[children])
+
+    is_bridge = np.zeros(triangulations.num_nodes("segment"), dtype=bool)
+    children = np.flatnonzero(depth > 0)
+    is_bridge[internal_segments[parent_pair[children]]] = labels[children] == 0
+    return tf.constant(is_bridge)
+
+
+def _get_removed_triangles(
+    triangulations,
+    segment_points: tf.Tensor,
+    is_boundary_segment: tf.Tensor,
+    segment_type: tf.Tensor,
+    graph_of_segment: tf.Tensor,
+) -> tf.Tensor:
+    """
+    Triangles with an apex in no other triangle and an internal opposite
+    segment. See extract_batched_parent_moves for the columns.
+    """
+    n_triangles = triangulations.num_nodes("triangle")
+    angle_inds, pt_inds = triangulations.edges(etype="angle_at_point")
+    tri_of_angle, angle_of_tri = triangulations.edges(
+        etype="triangle_contains_angle"
+    )
+    # Point of each angle, if it is the only angle at its point
+    n_angles_per_pt = triangulations.in_degrees(etype="angle_at_point")
+    apex_of_angle = tf.math.unsorted_segment_max(
+        tf.where(
+            tf.math.equal(tf.gather(n_angles_per_pt, pt_inds), 1),
+            tf.cast(pt_inds, tf.int64),
+            -1,
+        ),
+        angle_inds,
+        triangulations.num_nodes("angle"),
+    )
+    apex_of_tri = tf.math.unsorted_segment_max(
+        tf.gather(apex_of_angle, angle_of_tri), tri_of_angle, n_triangles
+    )
+
+    seg_inds, tri_inds = triangulations.edges(etype="segment_in_triangle")
+    # stt triangles have one space-like segment, tss triangles two
+    is_stt_triangle = tf.math.equal(
+        tf.math.unsorted_segment_sum(
+            tf.gather(segment_type, seg_inds), tri_inds, n_triangles
+        ),
+        1,
+    )
+    apex = tf.gather(apex_of_tri, tri_inds)
+    is_removed = tf.math.logical_and(
+        tf.math.greater_equal(apex, 0),
+        tf.math.logical_not(tf.gather(is_boundary_segment, seg_inds)),
+    )
+    # The segment opposite to the apex
+    is_removed = tf.math.logical_and(
+        is_removed,
+        tf.reduce_all(
+            tf.math.not_equal(
+                tf.gather(segment_points, seg_inds), tf.expand_dims(apex, 1)
+            ),
+            axis=1,
+        ),
+    )
+    segments = tf.cast(boolean_mask(seg_inds, is_removed), tf.int64)
+    triangles = tf.cast(boolean_mask(tri_inds, is_removed), tf.int64)
+    # 2, 3 -> tss triangle glued on a time-like / space-like segment
+    # 4, 5 -> stt triangle glued on a time-like / space-like segment
+    action_types = (
+        2
+        + 2 * tf.cast(tf.gather(is_stt_triangle, triangles), tf.int64)
+        + tf.gather(segment_type, segments)
+    )
+    return tf.stack(
+        [
+            tf.gather(graph_of_segment, segments),
+            action_types,
+            triangles,
+            segments,
+            boolean_mask(apex, is_removed),
+        ],
+        axis=1,
+    )
+
+
+def _get_graph_of_nodes(triangulations, ntype: str) -> tf.Tensor:
+    """Index of the graph in the batch containing each node"""
+    batch_num_nodes = tf.cast(triangulations.batch_num_nodes(ntype), tf.int64)
+    return tf.repeat(
+        tf.range(tf.shape(batch_num_nodes, out_type=tf.int64)[0]),
+        batch_num_nodes,
+    )
@@ -0,0 +1,171 @@
+from typing import Optional, Tuple
+
+import tensorflow as tf
+
+from core.tensor_utils import boolean_mask
+
+
+def get_segment_points(triangulation) -> tf.Tensor:
+    """
+    Endpoints of every segment of a (batched) triangulation, taken directly
+    from the edges of the segment_has_point relation
+
+    Returns
+    -------
+    segment_points: tf.Tensor
+        Tensor of shape (n_segments, 2) of the smaller and the larger point
+        index of each segment
+    """
+    seg_inds, pt_inds = triangulation.edges(etype="segment_has_point")
+    return _pair_segment_points(
+        seg_inds, pt_inds, triangulation.num_nodes("segment")
+    )
+
+
+def get_point_neighbors(
+    triangulation, segment_type: Optional[int] = None
+) -> tf.RaggedTensor:
+    """
+    Neighbours of every point of a (batched) triangulation in CSR form: the
+    row splits of the ragged tensor index, for each point, the neighbours
+    connected to it by a segment. A neighbour appears once per segment, so
+    points connected by parallel segments are listed twice.
+
+    Parameters
+    ----------
+    triangulation: dgl.DGLHeteroGraph
+    segment_type: int
+        If given, only the boundary segments of that type are considered
+        (the valid segments of extract_endpoint_pair_combinations)
+
+    Returns
+    -------
+    point_neighbors: tf.RaggedTensor
+        Ragged tensor of shape (n_points, None) of point indices
+    """
+    segment_points = get_segment_points(triangulation)
+    segment_weights = tf.ones(tf.shape(segment_points)[0])
+    if segment_type is not None:
+        segment_data = triangulation.nodes["segment"].data
+        segment_weights = tf.cast(
+            tf.math.equal(segment_data["segment_type"], segment_type),
+            tf.float32,
+        ) * tf.reshape(tf.cast(segment_data["boundary"], tf.float32), [-1])
+    points, neighbors, _ = construct_point_neighbor_edges(
+        segment_points, segment_weights
+    )
+    # Ordering the edges by point, and by neighbour within a point
+    n_points = tf.cast(triangulation.num_nodes("point"), tf.int64)
+    order = tf.argsort(points * n_points + neighbors)
+    return tf.RaggedTensor.from_value_rowids(
+        tf.gather(neighbors, order),
+        tf.gather(points, order),
+        nrows=n_points,
+    )
+
+
+def construct_point_neighbor_edges(
+    segment_points: tf.Tensor, segment_weights: tf.Tensor
+) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+    """
+    Edge list of the points connected by a segment with a nonzero weight, in
+    both directions
+
+    Parameters
+    ----------
+    segment_points: tf.Tensor
+        Tensor of shape (n_segments, 2) of the endpoints of each segment
+    segment_weights: tf.Tensor
+        Tensor of shape (n_segments, ) of the weight of each segment
+
+    Returns
+    -------
+    Tuple:
+        points: tf.Tensor
+            Tensor of shape (n_edges, ) of the first point of each edge
+        neighbors: tf.Tensor
+            Tensor of shape (n_edges, ) of the second point of each edge
+        weights: tf.Tensor
+            Tensor of shape (n_edges, ) of the weight of the segment of each
+            edge
+    """
+    is_connected = tf.math.not_equal(segment_weights, 0)
+    segment_points = boolean_mask(segment_points, is_connected)
+    segment_weights = boolean_mask(segment_weights, is_connected)
+    return (
+        tf.concat([segment_points[:, 0], segment_points[:, 1]], axis=0),
+        tf.concat([segment_points[:, 1], segment_points[:, 0]], axis=0),
+        tf.concat([segment_weights, segment_weights], axis=0),
+    )
+
+
+def construct_point_adjacency(
+    segment_points: tf.Tensor, segment_weights: tf.Tensor, n_points: int
+) -> tf.Tensor:
+    """
+    Dense adjacency matrices of the points connected by segments, scattered
+    from the endpoints of the segments in O(n_segments + n_points ** 2)
+    rather than multiplying the (n_segments, n_points) incidence matrices.
+    Entry (p, p') sums the weights of the segments between p and p'. The
+    diagonal is zero, so segments whose endpoints are the same point (e.g.
+    padding) are ignored.
+
+    Parameters
+    ----------
+    segment_points: tf.Tensor
+        Tensor of shape (n_segments, 2) of the endpoints of each segment
+    segment_weights: tf.Tensor
+        Tensor of shape (..., n_segments) of the weight of each segment, one
+        adjacency matrix being built per leading index, e.g. per segment type
+    n_points: int
+
+    Returns
+    -------
+    point_adjacency: tf.Tensor
+        Tensor of shape (..., n_points, n_points)
+    """
+    segment_points = tf.cast(segment_points, tf.int64)
+    leading_shape = segment_weights.shape[:-1]
+    n_matrices = leading_shape.num_elements()
+    segment_weights = tf.reshape(segment_weights, [n_matrices, -1])
+
+    # (matrix, point, neighbor) of the two directions of every segment
+    edges = tf.concat([segment_points, segment_points[:, ::-1]], axis=0)
+    indices = tf.concat(
+        [
+            tf.repeat(
+                tf.range(n_matrices, dtype=tf.int64), tf.shape(edges)[0]
+            )[:, None],
+            tf.tile(edges, [n_matrices, 1]),
+        ],
+        axis=1,
+    )
+    point_adjacency = tf.scatter_nd(
+        indices,
+        tf.reshape(tf.tile(segment_weights, [1, 2]), [-1]),
+        [n_matrices, n_points, n_points],
+    )
+    point_adjacency = tf.linalg.set_diag(
+        point_adjacency, tf.zeros([n_matrices, n_points])
+    )
+    return tf.reshape(
+        point_adjacency, leading_shape.as_list() + [n_points, n_points]
+    )
+
+
+def _pair_segment_points(
+    seg_inds: tf.Tensor, pt_inds: tf.Tensor, n_segments
+) -> tf.Tensor:
+    """
+    Endpoints of each segment from the (segment, point) incidence edges, which
+    list every segment twice
+    """
+    seg_inds = tf.cast(seg_inds, tf.int64)
+    pt_inds = tf.cast(pt_inds, tf.int64)
+    return tf.stack(
+        [
+            tf.math.unsorted_segment_min(pt_inds, seg_inds, n_segments),
+            tf.math.unsorted_segment_max(pt_inds, seg_inds, n_segments),
+        ],
+        axis=1,
+    )
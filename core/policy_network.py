@@ -1,9 +1,19 @@
-import dgl
+from functools import lru_cache
+
 from dgl.nn.tensorflow import HeteroGraphConv
 from dgl.nn.tensorflow.conv import SAGEConv
 
 import tensorflow as tf
 
+from core.feature_cache import cached
+from core.profiling import profiled, stage
+
+# Node type of the output of the local layers
+LOCAL_OUTPUT_NTYPE = "point"
+
+# Number of angle types, one-hot encoded in the angle features
+N_ANGLE_TYPES = 4
+
 
 class HeteroGraphPolicyNetwork(tf.keras.Model):
     def __init__(
@@ -16,8 +26,11 @@ class HeteroGraphPolicyNetwork(tf.keras.Model):
         n_local_hidden_nodes_2=8,
         n_global_hidden_nodes_1=32,
         n_global_hidden_nodes_2=16,
+        feature_cache=None,
     ):
         super().__init__()
+        # Optional FeatureCache of the features prepared by call
+        self.feature_cache = feature_cache
 
         self._initalize_local_layers(
             n_tri_feats=n_tri_feats,
@@ -31,12 +44,82 @@ class HeteroGraphPolicyNetwork(tf.keras.Model):
             n_global_hidden_nodes_1=n_global_hidden_nodes_1,
             n_global_hidden_nodes_2=n_global_hidden_nodes_2,
         )
+        self._compiled_fused_call = tf.function(
+            self._fused_call, reduce_retracing=True
+        )
 
     def call(self, triangulation):
-        local_features = _prepare_local_features(triangulation)
-        global_features = _prepare_global_features(triangulation)
+        local_features = stage(
+            "policy_network.local_features",
+            cached,
+            self.feature_cache,
+            triangulation,
+            _prepare_local_features,
+        )
+        global_features = stage(
+            "policy_network.global_features",
+            cached,
+            self.feature_cache,
+            triangulation,
+            _prepare_global_features,
+        )
 
-        point_logits = self._call_local_layers(triangulation, local_features)
+        point_logits = stage(
+            "policy_network.local_layers",
+            self._call_local_layers,
+            triangulation,
+            local_features,
+        )
+        triangulation_logits = stage(
+            "policy_network.global_layers",
+            self._call_global_layers,
+            global_features,
+        )
+        return point_logits, triangulation_logits
+
+    def fused_call(self, fused_inputs):
+        """
+        Inference path of call. The feature preparation, the local layers and
+        the global layers run as one compiled graph on the tensors gathered by
+        prepare_fused_inputs. The message passing of each relation is a gather
+        followed by a segment mean, and only the relations from which
+        LOCAL_OUTPUT_NTYPE can be reached are computed.
+
+        Parameters
+        ----------
+        fused_inputs: Dict[str, Dict]
+            The inputs of a (batched) triangulation, see prepare_fused_inputs
+
+        Returns
+        -------
+        Tuple:
+            point_logits: tf.Tensor
+                Tensor of shape (n_points, 1)
+            triangulation_logits: tf.Tensor
+                Tensor of shape (batch_size, 7)
+        """
+        return stage(
+            "policy_network.fused_call",
+            self._compiled_fused_call,
+            fused_inputs,
+        )
+
+    def _fused_call(self, fused_inputs):
+        node_data = fused_inputs["node_data"]
+        batch_num_nodes = fused_inputs["batch_num_nodes"]
+        local_features = _compute_local_features(node_data)
+        global_features = _compute_global_features(node_data, batch_num_nodes)
+
+        hidden = local_features
+        local_layers = self._get_local_layers()
+        required_relations = self._get_required_relations(
+            tuple(fused_inputs["edges"].keys())
+        )
+        for layer, relations in zip(local_layers, required_relations):
+            hidden = _call_fused_hetero_graph_conv(
+                layer, relations, fused_inputs["edges"], hidden
+            )
+        point_logits = hidden[LOCAL_OUTPUT_NTYPE]
         triangulation_logits = self._call_global_layers(global_features)
         return point_logits, triangulation_logits
 
@@ -114,12 +197,28 @@ class HeteroGraphPolicyNetwork(tf.keras.Model):
         )
 
     def _call_local_layers(self, graph, node_features):
-        hidden = self.local_layer_1(graph, node_features)
-        hidden = self.local_layer_2(graph, hidden)
-        hidden = self.local_layer_3(graph, hidden)
-        point_logits = hidden["point"]
+        hidden = node_features
+        required_relations = self._get_required_relations(
+            tuple(graph.canonical_etypes)
+        )
+        for layer, relations in zip(
+            self._get_local_layers(), required_relations
+        ):
+            hidden = _call_hetero_graph_conv(layer, relations, graph, hidden)
+        point_logits = hidden[LOCAL_OUTPUT_NTYPE]
         return point_logits
 
+    def _get_local_layers(self):
+        return [self.local_layer_1, self.local_layer_2, self.local_layer_3]
+
+    def _get_required_relations(self, canonical_etypes):
+        return _get_required_relations(
+            tuple(
+                tuple(layer.mods.keys()) for layer in self._get_local_layers()
+            ),
+            canonical_etypes,
+        )
+
     def _initialize_global_layers(
         self,
         n_global_hidden_nodes_1=32,
@@ -140,33 +239,183 @@ class HeteroGraphPolicyNetwork(tf.keras.Model):
         return graph_logits
 
 
+@profiled("policy_network.prepare_fused_inputs")
+def prepare_fused_inputs(triangulation):
+    """
+    Gathers, once per state, the tensors needed by
+    HeteroGraphPolicyNetwork.fused_call: the raw node data, the number of
+    nodes of each type per triangulation and the edges of each relation
+
+    Parameters
+    ----------
+    triangulation: dgl.DGLHeteroGraph
+        A (batched) triangulation
+
+    Returns
+    -------
+    fused_inputs: Dict[str, Dict]
+        -> fused_inputs["node_data"][ntype][key]: node data
+        -> fused_inputs["batch_num_nodes"][ntype]: tensor of shape
+            (batch_size, )
+        -> fused_inputs["edges"][(src_type, etype, dst_type)]: tuple of the
+            source and destination node indices
+    """
+    return {
+        "node_data": {
+            ntype: dict(triangulation.nodes[ntype].data)
+            for ntype in triangulation.ntypes
+        },
+        "batch_num_nodes": {
+            ntype: triangulation.batch_num_nodes(ntype)
+            for ntype in triangulation.ntypes
+        },
+        "edges": {
+            etype: triangulation.edges(etype=etype)
+            for etype in triangulation.canonical_etypes
+        },
+    }
+
+
+@lru_cache(maxsize=None)
+def _get_required_relations(layer_relations, canonical_etypes):
+    """
+    Dependency closure of the local layers. Going forward, a relation of a
+    layer can only be computed if the previous layer outputs both its source
+    type and its destination type (used by the self connection of SAGEConv),
+    as in HeteroGraphConv. Going backwards from LOCAL_OUTPUT_NTYPE, a relation
+    is only required if its destination type is needed by the next layer, and
+    its source and destination types are then needed from the previous layer.
+
+    Parameters
+    ----------
+    layer_relations: Tuple[Tuple[str, ...], ...]
+        The relation names of each layer
+    canonical_etypes: Tuple[Tuple[str, str, str], ...]
+        The (src_type, etype, dst_type) of the relations of the triangulation
+
+    Returns
+    -------
+    required_relations: Tuple[Tuple[Tuple[str, str, str], ...], ...]
+        The canonical relations to compute in each layer
+    """
+    available_ntypes = {
+        ntype
+        for src_type, _, dst_type in canonical_etypes
+        for ntype in (src_type, dst_type)
+    }
+    computable_relations = []
+    for relations in layer_relations:
+        layer_computable_relations = [
+            (src_type, etype, dst_type)
+            for src_type, etype, dst_type in canonical_etypes
+            if etype in relations
+            and src_type in available_ntypes
+            and dst_type in available_ntypes
+        ]
+        available_ntypes = {
+            dst_type for _, _, dst_type in layer_computable_relations
+        }
+        computable_relations.append(layer_computable_relations)
+
+    required_ntypes = {LOCAL_OUTPUT_NTYPE}
+    required_relations = []
+    for relations in reversed(computable_relations):
+        layer_required_relations = tuple(
+            relation
+            for relation in relations
+            if relation[2] in required_ntypes
+        )
+        required_ntypes = {
+            ntype
+            for src_type, _, dst_type in layer_required_relations
+            for ntype in (src_type, dst_type)
+        }
+        required_relations.append(layer_required_relations)
+    return tuple(required_relations[::-1])
+
+
+@profiled("policy_network.hetero_graph_conv")
+def _call_hetero_graph_conv(layer, relations, graph, node_features):
+    """
+    HeteroGraphConv restricted to the given relations, the relations that
+    cannot reach LOCAL_OUTPUT_NTYPE are skipped
+    """
+    outputs = {}
+    for src_type, etype, dst_type in relations:
+        rst = layer.mods[etype](
+            graph[src_type, etype, dst_type],
+            (node_features[src_type], node_features[dst_type]),
+        )
+        outputs.setdefault(dst_type, []).append(rst)
+    return {
+        ntype: layer.agg_fn(alist, ntype) for ntype, alist in outputs.items()
+    }
+
+
+def _call_fused_hetero_graph_conv(layer, relations, edges, node_features):
+    """
+    Pure tensorflow version of HeteroGraphConv with mean SAGEConv modules,
+    restricted to the given relations
+    """
+    outputs = {}
+    for src_type, etype, dst_type in relations:
+        src, dst = edges[(src_type, etype, dst_type)]
+        conv = layer.mods[etype]
+        feat_dst = node_features[dst_type]
+        h_neigh = tf.math.unsorted_segment_mean(
+            tf.gather(node_features[src_type], src),
+            dst,
+            tf.shape(feat_dst)[0],
+        )
+        rst = conv.fc_self(feat_dst) + conv.fc_neigh(h_neigh)
+        if conv.activation is not None:
+            rst = conv.activation(rst)
+        outputs.setdefault(dst_type, []).append(rst)
+    return {
+        ntype: layer.agg_fn(alist, ntype) for ntype, alist in outputs.items()
+    }
+
+
 def _prepare_local_features(triangulation):
+    return _compute_local_features(
+        {
+            ntype: triangulation.nodes[ntype].data
+            for ntype in triangulation.ntypes
+        }
+    )
+
+
+def _compute_local_features(node_data, dtype=tf.float32):
+    """
+    Node features of the local layers in the given dtype. The node data can
+    also be stored in integer dtypes (see compact_node_data), with the angle
+    types as codes instead of one-hot encodings, in which case it is only
+    converted here.
+    """
     tri_feats = tf.expand_dims(
-        triangulation.nodes["triangle"].data["triangle_type"], 1
+        tf.cast(node_data["triangle"]["triangle_type"], dtype), 1
     )
-    seg_feats = tf.concat(
+    seg_feats = tf.stack(
         [
-            tf.expand_dims(triangulation.nodes["segment"].data["boundary"], 1),
-            tf.expand_dims(
-                triangulation.nodes["segment"].data["segment_type"], 1
-            ),
+            tf.cast(node_data["segment"]["boundary"], dtype),
+            tf.cast(node_data["segment"]["segment_type"], dtype),
         ],
         axis=1,
     )
     angle_feats = tf.concat(
         [
-            triangulation.nodes["angle"].data["angle_type"],
+            _encode_angle_types(node_data["angle"]["angle_type"], dtype),
             tf.expand_dims(
-                triangulation.nodes["angle"].data["light_cone_angle"], 1
+                tf.cast(node_data["angle"]["light_cone_angle"], dtype), 1
             ),
         ],
         axis=1,
     )
     pt_feats = tf.concat(
         [
-            triangulation.nodes["point"].data["n_angle_types"],
+            tf.cast(node_data["point"]["n_angle_types"], dtype),
             tf.expand_dims(
-                triangulation.nodes["point"].data["n_light_cone_angle"], 1
+                tf.cast(node_data["point"]["n_light_cone_angle"], dtype), 1
             ),
         ],
         axis=1,
@@ -182,9 +431,22 @@ def _prepare_local_features(triangulation):
 
 
 def _prepare_global_features(triangulation):
-    n_triangles = triangulation.batch_num_nodes("triangle")
-    n_segments = triangulation.batch_num_nodes("segment")
-    n_points = triangulation.batch_num_nodes("point")
+    return _compute_global_features(
+        {
+            ntype: triangulation.nodes[ntype].data
+            for ntype in triangulation.ntypes
+        },
+        {
+            ntype: triangulation.batch_num_nodes(ntype)
+            for ntype in triangulation.ntypes
+        },
+    )
+
+
+def _compute_global_features(node_data, batch_num_nodes):
+    n_triangles = batch_num_nodes["triangle"]
+    n_segments = batch_num_nodes["segment"]
+    n_points = batch_num_nodes["point"]
 
     # --------------------------------------------------------------------------
     log_n_tri = tf.math.log(
@@ -199,19 +461,17 @@ def _prepare_global_features(triangulation):
     # --------------------------------------------------------------------------
     frac_triangle_types = _mean_node_readout(
         n_triangles,
-        _encode_types_for_node(
-            triangulation.nodes["triangle"].data["triangle_type"]
-        ),
+        _encode_types_for_node(node_data["triangle"]["triangle_type"]),
     )
 
     # --------------------------------------------------------------------------
     encoded_segment_types = _encode_types_for_node(
-        triangulation.nodes["segment"].data["segment_type"]
+        node_data["segment"]["segment_type"]
     )
     frac_segment_types = _mean_node_readout(n_segments, encoded_segment_types)
 
     boundary_segments = tf.expand_dims(
-        triangulation.nodes["segment"].data["boundary"], 1
+        tf.cast(node_data["segment"]["boundary"], tf.float32), 1
     )
     frac_boundary_segments = _mean_node_readout(n_segments, boundary_segments)
 
@@ -222,12 +482,12 @@ def _prepare_global_features(triangulation):
     mean_complete_light_cones = _mean_node_readout(
         n_points,
         tf.expand_dims(
-            triangulation.nodes["point"].data["n_light_cone_angle"], 1
+            tf.cast(node_data["point"]["n_light_cone_angle"], tf.float32), 1
         )
         / 4,
     )
     mean_angle_types = _mean_node_readout(
-        n_points, triangulation.nodes["point"].data["n_angle_types"]
+        n_points, tf.cast(node_data["point"]["n_angle_types"], tf.float32)
     )
 
     global_features = tf.concat(
@@ -247,11 +507,22 @@ def _prepare_global_features(triangulation):
     return global_features
 
 
+def _encode_angle_types(angle_types, dtype):
+    """One-hot encoding of the angle types, unless they already are"""
+    if angle_types.shape.rank == 1:
+        return tf.one_hot(
+            tf.cast(angle_types, tf.int32), N_ANGLE_TYPES, dtype=dtype
+        )
+    return tf.cast(angle_types, dtype)
+
+
 def _encode_types_for_node(types_for_node):
     encoded_types = tf.one_hot(tf.cast(types_for_node, dtype=tf.int32), 2)
     return encoded_types
 
 
 def _mean_node_readout(n_nodes, data):
-    readout = dgl.ops.segment.segment_reduce(n_nodes, data, reducer="mean")
+    batch_size = tf.shape(n_nodes)[0]
+    graph_of_nodes = tf.repeat(tf.range(batch_size), n_nodes)
+    readout = tf.math.unsorted_segment_mean(data, graph_of_nodes, batch_size)
     return readout
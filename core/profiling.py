@@ -0,0 +1,228 @@
+import functools
+import json
+import os
+import threading
+from time import perf_counter
+
+import dgl
+import numpy as np
+import tensorflow as tf
+
+# Number of events kept for the Chrome trace, the aggregates of the stages
+# keep counting after that
+MAX_EVENTS = 1_000_000
+
+_active_profiler = None
+
+
+class Profiler:
+    """
+    Opt-in instrumentation of the hot paths. The endpoint pair extractors,
+    the policy network, the environment transitions and the sampling of
+    actions are split into named stages, whose wall time, number of calls and
+    output sizes are recorded while a profiler is active:
+        with Profiler() as profiler:
+            trainer.train(n_iterations=10, batch_size=16)
+        print(profiler.table())
+        profiler.save_chrome_trace("trace.json")
+
+    When no profiler is active, an instrumented function only costs the
+    lookup of the active profiler. Stages are only recorded when executing
+    eagerly, as tracing a tf.function says nothing of the time to run it.
+    Stages can be nested, the self time of a stage excludes the time of its
+    inner stages.
+
+    Parameters
+    ----------
+    max_events: int
+        Number of events kept for the Chrome trace
+    """
+
+    def __init__(self, max_events=MAX_EVENTS):
+        self.max_events = max_events
+        self.stats = {}
+        self.events = []
+        self._origin = perf_counter()
+        self._local = threading.local()
+        self._previous_profilers = []
+
+    def __enter__(self):
+        global _active_profiler
+        self._previous_profilers.append(_active_profiler)
+        _active_profiler = self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _active_profiler
+        _active_profiler = self._previous_profilers.pop()
+
+    def run(self, name, fn, args, kwargs):
+        """Runs fn(*args, **kwargs) as the stage name"""
+        if not tf.executing_eagerly():
+            return fn(*args, **kwargs)
+        stack = self._get_stack()
+        stack.append(0.0)
+        start = perf_counter()
+        try:
+            value = fn(*args, **kwargs)
+        finally:
+            duration = perf_counter() - start
+            child_duration = stack.pop()
+            if stack:
+                stack[-1] += duration
+        self._record(
+            name, start, duration, duration - child_duration, _nbytes(value)
+        )
+        return value
+
+    def summary(self):
+        """
+        Aggregates of every stage, by decreasing total time
+
+        Returns
+        -------
+        rows: List[Dict]
+            -> "stage", "calls"
+            -> "total_seconds", "self_seconds", "mean_seconds",
+                "max_seconds"
+            -> "mean_output_bytes": mean size of the tensors returned
+        """
+        rows = [
+            {
+                "stage": name,
+                "calls": stats.calls,
+                "total_seconds": stats.total_seconds,
+                "self_seconds": stats.self_seconds,
+                "mean_seconds": stats.total_seconds / stats.calls,
+                "max_seconds": stats.max_seconds,
+                "mean_output_bytes": stats.output_bytes / stats.calls,
+            }
+            for name, stats in self.stats.items()
+        ]
+        return sorted(rows, key=lambda row: -row["total_seconds"])
+
+    def table(self):
+        """The summary as a fixed width text table"""
+        lines = [
+            f"{'stage':<48} {'calls':>8} {'total ms':>11} {'self ms':>11} "
+            f"{'mean ms':>9} {'max ms':>9} {'out KiB':>9}"
+        ]
+        for row in self.summary():
+            lines.append(
+                f"{row['stage']:<48} {row['calls']:>8} "
+                f"{1e3 * row['total_seconds']:>11.3f} "
+                f"{1e3 * row['self_seconds']:>11.3f} "
+                f"{1e3 * row['mean_seconds']:>9.3f} "
+                f"{1e3 * row['max_seconds']:>9.3f} "
+                f"{row['mean_output_bytes'] / 2**10:>9.1f}"
+            )
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        """
+        The recorded events in the Chrome trace event format, which can be
+        opened in chrome://tracing or https://ui.perfetto.dev
+        """
+        return {
+            "traceEvents": [
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": 1e6 * start,
+                    "dur": 1e6 * duration,
+                    "pid": os.getpid(),
+                    "tid": thread_id,
+                    "args": {"output_bytes": output_bytes},
+                }
+                for name, start, duration, thread_id, output_bytes in (
+                    self.events
+                )
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def save_chrome_trace(self, path):
+        with open(path, "w") as file:
+            json.dump(self.chrome_trace(), file)
+
+    def _get_stack(self):
+        # Durations of the inner stages of the running stages of the thread
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _record(self, name, start, duration, self_duration, output_bytes):
+        if name not in self.stats:
+            self.stats[name] = _StageStats()
+        self.stats[name].add(duration, self_duration, output_bytes)
+        if len(self.events) < self.max_events:
+            self.events.append(
+                (
+                    name,
+                    start - self._origin,
+                    duration,
+                    threading.get_ident(),
+                    output_bytes,
+                )
+            )
+
+
+def profiled(name):
+    """
+    Decorator recording every call of a function as the stage name while a
+    Profiler is active
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profiler = _active_profiler
+            if profiler is None:
+                return fn(*args, **kwargs)
+            return profiler.run(name, fn, args, kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def stage(name, fn, *args, **kwargs):
+    """
+    fn(*args, **kwargs), recorded as the stage name while a Profiler is
+    active, for the stages that are not functions of their own
+    """
+    profiler = _active_profiler
+    if profiler is None:
+        return fn(*args, **kwargs)
+    return profiler.run(name, fn, args, kwargs)
+
+
+class _StageStats:
+    def __init__(self):
+        self.calls = 0
+        self.total_seconds = 0.0
+        self.self_seconds = 0.0
+        self.max_seconds = 0.0
+        self.output_bytes = 0
+
+    def add(self, duration, self_duration, output_bytes):
+        self.calls += 1
+        self.total_seconds += duration
+        self.self_seconds += self_duration
+        self.max_seconds = max(self.max_seconds, duration)
+        self.output_bytes += output_bytes
+
+
+def _nbytes(value):
+    """Size of the tensors, arrays and graphs in a nested structure"""
+    n_bytes = 0
+    for item in tf.nest.flatten(value):
+        if isinstance(item, (tf.Tensor, tf.Variable)):
+            n_bytes += item.shape.num_elements() * item.dtype.size
+        elif isinstance(item, np.ndarray):
+            n_bytes += item.nbytes
+        elif isinstance(item, dgl.DGLGraph):
+            n_bytes += 2 * item.num_edges() * item.idtype.size
+            for ntype in item.ntypes:
+                n_bytes += _nbytes(dict(item.nodes[ntype].data))
+    return n_bytes
@@ -0,0 +1,309 @@
+from typing import Dict
+
+import tensorflow as tf
+
+from core.environment import compact_node_data
+from core.policy_network import (
+    LOCAL_OUTPUT_NTYPE,
+    _call_fused_hetero_graph_conv,
+    _compute_global_features,
+    _compute_local_features,
+    _get_required_relations,
+    prepare_fused_inputs,
+)
+from core.profiling import _nbytes, stage
+
+# Dtypes the weights can be stored in for inference
+WEIGHT_DTYPES = ("bfloat16", "int8")
+
+# Largest magnitude of the int8 weights, the int8 range is used symmetrically
+INT8_MAX = 127
+
+
+class QuantizedPolicyNetwork:
+    """
+    Inference-only copy of a HeteroGraphPolicyNetwork with its weights stored
+    in bfloat16 or int8, for sampling on CPU. It is called like
+    HeteroGraphPolicyNetwork.fused_call, with the same compiled message
+    passing, and returns float32 logits. The node data is best given in
+    compact integer storage (see prepare_quantized_inputs), which is only
+    converted to features in the first layer.
+
+    The weights are copied when the network is created. They are stored in
+    variables, so that later updates of the policy network are copied with
+    requantize without retracing the compiled call. See logit_drift_report
+    for how far the logits are from the float32 ones.
+
+    Parameters
+    ----------
+    policy_network: HeteroGraphPolicyNetwork
+        Network whose weights are copied, which must have been called once
+    weight_dtype: str
+        -> "bfloat16": weights and activations are bfloat16
+        -> "int8": weights are int8 with a float32 scale per output unit,
+            activations are float32
+    """
+
+    def __init__(self, policy_network, weight_dtype="int8"):
+        if weight_dtype not in WEIGHT_DTYPES:
+            raise ValueError(
+                f"Unknown weight dtype {weight_dtype}, expected one of "
+                f"{WEIGHT_DTYPES}"
+            )
+        if not all(layer.built for layer in _get_dense_layers(policy_network)):
+            raise ValueError(
+                "The policy network has to be called before being quantized"
+            )
+        self.weight_dtype = weight_dtype
+        self.compute_dtype = (
+            tf.bfloat16 if weight_dtype == "bfloat16" else tf.float32
+        )
+        self.local_layers = [
+            _QuantizedHeteroGraphConv(layer, weight_dtype)
+            for layer in policy_network._get_local_layers()
+        ]
+        self.global_layers = [
+            _QuantizedDense(layer, weight_dtype)
+            for layer in (
+                policy_network.g_layer_1,
+                policy_network.g_layer_2,
+                policy_network.g_layer_3,
+            )
+        ]
+        self._compiled_fused_call = tf.function(
+            self._fused_call, reduce_retracing=True
+        )
+
+    def requantize(self, policy_network):
+        """
+        Copies the current weights of the policy network the quantized
+        network was created from, e.g. after a training update, keeping the
+        traces of the compiled call
+
+        Parameters
+        ----------
+        policy_network: HeteroGraphPolicyNetwork
+        """
+        for dense, layer in zip(
+            self._get_dense_layers(), _get_dense_layers(policy_network)
+        ):
+            dense.assign(layer)
+
+    def _get_dense_layers(self):
+        return [
+            dense
+            for layer in self.local_layers
+            for conv in layer.mods.values()
+            for dense in (conv.fc_self, conv.fc_neigh)
+        ] + self.global_layers
+
+    @property
+    def nbytes(self):
+        """Size of the stored weights"""
+        return sum(
+            _nbytes([dense.kernel, dense.scale, dense.bias])
+            for dense in self._get_dense_layers()
+        )
+
+    def fused_call(self, fused_inputs):
+        """
+        Parameters
+        ----------
+        fused_inputs: Dict[str, Dict]
+            The inputs of a (batched) triangulation, see prepare_fused_inputs
+            and prepare_quantized_inputs
+
+        Returns
+        -------
+        Tuple:
+            point_logits: tf.Tensor
+                Tensor of shape (n_points, 1)
+            triangulation_logits: tf.Tensor
+                Tensor of shape (batch_size, 7)
+        """
+        return stage(
+            "quantized_policy_network.fused_call",
+            self._compiled_fused_call,
+            fused_inputs,
+        )
+
+    def _fused_call(self, fused_inputs):
+        node_data = fused_inputs["node_data"]
+        hidden = _compute_local_features(node_data, self.compute_dtype)
+        required_relations = _get_required_relations(
+            tuple(tuple(layer.mods.keys()) for layer in self.local_layers),
+            tuple(fused_inputs["edges"].keys()),
+        )
+        for layer, relations in zip(self.local_layers, required_relations):
+            hidden = _call_fused_hetero_graph_conv(
+                layer, relations, fused_inputs["edges"], hidden
+            )
+        point_logits = tf.cast(hidden[LOCAL_OUTPUT_NTYPE], tf.float32)
+
+        hidden = tf.cast(
+            _compute_global_features(
+                node_data, fused_inputs["batch_num_nodes"]
+            ),
+            self.compute_dtype,
+        )
+        for layer in self.global_layers:
+            hidden = layer(hidden)
+        triangulation_logits = tf.cast(hidden, tf.float32)
+        return point_logits, triangulation_logits
+
+
+def prepare_quantized_inputs(triangulation):
+    """
+    prepare_fused_inputs with the node data in compact integer storage, see
+    compact_node_data
+    """
+    fused_inputs = prepare_fused_inputs(triangulation)
+    fused_inputs["node_data"] = compact_node_data(fused_inputs["node_data"])
+    return fused_inputs
+
+
+def logit_drift_report(
+    policy_network, quantized_policy_network, triangulation
+) -> Dict[str, float]:
+    """
+    Compares the logits of a quantized policy network with the float32
+    logits of the policy network it was copied from on a (batched)
+    triangulation, along with the bytes of the weights and of the node data
+    read by each of them
+
+    Returns
+    -------
+    report: Dict[str, float]
+        -> max_point_logit_drift, mean_point_logit_drift: largest and mean
+            absolute difference of the point logits
+        -> max_triangulation_logit_drift, mean_triangulation_logit_drift:
+            same for the triangulation logits
+        -> weight_bytes, float32_weight_bytes
+        -> node_data_bytes, float32_node_data_bytes
+    """
+    fused_inputs = prepare_fused_inputs(triangulation)
+    quantized_inputs = prepare_quantized_inputs(triangulation)
+    point_logits, triangulation_logits = policy_network.fused_call(
+        fused_inputs
+    )
+    quantized_point_logits, quantized_triangulation_logits = (
+        quantized_policy_network.fused_call(quantized_inputs)
+    )
+    point_drift = tf.math.abs(quantized_point_logits - point_logits)
+    triangulation_drift = tf.math.abs(
+        quantized_triangulation_logits - triangulation_logits
+    )
+    return {
+        "max_point_logit_drift": float(tf.reduce_max(point_drift)),
+        "mean_point_logit_drift": float(tf.reduce_mean(point_drift)),
+        "max_triangulation_logit_drift": float(
+            tf.reduce_max(triangulation_drift)
+        ),
+        "mean_triangulation_logit_drift": float(
+            tf.reduce_mean(triangulation_drift)
+        ),
+        "weight_bytes": quantized_policy_network.nbytes,
+        "float32_weight_bytes": _nbytes(
+            [layer.weights for layer in _get_dense_layers(policy_network)]
+        ),
+        "node_data_bytes": _nbytes(quantized_inputs["node_data"]),
+        "float32_node_data_bytes": _nbytes(fused_inputs["node_data"]),
+    }
+
+
+class _QuantizedDense:
+    """
+    Dense layer with quantized weights, called like tf.keras.layers.Dense.
+    The int8 kernels are scaled after the matrix product, by one scale per
+    output unit. The weights are variables, reassigned by assign.
+    """
+
+    def __init__(self, layer, weight_dtype):
+        self.activation = layer.activation
+        self.weight_dtype = weight_dtype
+        kernel, scale, bias = self._quantize(layer)
+        self.kernel = _to_variable(kernel)
+        self.scale = _to_variable(scale)
+        self.bias = _to_variable(bias)
+
+    def assign(self, layer):
+        """Copies the current weights of a tf.keras.layers.Dense"""
+        kernel, scale, bias = self._quantize(layer)
+        self.kernel.assign(kernel)
+        if scale is not None:
+            self.scale.assign(scale)
+        if bias is not None:
+            self.bias.assign(bias)
+
+    def _quantize(self, layer):
+        kernel = layer.kernel
+        if self.weight_dtype == "int8":
+            scale = tf.math.maximum(
+                tf.reduce_max(tf.math.abs(kernel), axis=0) / INT8_MAX,
+                tf.keras.backend.epsilon(),
+            )
+            kernel = tf.cast(
+                tf.clip_by_value(
+                    tf.math.round(kernel / scale), -INT8_MAX, INT8_MAX
+                ),
+                tf.int8,
+            )
+            return kernel, scale, _read_bias(layer, tf.float32)
+        return (
+            tf.cast(kernel, tf.bfloat16),
+            None,
+            _read_bias(layer, tf.bfloat16),
+        )
+
+    def __call__(self, inputs):
+        outputs = tf.linalg.matmul(inputs, tf.cast(self.kernel, inputs.dtype))
+        if self.scale is not None:
+            outputs = outputs * self.scale
+        if self.bias is not None:
+            outputs = outputs + self.bias
+        return self.activation(outputs)
+
+
+class _QuantizedSAGEConv:
+    """The dense layers and the activation of a mean SAGEConv"""
+
+    def __init__(self, conv, weight_dtype):
+        self.fc_self = _QuantizedDense(conv.fc_self, weight_dtype)
+        self.fc_neigh = _QuantizedDense(conv.fc_neigh, weight_dtype)
+        self.activation = conv.activation
+
+
+class _QuantizedHeteroGraphConv:
+    """The modules and the aggregation of a HeteroGraphConv"""
+
+    def __init__(self, layer, weight_dtype):
+        self.mods = {
+            etype: _QuantizedSAGEConv(conv, weight_dtype)
+            for etype, conv in layer.mods.items()
+        }
+        self.agg_fn = layer.agg_fn
+
+
+def _to_variable(value):
+    if value is None:
+        return None
+    return tf.Variable(value, trainable=False)
+
+
+def _read_bias(layer, dtype):
+    if layer.bias is None:
+        return None
+    return tf.cast(layer.bias, dtype)
+
+
+def _get_dense_layers(policy_network):
+    return [
+        dense
+        for layer in policy_network._get_local_layers()
+        for conv in layer.mods.values()
+        for dense in (conv.fc_self, conv.fc_neigh)
+    ] + [
+        policy_network.g_layer_1,
+        policy_network.g_layer_2,
+        policy_network.g_layer_3,
+    ]
@@ -0,0 +1,342 @@
+from typing import NamedTuple
+
+import dgl
+import numpy as np
+import tensorflow as tf
+
+from core.environment import _create_triangle_data, _update_triangulation_data
+
+
+class EncodedTriangulation(NamedTuple):
+    """
+    Compact encoding of a triangulation, from which its angles and all of its
+    node data can be derived
+
+    n_points: int
+    segment_points: np.ndarray
+        Array of shape (n_segments, 2) of the endpoints of each segment
+    segment_types: np.ndarray
+        Array of shape (n_segments, ) of the type of each segment
+    triangle_segments: np.ndarray
+        Array of shape (n_triangles, 3) of the segments of each triangle
+    """
+
+    n_points: int
+    segment_points: np.ndarray
+    segment_types: np.ndarray
+    triangle_segments: np.ndarray
+
+
+class SumTree:
+    """
+    Binary tree of the sums of non-negative priorities, with the priorities
+    in its leaves. Updating priorities and sampling indices proportionally to
+    their priority take O(log capacity) per index, and both are vectorized
+    over batches of indices.
+
+    Parameters
+    ----------
+    capacity: int
+        Number of priorities, rounded up to a power of two for the tree
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._n_leaves = 1 << max(capacity - 1, 0).bit_length()
+        self._tree = np.zeros(2 * self._n_leaves)
+
+    @property
+    def total(self):
+        return self._tree[1]
+
+    def __getitem__(self, indices):
+        return self._tree[self._n_leaves + np.asarray(indices)]
+
+    def update(self, indices, priorities):
+        """Sets the priorities of the given indices"""
+        nodes = self._n_leaves + np.asarray(indices, dtype=np.int64)
+        self._tree[nodes] = priorities
+        # Recomputing the parents from their children handles indices
+        # sharing ancestors
+        for _ in range(self._n_leaves.bit_length() - 1):
+            nodes = np.unique(nodes // 2)
+            self._tree[nodes] = (
+                self._tree[2 * nodes] + self._tree[2 * nodes + 1]
+            )
+
+    def find(self, values):
+        """
+        Indices whose cumulative priority range contains each value of
+        [0, total)
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self._n_leaves.bit_length() - 1):
+            left = 2 * nodes
+            left_sums = self._tree[left]
+            # Rounding can leave values just above the sum of a subtree with
+            # a zero priority right child, which cannot be sampled
+            is_right = (values >= left_sums) & (self._tree[left + 1] > 0)
+            values = np.where(is_right, values - left_sums, values)
+            nodes = np.where(is_right, left + 1, left)
+        return nodes - self._n_leaves
+
+
+class PrioritizedReplayBuffer:
+    """
+    Fixed capacity buffer of terminal triangulations, sampled proportionally
+    to their priority, e.g. their reward. Once full, every new triangulation
+    replaces the oldest one. The triangulations are stored as
+    EncodedTriangulation and rebuilt as batched graphs when sampled.
+
+    Parameters
+    ----------
+    capacity: int
+    seed: int
+    """
+
+    def __init__(self, capacity, seed=None):
+        self.capacity = capacity
+        self._sum_tree = SumTree(capacity)
+        self._encodings = [None] * capacity
+        self._next_index = 0
+        self._size = 0
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, triangulations, priorities):
+        """
+        Parameters
+        ----------
+        triangulations: dgl.DGLHeteroGraph
+            Batched triangulations
+        priorities: Sequence[float]
+            Non-negative priority of each triangulation
+
+        Returns
+        -------
+        indices: np.ndarray
+            Indices of the triangulations in the buffer
+        """
+        encodings = encode_triangulations(triangulations)
+        # The first ones would be replaced by the last ones
+        encodings = encodings[-self.capacity :]
+        priorities = np.asarray(priorities, dtype=np.float64)[-self.capacity :]
+
+        indices = (self._next_index + np.arange(len(encodings))) % (
+            self.capacity
+        )
+        for index, encoding in zip(indices, encodings):
+            self._encodings[index] = encoding
+        self._sum_tree.update(indices, priorities)
+        self._next_index = (self._next_index + len(encodings)) % (
+            self.capacity
+        )
+        self._size = min(self._size + len(encodings), self.capacity)
+        return indices
+
+    def sample(self, batch_size):
+        """
+        Samples batch_size triangulations with replacement, stratified over
+        the total priority
+
+        Returns
+        -------
+        Tuple:
+            triangulations: dgl.DGLHeteroGraph
+                The sampled triangulations batched
+            indices: np.ndarray
+                Indices of the sampled triangulations, see update_priorities
+            probabilities: np.ndarray
+                Probability of sampling each of them
+        """
+        total = self._sum_tree.total
+        if not total > 0:
+            raise ValueError("No triangulation with a positive priority")
+        values = (np.arange(batch_size) + self._rng.random(batch_size)) * (
+            total / batch_size
+        )
+        indices = self._sum_tree.find(values)
+        triangulations = decode_triangulations(
+            [self._encodings[index] for index in indices]
+        )
+        return triangulations, indices, self._sum_tree[indices] / total
+
+    def update_priorities(self, indices, priorities):
+        self._sum_tree.update(indices, priorities)
+
+
+def encode_triangulations(triangulations):
+    """
+    Encodes each triangulation of a batch, see EncodedTriangulation
+
+    Returns
+    -------
+    encodings: List[EncodedTriangulation]
+    """
+    segments, points = [
+        ids.numpy() for ids in triangulations.edges(etype="segment_has_point")
+    ]
+    segment_points = points[np.argsort(segments, kind="stable")].reshape(-1, 2)
+    segments, triangles = [
+        ids.numpy()
+        for ids in triangulations.edges(etype="segment_in_triangle")
+    ]
+    triangle_segments = segments[np.argsort(triangles, kind="stable")].reshape(
+        -1, 3
+    )
+    segment_types = (
+        triangulations.nodes["segment"].data["segment_type"].numpy()
+    )
+
+    n_points, n_segments, n_triangles = [
+        triangulations.batch_num_nodes(ntype).numpy()
+        for ntype in ("point", "segment", "triangle")
+    ]
+    point_offsets = np.cumsum(n_points) - n_points
+    segment_offsets = np.cumsum(n_segments) - n_segments
+    # Node ids of the batched graph to node ids local to each triangulation
+    segment_points = segment_points - np.repeat(
+        point_offsets, n_segments
+    ).reshape(-1, 1)
+    triangle_segments = triangle_segments - np.repeat(
+        segment_offsets, n_triangles
+    ).reshape(-1, 1)
+
+    return [
+        EncodedTriangulation(
+            int(n_graph_points),
+            graph_segment_points.astype(np.int32),
+            graph_segment_types.astype(np.int8),
+            graph_triangle_segments.astype(np.int32),
+        )
+        for (
+            n_graph_points,
+            graph_segment_points,
+            graph_segment_types,
+            graph_triangle_segments,
+        ) in zip(
+            n_points,
+            np.split(segment_points, np.cumsum(n_segments)[:-1]),
+            np.split(segment_types, np.cumsum(n_segments)[:-1]),
+            np.split(triangle_segments, np.cumsum(n_triangles)[:-1]),
+        )
+    ]
+
+
+def decode_triangulations(encodings):
+    """
+    Rebuilds encoded triangulations as one batched graph with all of their
+    node data. The angle k of a triangle is the angle between its segments k
+    and k + 1, at their common endpoint.
+
+    Parameters
+    ----------
+    encodings: List[EncodedTriangulation]
+
+    Returns
+    -------
+    triangulations: dgl.DGLHeteroGraph
+    """
+    n_points = np.array([encoding.n_points for encoding in encodings])
+    n_segments = np.array(
+        [len(encoding.segment_types) for encoding in encodings]
+    )
+    n_triangles = np.array(
+        [len(encoding.triangle_segments) for encoding in encodings]
+    )
+    segment_points = np.concatenate(
+        [encoding.segment_points for encoding in encodings]
+    ) + np.repeat(np.cumsum(n_points) - n_points, n_segments).reshape(-1, 1)
+    triangle_segments = np.concatenate(
+        [encoding.triangle_segments for encoding in encodings]
+    ) + np.repeat(np.cumsum(n_segments) - n_segments, n_triangles).reshape(
+        -1, 1
+    )
+    segment_types = np.concatenate(
+        [encoding.segment_types for encoding in encodings]
+    )
+
+    # Segments k and k + 1 bounding each angle, in the order of the angles
+    bounding_segments = np.stack(
+        [triangle_segments, np.roll(triangle_segments, -1, axis=1)], axis=2
+    ).reshape(-1, 2)
+    points, other_points = (
+        segment_points[bounding_segments[:, 0]],
+        segment_points[bounding_segments[:, 1]],
+    )
+    is_first_common = np.any(
+        points[:, :1] == other_points, axis=1, keepdims=True
+    )
+    angle_points = np.where(is_first_common, points[:, :1], points[:, 1:])[
+        :, 0
+    ]
+    n_angles = 3 * n_triangles
+    angles = np.arange(n_angles.sum())
+
+    graph_data = {
+        ("segment", "segment_in_triangle", "triangle"): (
+            triangle_segments.reshape(-1),
+            np.repeat(np.arange(n_triangles.sum()), 3),
+        ),
+        ("segment", "segment_has_point", "point"): (
+            np.repeat(np.arange(n_segments.sum()), 2),
+            segment_points.reshape(-1),
+        ),
+        ("segment", "segment_bounds_angle", "angle"): (
+            bounding_segments.reshape(-1),
+            np.repeat(angles, 2),
+        ),
+        ("angle", "angle_at_point", "point"): (angles, angle_points),
+        ("triangle", "triangle_contains_angle", "angle"): (
+            angles // 3,
+            angles,
+        ),
+    }
+    triangulations = dgl.heterograph(
+        {
+            etype: tuple(tf.constant(ids, dtype=tf.int32) for ids in edges)
+            for etype, edges in graph_data.items()
+        },
+        num_nodes_dict={
+            "angle": int(n_angles.sum()),
+            "point": int(n_points.sum()),
+            "segment": int(n_segments.sum()),
+            "triangle": int(n_triangles.sum()),
+        },
+        idtype=tf.int32,
+    )
+    triangulations.nodes["segment"].data["segment_type"] = tf.constant(
+        segment_types, dtype=tf.float32
+    )
+
+    batch_num_nodes = {
+        "angle": n_angles,
+        "point": n_points,
+        "segment": n_segments,
+        "triangle": n_triangles,
+    }
+    triangulations.set_batch_num_nodes(
+        {
+            ntype: tf.constant(n_nodes, dtype=tf.int64)
+            for ntype, n_nodes in batch_num_nodes.items()
+        }
+    )
+    batch_num_edges = {
+        "segment_in_triangle": 3 * n_triangles,
+        "segment_has_point": 2 * n_segments,
+        "segment_bounds_angle": 2 * n_angles,
+        "angle_at_point": n_angles,
+        "triangle_contains_angle": n_angles,
+    }
+    triangulations.set_batch_num_edges(
+        {
+            etype: tf.constant(batch_num_edges[etype[1]], dtype=tf.int64)
+            for etype in graph_data
+        }
+    )
+    triangulations = _create_triangle_data(triangulations)
+    triangulations = _update_triangulation_data(triangulations)
+    return triangulations
@@ -0,0 +1,278 @@
+import multiprocessing
+import os
+import queue
+from contextlib import contextmanager
+from time import perf_counter
+
+import tensorflow as tf
+
+from core.feature_cache import FeatureCache
+from core.policy_network import HeteroGraphPolicyNetwork, prepare_fused_inputs
+from core.quantized_policy_network import QuantizedPolicyNetwork
+from core.trainer import TrajectorySampler
+
+# Seconds between checks of the stop event by a blocked worker, and of the
+# workers being alive by the blocked learner
+_POLL_INTERVAL = 0.1
+
+# Environment variables read by TensorFlow when it initializes, which
+# happens as soon as dgl is imported
+_SINGLE_THREADED_ENVIRON = {
+    "TF_NUM_INTRAOP_THREADS": "1",
+    "TF_NUM_INTEROP_THREADS": "1",
+}
+
+
+class RolloutWorkers:
+    """
+    Samples trajectories in n_workers processes, each stepping its own
+    environments with a local copy of the policy network. The workers stream
+    complete trajectories to the learner over a queue, and pick up the latest
+    weights sent with update_weights before sampling their next trajectory.
+
+    The processes are started with the spawn method, so log_reward_fn has to
+    be picklable, e.g. a module level function. Every worker runs TensorFlow
+    on a single thread, so that the throughput scales with the number of
+    cores rather than the workers competing for the same threads.
+
+    Usage:
+        with RolloutWorkers(policy_network, log_reward_fn, 4) as workers:
+            trainer.train(n_iterations, batch_size, rollout_workers=workers)
+
+    Parameters
+    ----------
+    policy_network: HeteroGraphPolicyNetwork
+        The learner's policy network, whose weights the workers start from
+    log_reward_fn: Callable[[dgl.DGLHeteroGraph], float]
+        Log reward of a terminated triangulation
+    n_workers: int
+        Number of worker processes
+    n_envs: int
+        Number of triangulations each worker samples in parallel
+    max_steps: int
+        Number of steps after which terminating is the only action left
+    policy_network_kwargs: Dict
+        Keyword arguments the policy network was created with
+    max_queued_trajectories: int
+        Number of trajectories the workers can be ahead of the learner
+    seed: int
+        Worker i seeds its random number generator with seed + i
+    feature_cache_size: int
+        Size of the FeatureCache of each worker, no cache by default
+    weight_dtype: str
+        If given, the workers sample with a QuantizedPolicyNetwork storing
+        the weights in that dtype ("bfloat16" or "int8"), float32 by default
+    compact_storage: bool
+        Whether the workers' environments store the node data in integer
+        dtypes, see compact_node_data
+    """
+
+    def __init__(
+        self,
+        policy_network,
+        log_reward_fn,
+        n_workers,
+        n_envs=16,
+        max_steps=32,
+        policy_network_kwargs=None,
+        max_queued_trajectories=256,
+        seed=None,
+        feature_cache_size=None,
+        weight_dtype=None,
+        compact_storage=False,
+    ):
+        self.policy_network = policy_network
+        self.log_reward_fn = log_reward_fn
+        self.n_workers = n_workers
+        self.n_envs = n_envs
+        self.max_steps = max_steps
+        self.policy_network_kwargs = policy_network_kwargs or {}
+        self.seed = seed
+        self.feature_cache_size = feature_cache_size
+        self.weight_dtype = weight_dtype
+        self.compact_storage = compact_storage
+
+        self._context = multiprocessing.get_context("spawn")
+        self._trajectory_queue = self._context.Queue(max_queued_trajectories)
+        self._weight_queues = []
+        self._stop_event = self._context.Event()
+        self._processes = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        weights = self.policy_network.get_weights()
+        with _updated_environ(_SINGLE_THREADED_ENVIRON):
+            self._start_workers(weights)
+
+    def _start_workers(self, weights):
+        for worker in range(self.n_workers):
+            weight_queue = self._context.Queue()
+            process = self._context.Process(
+                target=_run_worker,
+                args=(
+                    self._trajectory_queue,
+                    weight_queue,
+                    self._stop_event,
+                    weights,
+                    self.log_reward_fn,
+                    self.policy_network_kwargs,
+                    self.n_envs,
+                    self.max_steps,
+                    None if self.seed is None else self.seed + worker,
+                    self.feature_cache_size,
+                    self.weight_dtype,
+                    self.compact_storage,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self._weight_queues.append(weight_queue)
+            self._processes.append(process)
+
+    def get_trajectories(self, n_trajectories, timeout=None):
+        """
+        Waits for n_trajectories trajectories from any of the workers. The
+        trajectories can have been sampled with weights older than the last
+        update_weights, which the trajectory balance objective tolerates.
+
+        Parameters
+        ----------
+        n_trajectories: int
+        timeout: float
+            Seconds to wait for each trajectory, raises queue.Empty when
+            exceeded. Waits indefinitely by default
+
+        Returns
+        -------
+        trajectories: List[Trajectory]
+        """
+        return [self._get_trajectory(timeout) for _ in range(n_trajectories)]
+
+    def _get_trajectory(self, timeout):
+        start = perf_counter()
+        while True:
+            try:
+                return self._trajectory_queue.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+            for process in self._processes:
+                if process.exitcode is not None:
+                    raise RuntimeError(
+                        f"Rollout worker exited with code {process.exitcode}"
+                    )
+            if timeout is not None and perf_counter() - start > timeout:
+                raise queue.Empty
+
+    def update_weights(self, policy_network=None):
+        """
+        Sends the weights of the policy network, by default the one the
+        workers were created with, to every worker
+        """
+        policy_network = policy_network or self.policy_network
+        weights = policy_network.get_weights()
+        for weight_queue in self._weight_queues:
+            weight_queue.put(weights)
+
+    def close(self):
+        """Stops the workers, dropping the trajectories still queued"""
+        self._stop_event.set()
+        for process in self._processes:
+            while process.is_alive():
+                _drain(self._trajectory_queue)
+                process.join(_POLL_INTERVAL)
+        _drain(self._trajectory_queue)
+        self._processes = []
+        self._weight_queues = []
+
+
+def _run_worker(
+    trajectory_queue,
+    weight_queue,
+    stop_event,
+    weights,
+    log_reward_fn,
+    policy_network_kwargs,
+    n_envs,
+    max_steps,
+    seed,
+    feature_cache_size,
+    weight_dtype,
+    compact_storage,
+):
+    if seed is not None:
+        tf.random.set_seed(seed)
+
+    policy_network = HeteroGraphPolicyNetwork(**policy_network_kwargs)
+    sampler = TrajectorySampler(
+        policy_network,
+        log_reward_fn,
+        n_envs=n_envs,
+        max_steps=max_steps,
+        feature_cache=(
+            None
+            if feature_cache_size is None
+            else FeatureCache(feature_cache_size)
+        ),
+        compact_storage=compact_storage,
+    )
+    # Create the variables before overwriting them
+    policy_network.fused_call(
+        prepare_fused_inputs(sampler.environment.reset())
+    )
+    policy_network.set_weights(weights)
+    sampler.policy_network = _get_inference_network(
+        policy_network, weight_dtype
+    )
+
+    while not stop_event.is_set():
+        weights = _drain(weight_queue)
+        if weights:
+            policy_network.set_weights(weights[-1])
+            if weight_dtype is not None:
+                # Keeps the traces of the quantized network's compiled call
+                sampler.policy_network.requantize(policy_network)
+
+        for trajectory in sampler.sample(1):
+            while not stop_event.is_set():
+                try:
+                    trajectory_queue.put(trajectory, timeout=_POLL_INTERVAL)
+                    break
+                except queue.Full:
+                    continue
+
+
+def _get_inference_network(policy_network, weight_dtype):
+    if weight_dtype is None:
+        return policy_network
+    return QuantizedPolicyNetwork(policy_network, weight_dtype)
+
+
+@contextmanager
+def _updated_environ(variables):
+    """Temporarily sets environment variables, e.g. for spawned processes"""
+    previous = {name: os.environ.get(name) for name in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def _drain(items):
+    """Removes and returns every item currently in a queue"""
+    drained = []
+    while True:
+        try:
+            drained.append(items.get_nowait())
+        except queue.Empty:
+            return drained
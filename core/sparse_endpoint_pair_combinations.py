@@ -0,0 +1,613 @@
+from typing import Tuple
+
+import tensorflow as tf
+
+from core.profiling import profiled
+from core.tensor_utils import boolean_mask
+
+# Point types of a new triangle (see endpoint_pair_combinations):
+#   A -> Point incident to one time-like segment and one space-like segment
+#   B -> Point incident to two time-like segments
+#   C -> Point incident to two space-like segments
+# Whether each new point type (A, B, C) has a valid segment of each type
+NEW_POINTS_WITH_VALID_SEGMENT = ((True, True, False), (True, False, True))
+# Number of light cone crossings of each new point type (A, B, C)
+NEW_POINTS_N_LIGHT_CROSSINGS = (1.0, 0.0, 0.0)
+
+
+def extract_sparse_endpoint_pair_combinations(
+    triangulation,
+) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
+    """
+    Sparse counterpart of extract_endpoint_pair_combinations. Only the boundary
+    segments, their endpoints and the segments incident to those endpoints are
+    looked at, so no (n_points, n_points) tensor is ever materialized. The
+    memory and the work scale with the size of the boundary instead of with
+    the total number of points.
+
+    The six returned tensors are identical (values and ordering) to the ones
+    returned by extract_endpoint_pair_combinations.
+    """
+    return tuple(
+        pairs[:, 1:]
+        for pairs in extract_batched_endpoint_pair_combinations(triangulation)
+    )
+
+
+@profiled("sparse_extractor")
+def extract_batched_endpoint_pair_combinations(
+    triangulations,
+) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
+    """
+    Extracts the endpoint pair combinations of every triangulation in a
+    dgl.batch'ed heterograph in one vectorized call. Endpoint pairs are only
+    matched with endpoint pairs of the same triangulation.
+
+    Each of the six returned tensors has a leading column with the index of the
+    triangulation in the batch, followed by the node indices of the points in
+    the batched graph. These directly index the point_logits of the batched
+    graph, while the node indices within each triangulation are recovered by
+    subtracting the cumulative sum of batch_num_nodes("point") of the preceding
+    triangulations. For a single triangulation, the graph column is all zeros.
+    """
+    # ------------------ Get relevant data from triangulation ------------------
+    n_points = tf.cast(triangulations.num_nodes("point"), tf.int64)
+    batch_num_points = tf.cast(
+        triangulations.batch_num_nodes("point"), tf.int64
+    )
+    graph_of_pt = tf.repeat(
+        tf.range(tf.shape(batch_num_points, out_type=tf.int64)[0]),
+        batch_num_points,
+    )
+    boundary_segments = tf.where(
+        tf.cast(triangulations.nodes["segment"].data["boundary"], tf.bool)
+    )[:, 0]
+    boundary_segments, segment_endpts = _get_segment_endpoints(
+        triangulations, boundary_segments
+    )
+    segment_type = tf.cast(
+        tf.gather(
+            triangulations.nodes["segment"].data["segment_type"],
+            boundary_segments,
+        ),
+        tf.int32,
+    )
+    boundary_pts, compact_segment_endpts = _compact_boundary_points(
+        segment_endpts
+    )
+    n_light_crossings_per_pt = tf.cast(
+        tf.gather(
+            triangulations.nodes["point"].data["n_light_cone_angle"],
+            boundary_pts,
+        ),
+        tf.float32,
+    )
+    neighbor_keys = _get_neighbor_keys_of_boundary_points(
+        triangulations, boundary_pts, n_points
+    )
+
+    # ------------------------ Extract combinations ----------------------------
+    current_pair_combos = []
+    new_tri_pair_combos = []
+    for type_index in range(2):
+        is_of_type = tf.math.equal(segment_type, type_index)
+        n_vseg_per_pt = _count_valid_segments_per_point(
+            compact_segment_endpts, is_of_type, tf.shape(boundary_pts)[0]
+        )
+        endpts, compact_endpts = _get_valid_segment_endpoints_to_connect(
+            boolean_mask(segment_endpts, is_of_type),
+            boolean_mask(compact_segment_endpts, is_of_type),
+            n_points,
+        )
+        graph_of_endpts = tf.gather(graph_of_pt, endpts[:, 0])
+        current_pair_combos.append(
+            _get_compatible_current_pair_combinations(
+                endpts,
+                compact_endpts,
+                graph_of_endpts,
+                n_vseg_per_pt,
+                n_light_crossings_per_pt,
+                neighbor_keys,
+                n_points,
+            )
+        )
+        new_tri_pair_combos.append(
+            {
+                new_pt_types: _get_compatible_new_triangle_pair_combinations(
+                    endpts,
+                    compact_endpts,
+                    graph_of_endpts,
+                    n_light_crossings_per_pt,
+                    type_index,
+                    new_pt_types,
+                )
+                for new_pt_types in [(0, 0), (0, 1), (1, 0), (0, 2), (2, 0)]
+            }
+        )
+
+    # --------------------- Group combinations per type ------------------------
+    timelike, spacelike = new_tri_pair_combos
+
+    # Join current segments
+    timelike_pairs, spacelike_pairs = current_pair_combos
+
+    # Join with segment of new tss triangle: (A, A') and (A, C)/(C, A)
+    timelike_pairs_for_tss_triangle = timelike[(0, 0)]
+    spacelike_pairs_for_tss_triangle = tf.concat(
+        [spacelike[(0, 2)], _reverse_pairs(spacelike[(2, 0)])], axis=0
+    )
+
+    # Join with segment of new stt triangle: (A, B)/(B, A) and (A, A')
+    timelike_pairs_for_stt_triangle = tf.concat(
+        [timelike[(0, 1)], _reverse_pairs(timelike[(1, 0)])], axis=0
+    )
+    spacelike_pairs_for_stt_triangle = spacelike[(0, 0)]
+    return (
+        timelike_pairs,
+        spacelike_pairs,
+        timelike_pairs_for_tss_triangle,
+        spacelike_pairs_for_tss_triangle,
+        timelike_pairs_for_stt_triangle,
+        spacelike_pairs_for_stt_triangle,
+    )
+
+
+def _reverse_pairs(pair_combos: tf.Tensor) -> tf.Tensor:
+    """Swaps the endpoints of pairs that have a leading graph column"""
+    return tf.concat([pair_combos[:, :1], pair_combos[:, :0:-1]], axis=1)
+
+
+@profiled("sparse_extractor.current_pairs")
+def _get_compatible_current_pair_combinations(
+    endpts: tf.Tensor,
+    compact_endpts: tf.Tensor,
+    graph_of_endpts: tf.Tensor,
+    n_vseg_per_pt: tf.Tensor,
+    n_light_crossings_per_pt: tf.Tensor,
+    neighbor_keys: tf.Tensor,
+    n_points: tf.Tensor,
+) -> tf.Tensor:
+    """
+    Matches each ordered endpoint pair (p0, p1) of the valid segments with the
+    endpoint pairs (p0', p1') of valid segments of the same triangulation,
+    where p0' > p1', such that p0' is compatible with p0 and p1' is compatible
+    with p1. This is the sparse equivalent of the first N rows of the
+    (N+6, n_points, n_points) endpoint pair filter.
+
+    Parameters
+    ----------
+    endpts: tf.Tensor
+        Tensor of shape (N, 2) corresponding to the sorted ordered endpoints of
+        the valid segments of one segment type
+    compact_endpts: tf.Tensor
+        Tensor of shape (N, 2) with the indices of endpts among the boundary
+        points
+    graph_of_endpts: tf.Tensor
+        Tensor of shape (N, ) with the index of the triangulation in the batch
+        containing each endpoint pair
+    n_vseg_per_pt: tf.Tensor
+        Tensor of shape (n_boundary_points, ) representing the number of valid
+        segments of the segment type incident to each boundary point
+    n_light_crossings_per_pt: tf.Tensor
+        Tensor of shape (n_boundary_points, ) representing the number of light
+        cone crossings around each boundary point
+    neighbor_keys: tf.Tensor
+        Sorted tensor of the keys of points connected by a segment
+    n_points: tf.Tensor
+        Total number of points in the triangulation
+
+    Returns
+    -------
+    pair_combos: tf.Tensor
+        Tensor of shape (M, 5) representing the endpoint pairs being matched
+            -> pair_combos[:, 0] refer to the triangulation in the batch
+            -> pair_combos[:, [1, 2]] refer to (p0, p1)
+            -> pair_combos[:, [3, 4]] refer to (p0', p1')
+    """
+    is_lower = tf.math.greater(endpts[:, 0], endpts[:, 1])
+    lower_endpts = boolean_mask(endpts, is_lower)
+    compact_lower_endpts = boolean_mask(compact_endpts, is_lower)
+    graph_of_lower_endpts = boolean_mask(graph_of_endpts, is_lower)
+
+    # Every (p0, p1) is considered against every (p0', p1') of the same type
+    # and the same triangulation. Endpoints are sorted, so the (p0', p1') of
+    # each triangulation form a contiguous range.
+    first_lower = tf.searchsorted(
+        graph_of_lower_endpts, graph_of_endpts, side="left", out_type=tf.int64
+    )
+    last_lower = tf.searchsorted(
+        graph_of_lower_endpts, graph_of_endpts, side="right", out_type=tf.int64
+    )
+    endpts_inds = tf.repeat(
+        tf.range(tf.shape(endpts, out_type=tf.int64)[0]),
+        last_lower - first_lower,
+    )
+    lower_endpts_inds = tf.ragged.range(first_lower, last_lower).flat_values
+    pair_combos = tf.concat(
+        [
+            tf.gather(endpts, endpts_inds),
+            tf.gather(lower_endpts, lower_endpts_inds),
+        ],
+        axis=1,
+    )
+    compact_pair_combos = tf.concat(
+        [
+            tf.gather(compact_endpts, endpts_inds),
+            tf.gather(compact_lower_endpts, lower_endpts_inds),
+        ],
+        axis=1,
+    )
+
+    compatible = [
+        _are_compatible_existing_points(
+            pair_combos[:, i],
+            pair_combos[:, i + 2],
+            compact_pair_combos[:, i],
+            compact_pair_combos[:, i + 2],
+            n_vseg_per_pt,
+            n_light_crossings_per_pt,
+            neighbor_keys,
+            n_points,
+        )
+        for i in range(2)
+    ]
+    pair_combos = tf.concat(
+        [
+            tf.expand_dims(tf.gather(graph_of_endpts, endpts_inds), 1),
+            pair_combos,
+        ],
+        axis=1,
+    )
+    return boolean_mask(pair_combos, tf.math.logical_and(*compatible))
+
+
+@profiled("sparse_extractor.new_triangle_pairs")
+def _get_compatible_new_triangle_pair_combinations(
+    endpts: tf.Tensor,
+    compact_endpts: tf.Tensor,
+    graph_of_endpts: tf.Tensor,
+    n_light_crossings_per_pt: tf.Tensor,
+    type_index: int,
+    new_pt_types: Tuple[int, int],
+) -> tf.Tensor:
+    """
+    Gathers the endpoint pairs (p0, p1), where p0 > p1, of the valid segments
+    that can be matched with the endpoint pair (q0, q1) of a new triangle. This
+    is the sparse equivalent of one of the last 6 rows of the
+    (N+6, n_points, n_points) endpoint pair filter.
+
+    Parameters
+    ----------
+    endpts: tf.Tensor
+        Tensor of shape (N, 2) corresponding to the sorted ordered endpoints of
+        the valid segments of one segment type
+    compact_endpts: tf.Tensor
+        Tensor of shape (N, 2) with the indices of endpts among the boundary
+        points
+    graph_of_endpts: tf.Tensor
+        Tensor of shape (N, ) with the index of the triangulation in the batch
+        containing each endpoint pair
+    n_light_crossings_per_pt: tf.Tensor
+        Tensor of shape (n_boundary_points, ) representing the number of light
+        cone crossings around each boundary point
+    type_index: int
+        Segment type of the valid segments
+    new_pt_types: Tuple[int, int]
+        Point types (0: A, 1: B, 2: C) of the new endpoints (q0, q1)
+
+    Returns
+    -------
+    pair_combos: tf.Tensor
+        Tensor of shape (M, 3) representing the triangulation in the batch and
+        the endpoint pairs (p0, p1) where p0 is matched with q0 and p1 is
+        matched with q1
+    """
+    if not all(
+        NEW_POINTS_WITH_VALID_SEGMENT[type_index][new_pt_type]
+        for new_pt_type in new_pt_types
+    ):
+        return tf.zeros(shape=(0, 3), dtype=tf.int64)
+
+    is_lower = tf.math.greater(endpts[:, 0], endpts[:, 1])
+    lower_endpts = boolean_mask(
+        tf.concat([tf.expand_dims(graph_of_endpts, 1), endpts], axis=1),
+        is_lower,
+    )
+    compact_lower_endpts = boolean_mask(compact_endpts, is_lower)
+    compatible = [
+        tf.math.less_equal(
+            tf.gather(n_light_crossings_per_pt, compact_lower_endpts[:, i])
+            + NEW_POINTS_N_LIGHT_CROSSINGS[new_pt_type],
+            4,
+        )
+        for i, new_pt_type in enumerate(new_pt_types)
+    ]
+    return boolean_mask(lower_endpts, tf.math.logical_and(*compatible))
+
+
+def _are_compatible_existing_points(
+    points: tf.Tensor,
+    other_points: tf.Tensor,
+    compact_points: tf.Tensor,
+    compact_other_points: tf.Tensor,
+    n_vseg_per_pt: tf.Tensor,
+    n_light_crossings_per_pt: tf.Tensor,
+    neighbor_keys: tf.Tensor,
+    n_points: tf.Tensor,
+) -> tf.Tensor:
+    """
+    Element-wise version of the lower triangular part of the consolidated point
+    combination filter. A point p' is compatible with a point p if p' <= p and:
+        - p' != p: they are not connected by a segment and have at most four
+            light cone crossings in total
+        - p' == p: p has at least two valid segments and exactly four light
+            cone crossings
+    All points considered here are endpoints of a valid segment, so the
+    condition of having at least one valid segment always holds.
+
+    Parameters
+    ----------
+    points: tf.Tensor
+        Tensor of shape (N, ) of the node indices of the points p
+    other_points: tf.Tensor
+        Tensor of shape (N, ) of the node indices of the points p'
+    compact_points: tf.Tensor
+        Tensor of shape (N, ) of the indices of p among the boundary points
+    compact_other_points: tf.Tensor
+        Tensor of shape (N, ) of the indices of p' among the boundary points
+    n_vseg_per_pt: tf.Tensor
+        Tensor of shape (n_boundary_points, ) representing the number of valid
+        segments incident to each boundary point
+    n_light_crossings_per_pt: tf.Tensor
+        Tensor of shape (n_boundary_points, ) representing the number of light
+        cone crossings around each boundary point
+    neighbor_keys: tf.Tensor
+        Sorted tensor of the keys of points connected by a segment
+    n_points: tf.Tensor
+        Total number of points in the triangulation
+
+    Returns
+    -------
+    compatible: tf.Tensor
+        Boolean tensor of shape (N, )
+    """
+    n_light_crossings = tf.gather(n_light_crossings_per_pt, compact_points)
+    other_n_light_crossings = tf.gather(
+        n_light_crossings_per_pt, compact_other_points
+    )
+    compatible_same_points = tf.math.logical_and(
+        tf.math.equal(points, other_points),
+        tf.math.logical_and(
+            tf.math.greater_equal(tf.gather(n_vseg_per_pt, compact_points), 2),
+            tf.math.equal(n_light_crossings, 4),
+        ),
+    )
+    compatible_distinct_points = tf.math.logical_and(
+        tf.math.less(other_points, points),
+        tf.math.logical_and(
+            tf.math.less_equal(n_light_crossings + other_n_light_crossings, 4),
+            tf.math.logical_not(
+                _are_neighbors(points, other_points, neighbor_keys, n_points)
+            ),
+        ),
+    )
+    return tf.math.logical_or(
+        compatible_same_points, compatible_distinct_points
+    )
+
+
+def _are_neighbors(
+    points: tf.Tensor,
+    other_points: tf.Tensor,
+    neighbor_keys: tf.Tensor,
+    n_points: tf.Tensor,
+) -> tf.Tensor:
+    """
+    Element-wise lookup of whether two points are connected by a segment
+
+    Parameters
+    ----------
+    points: tf.Tensor
+        Tensor of shape (N, ) of node indices
+    other_points: tf.Tensor
+        Tensor of shape (N, ) of node indices
+    neighbor_keys: tf.Tensor
+        Sorted tensor of the keys of points connected by a segment, ending with
+        the largest int64 value
+    n_points: tf.Tensor
+        Total number of points in the triangulation
+
+    Returns
+    -------
+    are_neighbors: tf.Tensor
+        Boolean tensor of shape (N, )
+    """
+    keys = _pair_keys(points, other_points, n_points)
+    positions = tf.searchsorted(neighbor_keys, keys, side="left")
+    return tf.math.equal(tf.gather(neighbor_keys, positions), keys)
+
+
+def _get_neighbor_keys_of_boundary_points(
+    triangulation, boundary_pts: tf.Tensor, n_points: tf.Tensor
+) -> tf.Tensor:
+    """
+    Gathers the keys of the point pairs connected by the segments incident to
+    the boundary points. This is the sparse equivalent of the point to point
+    adjacency matrix restricted to the rows of the boundary points.
+
+    Parameters
+    ----------
+    triangulation: dgl.DGLHeteroGraph
+    boundary_pts: tf.Tensor
+        Tensor of shape (n_boundary_points, ) of the node indices of the
+        endpoints of boundary segments
+    n_points: tf.Tensor
+        Total number of points in the triangulation
+
+    Returns
+    -------
+    neighbor_keys: tf.Tensor
+        Sorted tensor of unique keys, ending with the largest int64 value so
+        that lookups never go out of bounds
+    """
+    incident_segments, _ = triangulation.in_edges(
+        tf.cast(boundary_pts, triangulation.idtype), etype="segment_has_point"
+    )
+    incident_segments, _ = tf.unique(incident_segments)
+    _, segment_endpts = _get_segment_endpoints(
+        triangulation, incident_segments
+    )
+    keys, _ = tf.unique(
+        _pair_keys(segment_endpts[:, 0], segment_endpts[:, 1], n_points)
+    )
+    neighbor_keys = tf.concat(
+        [tf.sort(keys), tf.constant([tf.int64.max], dtype=tf.int64)], axis=0
+    )
+    return neighbor_keys
+
+
+def _get_valid_segment_endpoints_to_connect(
+    endpts: tf.Tensor, compact_endpts: tf.Tensor, n_points: tf.Tensor
+) -> Tuple[tf.Tensor, tf.Tensor]:
+    """
+    Generates the unique ordered endpoint pairs (p0, p1) of the valid segments
+    of one segment type, sorted by (p0, p1). This matches the ordering of
+    tf.where on the endpoint adjacency of valid segments, where parallel valid
+    segments between the same points appear only once.
+
+    Parameters
+    ----------
+    endpts: tf.Tensor
+        Tensor of shape (n_valid_segments, 2) of the endpoints of the valid
+        segments
+    compact_endpts: tf.Tensor
+        Tensor of shape (n_valid_segments, 2) with the indices of endpts among
+        the boundary points
+    n_points: tf.Tensor
+        Total number of points in the triangulation
+
+    Returns
+    -------
+    Tuple:
+        ordered_endpts: tf.Tensor
+            Tensor of shape (N, 2) of ordered endpoint pairs
+        compact_ordered_endpts: tf.Tensor
+            Tensor of shape (N, 2) with the indices of ordered_endpts among the
+            boundary points
+    """
+    ordered_endpts = tf.concat([endpts, endpts[:, ::-1]], axis=0)
+    compact_ordered_endpts = tf.concat(
+        [compact_endpts, compact_endpts[:, ::-1]], axis=0
+    )
+    keys = ordered_endpts[:, 0] * n_points + ordered_endpts[:, 1]
+    order = tf.argsort(keys, stable=True)
+    sorted_keys = tf.gather(keys, order)
+    previous_keys = tf.concat(
+        [tf.constant([-1], dtype=tf.int64), sorted_keys], axis=0
+    )[:-1]
+    unique_order = boolean_mask(
+        order, tf.math.not_equal(sorted_keys, previous_keys)
+    )
+    return (
+        tf.gather(ordered_endpts, unique_order),
+        tf.gather(compact_ordered_endpts, unique_order),
+    )
+
+
+def _count_valid_segments_per_point(
+    compact_segment_endpts: tf.Tensor,
+    is_of_type: tf.Tensor,
+    n_boundary_pts: tf.Tensor,
+) -> tf.Tensor:
+    """
+    Counts the number of boundary segments of a particular type incident to
+    each boundary point (with multiplicity)
+
+    Parameters
+    ----------
+    compact_segment_endpts: tf.Tensor
+        Tensor of shape (n_boundary_segments, 2) with the indices of the
+        segment endpoints among the boundary points
+    is_of_type: tf.Tensor
+        Boolean tensor of shape (n_boundary_segments, )
+    n_boundary_pts: tf.Tensor
+        Number of boundary points
+
+    Returns
+    -------
+    n_vseg_per_pt: tf.Tensor
+        Tensor of shape (n_boundary_points, )
+    """
+    counts = tf.repeat(tf.cast(is_of_type, tf.float32), 2)
+    return tf.math.unsorted_segment_sum(
+        counts, tf.reshape(compact_segment_endpts, [-1]), n_boundary_pts
+    )
+
+
+def _compact_boundary_points(
+    segment_endpts: tf.Tensor,
+) -> Tuple[tf.Tensor, tf.Tensor]:
+    """
+    Relabels the endpoints of the boundary segments with indices among the
+    boundary points, so that per-point data only needs to be gathered for the
+    boundary points
+
+    Parameters
+    ----------
+    segment_endpts: tf.Tensor
+        Tensor of shape (n_boundary_segments, 2) of node indices
+
+    Returns
+    -------
+    Tuple:
+        boundary_pts: tf.Tensor
+            Tensor of shape (n_boundary_points, ) of node indices
+        compact_segment_endpts: tf.Tensor
+            Tensor of shape (n_boundary_segments, 2) of indices into
+            boundary_pts
+    """
+    boundary_pts, compact_pts = tf.unique(
+        tf.reshape(segment_endpts, [-1]), out_idx=tf.int64
+    )
+    return boundary_pts, tf.reshape(compact_pts, (-1, 2))
+
+
+def _get_segment_endpoints(
+    triangulation, segments: tf.Tensor
+) -> Tuple[tf.Tensor, tf.Tensor]:
+    """
+    Gathers the endpoints of the given segments from the edges of the
+    segment_has_point relation
+
+    Parameters
+    ----------
+    triangulation: dgl.DGLHeteroGraph
+    segments: tf.Tensor
+        Tensor of shape (n, ) of unique segment node indices
+
+    Returns
+    -------
+    Tuple:
+        segments: tf.Tensor
+            Tensor of shape (n, ) of the segment node indices, sorted
+        segment_endpts: tf.Tensor
+            Tensor of shape (n, 2) of the endpoints of each segment
+    """
+    seg_inds, pt_inds = triangulation.out_edges(
+        tf.cast(segments, triangulation.idtype), etype="segment_has_point"
+    )
+    order = tf.argsort(seg_inds, stable=True)
+    seg_inds = tf.cast(tf.gather(seg_inds, order), tf.int64)
+    pt_inds = tf.cast(tf.gather(pt_inds, order), tf.int64)
+    return seg_inds[::2], tf.reshape(pt_inds, (-1, 2))
+
+
+def _pair_keys(
+    points: tf.Tensor, other_points: tf.Tensor, n_points: tf.Tensor
+) -> tf.Tensor:
+    """Order-independent int64 keys of point pairs"""
+    points = tf.cast(points, tf.int64)
+    other_points = tf.cast(other_points, tf.int64)
+    return tf.math.minimum(points, other_points) * n_points + tf.math.maximum(
+        points, other_points
+    )
@@ -0,0 +1,11 @@
+import tensorflow as tf
+
+
+def boolean_mask(values: tf.Tensor, mask: tf.Tensor) -> tf.Tensor:
+    """
+    Same as tf.boolean_mask for a mask over the first dimension of values.
+    tf.boolean_mask dispatches many small ops to handle arbitrary masks, which
+    makes it several times slower in eager mode than gathering the indices of
+    the mask.
+    """
+    return tf.gather(values, tf.reshape(tf.where(mask), [-1]))
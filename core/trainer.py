@@ -0,0 +1,435 @@
+from time import perf_counter
+from typing import List, NamedTuple, Optional, Tuple
+
+import dgl
+import numpy as np
+import tensorflow as tf
+
+from core.action_space import (
+    N_ACTION_TYPES,
+    build_action_space,
+    get_action,
+    masked_action_log_softmax,
+)
+from core.environment import VecTriangulationEnvironment
+from core.feature_cache import cached
+from core.policy_network import prepare_fused_inputs
+from core.profiling import profiled
+from core.sparse_endpoint_pair_combinations import (
+    extract_batched_endpoint_pair_combinations,
+)
+from core.tensor_utils import boolean_mask
+
+
+class Trajectory(NamedTuple):
+    """
+    A complete trajectory s_0 -> ... -> s_n -> terminate
+
+    states: List[dgl.DGLHeteroGraph]
+        The states s_0, ..., s_n the actions are taken from
+    actions: List[Tuple[int, int]]
+        The action type of each step and the index of the chosen endpoint pair
+        among the endpoint pair combinations of that type of the state
+    log_reward: float
+        Log reward of the terminal state s_n
+    log_probs: List[float]
+        Log probability of each action under the forward policy it was
+        sampled with, if known
+    """
+
+    states: List[dgl.DGLHeteroGraph]
+    actions: List[Tuple[int, int]]
+    log_reward: float
+    log_probs: Optional[List[float]] = None
+
+
+class TrajectoryBalanceTrainer:
+    """
+    Trains the policy network of an agent as the forward policy of a GFlowNet
+    with the trajectory balance objective:
+        (log Z + sum log P_F(s'|s) - log R(x) - sum log P_B(s|s'))^2
+
+    Trajectories are sampled on-policy by a TrajectorySampler, or by
+    RolloutWorkers in other processes.
+
+    Parameters
+    ----------
+    agent: Agent
+    log_reward_fn: Callable[[dgl.DGLHeteroGraph], float]
+        Log reward of a terminated triangulation
+    log_backward_prob_fn: Callable[[Trajectory], float]
+        Sum of the log backward probabilities of a trajectory. Defaults to 0
+    n_envs: int
+        Number of triangulations sampled in parallel
+    max_steps: int
+        Number of steps after which terminating is the only action left
+    learning_rate: float
+        Learning rate of the policy network
+    log_z_learning_rate: float
+        Learning rate of log Z
+    """
+
+    def __init__(
+        self,
+        agent,
+        log_reward_fn,
+        log_backward_prob_fn=None,
+        n_envs=16,
+        max_steps=32,
+        learning_rate=1e-3,
+        log_z_learning_rate=1e-1,
+    ):
+        self.agent = agent
+        self.log_reward_fn = log_reward_fn
+        self.log_backward_prob_fn = log_backward_prob_fn or (
+            lambda trajectory: 0.0
+        )
+        self.max_steps = max_steps
+
+        self.sampler = TrajectorySampler(
+            agent.policy_network, log_reward_fn, n_envs, max_steps
+        )
+        self.log_z = tf.Variable(0.0, name="log_z")
+        self.optimizer = tf.keras.optimizers.Adam(learning_rate)
+        self.log_z_optimizer = tf.keras.optimizers.Adam(log_z_learning_rate)
+
+    def train(self, n_iterations, batch_size, rollout_workers=None):
+        """
+        Alternates between sampling batch_size trajectories and updating the
+        policy network and log Z on them
+
+        Parameters
+        ----------
+        n_iterations: int
+        batch_size: int
+        rollout_workers: RolloutWorkers
+            If given, the trajectories are received from the rollout workers
+            instead of being sampled in this process, and the updated weights
+            are sent back to them after every iteration
+
+        Returns
+        -------
+        history: List[Dict[str, float]]
+            The loss, log Z and the trajectories sampled and trained on per
+            second of each iteration
+        """
+        history = []
+        for _ in range(n_iterations):
+            start = perf_counter()
+            if rollout_workers is None:
+                trajectories = self.collect_trajectories(batch_size)
+            else:
+                trajectories = rollout_workers.get_trajectories(batch_size)
+            loss = self.train_step(trajectories)
+            if rollout_workers is not None:
+                rollout_workers.update_weights(self.agent.policy_network)
+            duration = perf_counter() - start
+            history.append(
+                {
+                    "loss": float(loss),
+                    "log_z": float(self.log_z),
+                    "trajectories_per_second": len(trajectories) / duration,
+                }
+            )
+        return history
+
+    def collect_trajectories(self, n_trajectories):
+        """
+        Samples at least n_trajectories complete trajectories with the current
+        forward policy, see TrajectorySampler.sample
+        """
+        return self.sampler.sample(n_trajectories)
+
+    def train_step(self, trajectories):
+        """
+        Applies one update of the trajectory balance loss. The states of every
+        step of every trajectory are batched in a single dgl.batch, so the
+        forward policy of the whole batch is computed in one forward pass.
+        """
+        states = dgl.batch(
+            [
+                state
+                for trajectory in trajectories
+                for state in trajectory.states
+            ]
+        )
+        action_space = _get_action_space(states)
+        must_terminate = tf.constant(
+            [
+                step >= self.max_steps
+                for trajectory in trajectories
+                for step in range(len(trajectory.actions))
+            ]
+        )
+        chosen_action_types, chosen_ranks = zip(
+            *[
+                action
+                for trajectory in trajectories
+                for action in trajectory.actions
+            ]
+        )
+        trajectory_of_step = tf.repeat(
+            tf.range(len(trajectories)),
+            [len(trajectory.actions) for trajectory in trajectories],
+        )
+        log_rewards = tf.constant(
+            [trajectory.log_reward for trajectory in trajectories],
+            dtype=tf.float32,
+        )
+        log_backward_probs = tf.constant(
+            [
+                self.log_backward_prob_fn(trajectory)
+                for trajectory in trajectories
+            ],
+            dtype=tf.float32,
+        )
+        fused_inputs = prepare_fused_inputs(states)
+
+        policy_network = self.agent.policy_network
+        with tf.GradientTape() as tape:
+            point_logits, triangulation_logits = policy_network.fused_call(
+                fused_inputs
+            )
+            log_probs = masked_action_log_softmax(
+                action_space,
+                point_logits,
+                triangulation_logits,
+                must_terminate,
+            )
+            chosen = _find_actions(
+                (
+                    action_space.graph_ids,
+                    action_space.action_types,
+                    action_space.ranks,
+                ),
+                (
+                    tf.range(states.batch_size),
+                    tf.constant(chosen_action_types, dtype=tf.int32),
+                    tf.constant(chosen_ranks, dtype=tf.int32),
+                ),
+            )
+            log_forward_probs = tf.math.unsorted_segment_sum(
+                tf.gather(log_probs, chosen),
+                trajectory_of_step,
+                len(trajectories),
+            )
+            loss = tf.reduce_mean(
+                tf.math.square(
+                    self.log_z
+                    + log_forward_probs
+                    - log_rewards
+                    - log_backward_probs
+                )
+            )
+
+        variables = policy_network.trainable_variables
+        gradients = tape.gradient(loss, variables + [self.log_z])
+        self.optimizer.apply_gradients(zip(gradients[:-1], variables))
+        self.log_z_optimizer.apply_gradients([(gradients[-1], self.log_z)])
+        return loss
+
+
+class TrajectorySampler:
+    """
+    Samples trajectories on-policy from n_envs triangulations stepped as one
+    batched graph. The forward policy first picks an action type with the
+    masked softmax of the 7 triangulation logits, then an endpoint pair of
+    that type with the softmax of the segment pair logits computed from the
+    point logits.
+
+    Parameters
+    ----------
+    policy_network: HeteroGraphPolicyNetwork
+    log_reward_fn: Callable[[dgl.DGLHeteroGraph], float]
+        Log reward of a terminated triangulation
+    n_envs: int
+        Number of triangulations sampled in parallel
+    max_steps: int
+        Number of steps after which terminating is the only action left
+    feature_cache: FeatureCache
+        Optional cache of the action candidates and of the inputs of the
+        policy network per (batched) state, which hits when the same states
+        are sampled from again, e.g. the starting triangles with n_envs=1
+    compact_storage: bool
+        Whether the environments store the node data in integer dtypes, see
+        compact_node_data. The states of the trajectories are then stored
+        compactly as well
+    """
+
+    def __init__(
+        self,
+        policy_network,
+        log_reward_fn,
+        n_envs=16,
+        max_steps=32,
+        feature_cache=None,
+        compact_storage=False,
+    ):
+        self.policy_network = policy_network
+        self.log_reward_fn = log_reward_fn
+        self.max_steps = max_steps
+        self.feature_cache = feature_cache
+
+        self.environment = VecTriangulationEnvironment(n_envs, compact_storage)
+        self._states = None
+        self._ongoing = None
+
+    def sample(self, n_trajectories):
+        """
+        Samples at least n_trajectories complete trajectories with the current
+        forward policy. Every step runs a single forward pass on the batched
+        triangulations of all the environments. Unfinished trajectories are
+        carried over to the next call.
+        """
+        if self._states is None:
+            self._states = self.environment.reset()
+            self._ongoing = [
+                ([], [], []) for _ in range(self.environment.n_envs)
+            ]
+
+        trajectories = []
+        while len(trajectories) < n_trajectories:
+            states = self._states
+            action_space = _get_action_space(states, self.feature_cache)
+            point_logits, triangulation_logits = (
+                self.policy_network.fused_call(
+                    cached(self.feature_cache, states, prepare_fused_inputs)
+                )
+            )
+            must_terminate = tf.constant(
+                [
+                    len(actions) >= self.max_steps
+                    for _, actions, _ in self._ongoing
+                ]
+            )
+            log_probs = masked_action_log_softmax(
+                action_space,
+                point_logits,
+                triangulation_logits,
+                must_terminate,
+            )
+            chosen = _sample_actions(
+                log_probs, action_space.graph_ids, states.batch_size
+            )
+
+            actions = []
+            for graph, state in enumerate(dgl.unbatch(states)):
+                action = get_action(action_space, chosen[graph])
+                actions.append(action)
+                self._ongoing[graph][0].append(state)
+                self._ongoing[graph][1].append(
+                    (action[0], int(action_space.ranks[chosen[graph]]))
+                )
+                self._ongoing[graph][2].append(float(log_probs[chosen[graph]]))
+
+            self._states, dones, terminal_states = self.environment.step(
+                actions
+            )
+            terminated = tf.where(dones)[:, 0].numpy().tolist()
+            for graph, terminal_state in zip(terminated, terminal_states):
+                trajectory_states, trajectory_actions, trajectory_log_probs = (
+                    self._ongoing[graph]
+                )
+                trajectories.append(
+                    Trajectory(
+                        trajectory_states,
+                        trajectory_actions,
+                        float(self.log_reward_fn(terminal_state)),
+                        trajectory_log_probs,
+                    )
+                )
+                self._ongoing[graph] = ([], [], [])
+        return trajectories
+
+
+def log_n_triangles(triangulation) -> float:
+    """
+    Log of the number of triangles of a terminated triangulation, a log
+    reward favouring larger triangulations. Defined at module level, so that
+    it can be sent to RolloutWorkers
+    """
+    return np.log(triangulation.num_nodes("triangle"))
+
+
+def _get_action_candidates(triangulations, feature_cache=None):
+    """
+    The endpoint pair combinations of a batched graph, without the pairs
+    gluing a segment to itself (p0, p1, p0, p1), which can only be applied
+    when there are parallel segments between p0 and p1. Cached in the
+    feature cache if given.
+    """
+    return cached(feature_cache, triangulations, _extract_action_candidates)
+
+
+def _get_action_space(triangulations, feature_cache=None):
+    """
+    The ActionSpace of the action candidates of a batched graph, cached in
+    the feature cache if given
+    """
+    return cached(feature_cache, triangulations, _extract_action_space)
+
+
+def _extract_action_space(triangulations):
+    return build_action_space(
+        _extract_action_candidates(triangulations), triangulations.batch_size
+    )
+
+
+@profiled("trainer.action_candidates")
+def _extract_action_candidates(triangulations):
+    combinations = list(
+        extract_batched_endpoint_pair_combinations(triangulations)
+    )
+    for action_type in range(2):
+        pairs = combinations[action_type]
+        is_self_gluing = tf.reduce_all(
+            tf.math.equal(pairs[:, 1:3], pairs[:, 3:]), axis=1
+        )
+        combinations[action_type] = boolean_mask(
+            pairs, tf.math.logical_not(is_self_gluing)
+        )
+    return tuple(combinations)
+
+
+@profiled("trainer.sample_actions")
+def _sample_actions(log_probs, graph_ids, batch_size):
+    """
+    Samples one action per triangulation with the Gumbel-max trick, returning
+    the indices of the sampled actions
+    """
+    uniform = tf.random.uniform(tf.shape(log_probs), minval=1e-20, maxval=1.0)
+    scores = log_probs - tf.math.log(-tf.math.log(uniform))
+    max_scores = tf.math.unsorted_segment_max(scores, graph_ids, batch_size)
+    is_max = tf.math.equal(scores, tf.gather(max_scores, graph_ids))
+    chosen = tf.math.unsorted_segment_min(
+        tf.where(
+            is_max,
+            tf.range(tf.shape(scores)[0]),
+            tf.shape(scores)[0],
+        ),
+        graph_ids,
+        batch_size,
+    )
+    return chosen.numpy()
+
+
+def _find_actions(actions, chosen_actions):
+    """
+    Indices of the chosen (graph, action type, rank) among the actions
+    (graph_ids, action_types, ranks) of an ActionSpace
+    """
+    n_ranks = tf.cast(tf.shape(actions[0])[0] + 1, tf.int64)
+
+    def to_keys(graph_ids, action_types, ranks):
+        graph_ids, action_types, ranks = [
+            tf.cast(values, tf.int64)
+            for values in (graph_ids, action_types, ranks)
+        ]
+        return (graph_ids * N_ACTION_TYPES + action_types) * n_ranks + ranks
+
+    keys = to_keys(*actions)
+    order = tf.argsort(keys)
+    positions = tf.searchsorted(
+        tf.gather(keys, order), to_keys(*chosen_actions)
+    )
+    return tf.gather(order, positions)
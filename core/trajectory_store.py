@@ -0,0 +1,347 @@
+import json
+import os
+
+import dgl
+import numpy as np
+import tensorflow as tf
+
+from core.environment import _create_triangle_data, _update_triangulation_data
+from core.trainer import Trajectory
+
+NTYPES = ("angle", "point", "segment", "triangle")
+CANONICAL_ETYPES = (
+    ("angle", "angle_at_point", "point"),
+    ("segment", "segment_bounds_angle", "angle"),
+    ("segment", "segment_has_point", "point"),
+    ("segment", "segment_in_triangle", "triangle"),
+    ("triangle", "triangle_contains_angle", "angle"),
+)
+
+# Columns of the store: name -> (dtype, shape of a row). Every column is a
+# flat binary file of rows, appended to and memory-mapped independently.
+#   num_nodes, num_edges -> number of nodes and edges of each state per node
+#       type and edge type
+#   edge_starts, segment_starts -> first row of each state in the edge
+#       columns and the segment_type column
+#   edges.<etype> -> (src, dst) of each edge, in node ids local to its state
+#   segment_type -> segment type of each segment
+#   actions, log_probs -> (action type, rank) and forward log probability of
+#       the action taken from each state, NaN if unknown
+#   step_starts, n_steps, log_reward -> first state, number of states and log
+#       reward of each trajectory
+COLUMNS = {
+    "num_nodes": ("int32", (len(NTYPES),)),
+    "num_edges": ("int32", (len(CANONICAL_ETYPES),)),
+    "edge_starts": ("int64", (len(CANONICAL_ETYPES),)),
+    "segment_starts": ("int64", ()),
+    **{f"edges.{etype}": ("int32", (2,)) for _, etype, _ in CANONICAL_ETYPES},
+    "segment_type": ("int8", ()),
+    "actions": ("int32", (2,)),
+    "log_probs": ("float32", ()),
+    "step_starts": ("int64", ()),
+    "n_steps": ("int32", ()),
+    "log_reward": ("float32", ()),
+}
+
+_SCHEMA_FILE = "schema.json"
+
+
+class TrajectoryStore:
+    """
+    Append-only columnar store of trajectories on disk. A state is stored as
+    flat integer edge arrays and its segment types only, the rest of its data
+    is recomputed when it is read back. Reads go through memory-mapped files,
+    so only the rows of the requested states are loaded into memory.
+
+    Parameters
+    ----------
+    path: str
+        Directory of the store, created if it does not exist
+    """
+
+    def __init__(self, path):
+        self.path = path
+        schema = {
+            "canonical_etypes": [list(etype) for etype in CANONICAL_ETYPES],
+            "columns": {
+                name: [dtype, list(shape)]
+                for name, (dtype, shape) in COLUMNS.items()
+            },
+        }
+        schema_path = os.path.join(path, _SCHEMA_FILE)
+        if os.path.exists(schema_path):
+            with open(schema_path) as file:
+                if json.load(file) != schema:
+                    raise ValueError(f"Incompatible trajectory store {path}")
+        else:
+            os.makedirs(path, exist_ok=True)
+            with open(schema_path, "w") as file:
+                json.dump(schema, file)
+
+        self._columns = {}
+
+    @property
+    def n_trajectories(self):
+        return len(self._column("n_steps"))
+
+    @property
+    def n_states(self):
+        return len(self._column("num_nodes"))
+
+    def append(self, trajectories):
+        """
+        Writes trajectories at the end of the store. The states of all the
+        trajectories are converted from one batched graph.
+
+        Parameters
+        ----------
+        trajectories: List[Trajectory]
+        """
+        states = dgl.batch(
+            [
+                state
+                for trajectory in trajectories
+                for state in trajectory.states
+            ]
+        )
+        num_nodes = np.stack(
+            [states.batch_num_nodes(ntype).numpy() for ntype in NTYPES],
+            axis=1,
+        )
+        num_edges = np.stack(
+            [
+                states.batch_num_edges(etype).numpy()
+                for etype in CANONICAL_ETYPES
+            ],
+            axis=1,
+        )
+        n_steps = [len(trajectory.states) for trajectory in trajectories]
+        segment = NTYPES.index("segment")
+        columns = {
+            "num_nodes": num_nodes,
+            "num_edges": num_edges,
+            "edge_starts": self._next_starts("edge_starts", "num_edges")
+            + _exclusive_cumsum(num_edges),
+            "segment_starts": self._next_starts(
+                "segment_starts", "num_nodes", segment
+            )
+            + _exclusive_cumsum(num_nodes[:, segment]),
+            "segment_type": states.nodes["segment"]
+            .data["segment_type"]
+            .numpy(),
+            "actions": [
+                action
+                for trajectory in trajectories
+                for action in trajectory.actions
+            ],
+            "log_probs": [
+                log_prob
+                for trajectory in trajectories
+                for log_prob in (
+                    trajectory.log_probs or [np.nan] * len(trajectory.actions)
+                )
+            ],
+            "step_starts": self.n_states + _exclusive_cumsum(n_steps),
+            "n_steps": n_steps,
+            "log_reward": [
+                trajectory.log_reward for trajectory in trajectories
+            ],
+        }
+        node_offsets = _exclusive_cumsum(num_nodes)
+        for etype_index, (src_type, etype, dst_type) in enumerate(
+            CANONICAL_ETYPES
+        ):
+            # Node ids of the batched graph to node ids local to each state
+            src, dst = [ids.numpy() for ids in states.edges(etype=etype)]
+            n_edges = num_edges[:, etype_index]
+            src = src - np.repeat(
+                node_offsets[:, NTYPES.index(src_type)], n_edges
+            )
+            dst = dst - np.repeat(
+                node_offsets[:, NTYPES.index(dst_type)], n_edges
+            )
+            columns[f"edges.{etype}"] = np.stack([src, dst], axis=1)
+
+        for name, (dtype, _) in COLUMNS.items():
+            with open(self._column_path(name), "ab") as file:
+                file.write(np.asarray(columns[name], dtype=dtype).tobytes())
+        self._columns = {}
+
+    def read_states(self, indices):
+        """
+        Rebuilds states as one batched graph, only reading their rows
+
+        Parameters
+        ----------
+        indices: Sequence[int]
+            Indices of the states among all the states of the store
+
+        Returns
+        -------
+        states: dgl.DGLHeteroGraph
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        num_nodes = np.asarray(self._column("num_nodes")[indices])
+        num_edges = np.asarray(self._column("num_edges")[indices])
+        edge_starts = np.asarray(self._column("edge_starts")[indices])
+        node_offsets = _exclusive_cumsum(num_nodes)
+
+        graph_data = {}
+        for etype_index, canonical_etype in enumerate(CANONICAL_ETYPES):
+            src_type, etype, dst_type = canonical_etype
+            n_edges = num_edges[:, etype_index]
+            edges = self._column(f"edges.{etype}")[
+                _concatenate_ranges(edge_starts[:, etype_index], n_edges)
+            ]
+            # Node ids local to each state to node ids of the batched graph
+            graph_data[canonical_etype] = (
+                tf.constant(
+                    edges[:, 0]
+                    + np.repeat(
+                        node_offsets[:, NTYPES.index(src_type)], n_edges
+                    ),
+                    dtype=tf.int32,
+                ),
+                tf.constant(
+                    edges[:, 1]
+                    + np.repeat(
+                        node_offsets[:, NTYPES.index(dst_type)], n_edges
+                    ),
+                    dtype=tf.int32,
+                ),
+            )
+
+        states = dgl.heterograph(
+            graph_data,
+            num_nodes_dict={
+                ntype: int(num_nodes[:, ntype_index].sum())
+                for ntype_index, ntype in enumerate(NTYPES)
+            },
+            idtype=tf.int32,
+        )
+        states.nodes["segment"].data["segment_type"] = tf.constant(
+            self._column("segment_type")[
+                _concatenate_ranges(
+                    self._column("segment_starts")[indices],
+                    num_nodes[:, NTYPES.index("segment")],
+                )
+            ],
+            dtype=tf.float32,
+        )
+        states.set_batch_num_nodes(
+            {
+                ntype: tf.constant(num_nodes[:, ntype_index], dtype=tf.int64)
+                for ntype_index, ntype in enumerate(NTYPES)
+            }
+        )
+        states.set_batch_num_edges(
+            {
+                canonical_etype: tf.constant(
+                    num_edges[:, etype_index], dtype=tf.int64
+                )
+                for etype_index, canonical_etype in enumerate(CANONICAL_ETYPES)
+            }
+        )
+        states = _create_triangle_data(states)
+        states = _update_triangulation_data(states)
+        return states
+
+    def read_steps(self, indices):
+        """
+        Reads steps of any trajectories, e.g. a minibatch of transitions
+
+        Parameters
+        ----------
+        indices: Sequence[int]
+            Indices of the steps, which are also the indices of the states
+            the actions are taken from
+
+        Returns
+        -------
+        Tuple:
+            states: dgl.DGLHeteroGraph
+                The batched states the actions are taken from
+            actions: np.ndarray
+                Array of shape (n_steps, 2) of the action types and ranks
+            log_probs: np.ndarray
+                Array of shape (n_steps, ) of the forward log probabilities
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        return (
+            self.read_states(indices),
+            np.asarray(self._column("actions")[indices]),
+            np.asarray(self._column("log_probs")[indices]),
+        )
+
+    def read_trajectories(self, indices):
+        """
+        Reads trajectories, rebuilding the states of all of them in one
+        batched graph
+
+        Returns
+        -------
+        trajectories: List[Trajectory]
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        n_steps = np.asarray(self._column("n_steps")[indices])
+        states, actions, log_probs = self.read_steps(
+            _concatenate_ranges(self._column("step_starts")[indices], n_steps)
+        )
+        states = dgl.unbatch(states)
+        log_rewards = self._column("log_reward")[indices]
+
+        trajectories = []
+        offsets = _exclusive_cumsum(n_steps)
+        for offset, n_trajectory_steps, log_reward in zip(
+            offsets, n_steps, log_rewards
+        ):
+            steps = slice(offset, offset + n_trajectory_steps)
+            trajectories.append(
+                Trajectory(
+                    states[steps],
+                    [tuple(action) for action in actions[steps].tolist()],
+                    float(log_reward),
+                    log_probs[steps].tolist(),
+                )
+            )
+        return trajectories
+
+    def _column(self, name):
+        if name not in self._columns:
+            dtype, shape = COLUMNS[name]
+            path = self._column_path(name)
+            n_rows = 0
+            if os.path.exists(path):
+                row_size = np.dtype(dtype).itemsize * int(np.prod(shape))
+                n_rows = os.path.getsize(path) // row_size
+            # np.memmap cannot map empty files
+            self._columns[name] = (
+                np.memmap(path, dtype=dtype, mode="r", shape=(n_rows, *shape))
+                if n_rows
+                else np.empty((0, *shape), dtype=dtype)
+            )
+        return self._columns[name]
+
+    def _column_path(self, name):
+        return os.path.join(self.path, f"{name}.bin")
+
+    def _next_starts(self, starts_name, counts_name, index=slice(None)):
+        """First row of a state appended after the last one of the store"""
+        starts = self._column(starts_name)
+        if not len(starts):
+            return 0
+        return starts[-1] + self._column(counts_name)[-1, index]
+
+
+def _exclusive_cumsum(counts):
+    counts = np.asarray(counts, dtype=np.int64)
+    return np.cumsum(counts, axis=0) - counts
+
+
+def _concatenate_ranges(starts, lengths):
+    """Concatenation of the ranges [start, start + length)"""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    return np.repeat(
+        np.asarray(starts, dtype=np.int64) - _exclusive_cumsum(lengths),
+        lengths,
+    ) + np.arange(lengths.sum(), dtype=np.int64)
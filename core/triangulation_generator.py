@@ -0,0 +1,262 @@
+import numpy as np
+
+from core.environment import STT_SEGMENT_TYPES, TSS_SEGMENT_TYPES
+from core.replay_buffer import EncodedTriangulation, decode_triangulations
+
+# Maximum number of light cone crossings around a point, reached exactly by
+# the internal points
+MAX_LIGHT_CONE_CROSSINGS = 4
+
+
+class TriangulationGenerator:
+    """
+    Grows a triangulation with the moves of the environment that keep it a
+    disk, directly on index lists, so that large triangulations can be grown
+    in seconds and converted to a heterograph once:
+        -> add_triangle: glues a new tss or stt triangle to a boundary
+            segment (p0, p1), adding a point r and the segments (p1, r) and
+            (r, p0)
+        -> close_point: glues the two boundary segments (p, a) and (p, b) of
+            a point p, merging b into a and making p an internal point
+
+    Both moves obey local causality as in
+    _create_filter_for_point_combinations_obeying_local_causality: merged
+    boundary points have at most four light cone crossings, and closed
+    points exactly four. Removed points and segments are only marked as such
+    until the triangulation is encoded.
+
+    Parameters
+    ----------
+    segment_types: Tuple[int, int, int]
+        Segment types of the starting triangle, TSS_SEGMENT_TYPES or
+        STT_SEGMENT_TYPES
+    """
+
+    def __init__(self, segment_types=TSS_SEGMENT_TYPES):
+        self.segment_points = []
+        self.segment_types = []
+        self.segment_triangles = []
+        self.triangle_segments = []
+        self.point_segments = []
+        self.n_light_cone_crossings = []
+        self.n_points = 0
+
+        self._boundary_segments = []
+        self._boundary_positions = {}
+        self._removed_points = set()
+
+        points = [self._add_point(0) for _ in range(3)]
+        segments = [
+            self._add_segment(points[k], points[(k + 1) % 3], segment_type)
+            for k, segment_type in enumerate(segment_types)
+        ]
+        self._add_triangle(segments)
+        for k, segment_type in enumerate(segment_types):
+            self.n_light_cone_crossings[points[k]] += int(
+                segment_type != segment_types[k - 1]
+            )
+
+    @property
+    def boundary_segments(self):
+        return self._boundary_segments
+
+    def triangle_options(self, segment):
+        """
+        The types (u1, u2) of the segments (p1, r) and (r, p0) of the new
+        triangles that can be glued to a boundary segment (p0, p1)
+        """
+        p0, p1 = self.segment_points[segment]
+        segment_type = self.segment_types[segment]
+        return [
+            (u1, u2)
+            for u1 in (0, 1)
+            for u2 in (0, 1)
+            if sorted((segment_type, u1, u2))
+            in (sorted(TSS_SEGMENT_TYPES), sorted(STT_SEGMENT_TYPES))
+            and self.n_light_cone_crossings[p0] + (segment_type != u2)
+            <= MAX_LIGHT_CONE_CROSSINGS
+            and self.n_light_cone_crossings[p1] + (segment_type != u1)
+            <= MAX_LIGHT_CONE_CROSSINGS
+        ]
+
+    def add_triangle(self, segment, u1, u2):
+        """Glues a new triangle to a boundary segment, see triangle_options"""
+        p0, p1 = self.segment_points[segment]
+        segment_type = self.segment_types[segment]
+        r = self._add_point(int(u1 != u2))
+        self.n_light_cone_crossings[p0] += int(segment_type != u2)
+        self.n_light_cone_crossings[p1] += int(segment_type != u1)
+        self._add_triangle(
+            [
+                segment,
+                self._add_segment(p1, r, u1),
+                self._add_segment(r, p0, u2),
+            ]
+        )
+
+    def closable_segments(self, point):
+        """
+        The boundary segments (p, a) and (p, b) of a point that can be glued
+        together, or None
+        """
+        if self.n_light_cone_crossings[point] != MAX_LIGHT_CONE_CROSSINGS:
+            return None
+        segments = [
+            segment
+            for segment in self.point_segments[point]
+            if segment in self._boundary_positions
+        ]
+        if len(segments) != 2:
+            return None
+        segment, other_segment = segments
+        if self.segment_types[segment] != self.segment_types[other_segment]:
+            return None
+        a, b = [self._other_point(s, point) for s in segments]
+        if (
+            a == b
+            or self._are_neighbours(a, b)
+            or self.n_light_cone_crossings[a] + self.n_light_cone_crossings[b]
+            > MAX_LIGHT_CONE_CROSSINGS
+        ):
+            return None
+        return segment, other_segment
+
+    def close_point(self, point):
+        """Glues the boundary segments of a point, see closable_segments"""
+        segment, other_segment = self.closable_segments(point)
+        a = self._other_point(segment, point)
+        b = self._other_point(other_segment, point)
+
+        # Merge other_segment into segment
+        self._remove_boundary_segment(segment)
+        self._remove_boundary_segment(other_segment)
+        (triangle,) = self.segment_triangles[other_segment]
+        self.triangle_segments[triangle] = [
+            segment if s == other_segment else s
+            for s in self.triangle_segments[triangle]
+        ]
+        self.segment_triangles[segment].append(triangle)
+        self.point_segments[point].discard(other_segment)
+        self.point_segments[b].discard(other_segment)
+        self.segment_triangles[other_segment] = []
+
+        # Merge b into a
+        for s in self.point_segments[b]:
+            self.segment_points[s] = [
+                a if p == b else p for p in self.segment_points[s]
+            ]
+        self.point_segments[a] |= self.point_segments[b]
+        self.point_segments[b] = set()
+        self.n_light_cone_crossings[a] += self.n_light_cone_crossings[b]
+        self._removed_points.add(b)
+        self.n_points -= 1
+        return a
+
+    def encode(self):
+        """
+        The triangulation as an EncodedTriangulation, with the removed points
+        and segments dropped and the others relabeled in order
+        """
+        segments = np.array(
+            [len(triangles) > 0 for triangles in self.segment_triangles]
+        )
+        segment_ids = np.cumsum(segments) - 1
+        points = np.ones(len(self.point_segments), dtype=bool)
+        points[list(self._removed_points)] = False
+        point_ids = np.cumsum(points) - 1
+        return EncodedTriangulation(
+            int(points.sum()),
+            point_ids[np.array(self.segment_points)[segments]].astype(
+                np.int32
+            ),
+            np.array(self.segment_types, dtype=np.int8)[segments],
+            segment_ids[np.array(self.triangle_segments)].astype(np.int32),
+        )
+
+    def _add_point(self, n_light_cone_crossings):
+        self.point_segments.append(set())
+        self.n_light_cone_crossings.append(n_light_cone_crossings)
+        self.n_points += 1
+        return len(self.point_segments) - 1
+
+    def _add_segment(self, p0, p1, segment_type):
+        segment = len(self.segment_points)
+        self.segment_points.append([p0, p1])
+        self.segment_types.append(segment_type)
+        self.segment_triangles.append([])
+        self.point_segments[p0].add(segment)
+        self.point_segments[p1].add(segment)
+        self._boundary_positions[segment] = len(self._boundary_segments)
+        self._boundary_segments.append(segment)
+        return segment
+
+    def _add_triangle(self, segments):
+        triangle = len(self.triangle_segments)
+        self.triangle_segments.append(segments)
+        for segment in segments:
+            self.segment_triangles[segment].append(triangle)
+            if len(self.segment_triangles[segment]) == 2:
+                self._remove_boundary_segment(segment)
+
+    def _remove_boundary_segment(self, segment):
+        # Swap with the last boundary segment, for constant time removal
+        position = self._boundary_positions.pop(segment)
+        last_segment = self._boundary_segments.pop()
+        if last_segment != segment:
+            self._boundary_segments[position] = last_segment
+            self._boundary_positions[last_segment] = position
+
+    def _other_point(self, segment, point):
+        p0, p1 = self.segment_points[segment]
+        return p1 if p0 == point else p0
+
+    def _are_neighbours(self, point, other_point):
+        return any(
+            other_point in self.segment_points[segment]
+            for segment in self.point_segments[point]
+        )
+
+
+def generate_triangulation(n_points, seed=None, close_probability=0.5):
+    """
+    Grows a random triangulation with at least n_points points from a random
+    base triangle, see TriangulationGenerator. Every step either closes a
+    boundary point whose light cone is complete, with close_probability, or
+    glues a new triangle to a random boundary segment.
+
+    Parameters
+    ----------
+    n_points: int
+    seed: int
+    close_probability: float
+        Probability of closing a point when possible, the larger the more
+        internal points
+
+    Returns
+    -------
+    triangulation: dgl.DGLHeteroGraph
+        The triangulation with all the node data of the environment
+    """
+    rng = np.random.default_rng(seed)
+    generator = TriangulationGenerator(
+        TSS_SEGMENT_TYPES if rng.random() < 0.5 else STT_SEGMENT_TYPES
+    )
+    # Boundary points whose light cone may be complete
+    closable_points = set()
+    while generator.n_points < n_points:
+        if closable_points and rng.random() < close_probability:
+            point = closable_points.pop()
+            if generator.closable_segments(point) is not None:
+                merged_point = generator.close_point(point)
+                closable_points.add(merged_point)
+            continue
+
+        boundary_segments = generator.boundary_segments
+        segment = boundary_segments[rng.integers(len(boundary_segments))]
+        options = generator.triangle_options(segment)
+        if not options:
+            continue
+        u1, u2 = options[rng.integers(len(options))]
+        generator.add_triangle(segment, u1, u2)
+        closable_points.update(generator.segment_points[segment])
+    return decode_triangulations([generator.encode()])
@@ -0,0 +1,190 @@
+import dgl
+import numpy as np
+
+from core.policy_network import N_ANGLE_TYPES
+
+# Number of Weisfeiler-Lehman refinements of the node colors, i.e. the radius
+# of the neighbourhood every color summarizes
+N_ITERATIONS = 4
+
+# Node features used as the initial colors, which do not depend on the node
+# labels. Points start with the same color and are told apart by refinement
+INVARIANT_FEATURES = {
+    "angle": ("angle_type",),
+    "point": (),
+    "segment": ("segment_type",),
+    "triangle": ("triangle_type",),
+}
+
+
+def hash_triangulations(triangulations, n_iterations=N_ITERATIONS):
+    """
+    Weisfeiler-Lehman hash of each triangulation of a batch, invariant to the
+    relabeling of its nodes. Every iteration, the color of a node is mixed
+    with the sum of the mixed colors of its neighbours along every edge type
+    and direction, so a hash costs O(n_iterations * n_edges).
+
+    Isomorphic triangulations always have the same hash. Non-isomorphic
+    triangulations that the refinement cannot tell apart share their hash
+    too, which does not happen for the triangulations of the environment in
+    practice, besides 64 bit collisions.
+
+    Parameters
+    ----------
+    triangulations: dgl.DGLHeteroGraph
+        Batched triangulations, with the node data of the environment
+    n_iterations: int
+
+    Returns
+    -------
+    hashes: np.ndarray
+        Array of shape (batch_size, ) of uint64 hashes
+    """
+    colors = {
+        ntype: _initial_colors(triangulations, ntype)
+        for ntype in triangulations.ntypes
+    }
+    edges = {
+        etype: [ids.numpy() for ids in triangulations.edges(etype=etype)]
+        for etype in triangulations.canonical_etypes
+    }
+    for _ in range(n_iterations):
+        aggregates = {
+            ntype: np.zeros_like(ntype_colors)
+            for ntype, ntype_colors in colors.items()
+        }
+        for salt, ((src_type, _, dst_type), (src, dst)) in enumerate(
+            edges.items()
+        ):
+            # Messages in both directions, salted by edge type and direction
+            np.add.at(
+                aggregates[dst_type],
+                dst,
+                _mix(colors[src_type][src] ^ np.uint64(2 * salt + 1)),
+            )
+            np.add.at(
+                aggregates[src_type],
+                src,
+                _mix(colors[dst_type][dst] ^ np.uint64(2 * salt + 2)),
+            )
+        colors = {
+            ntype: _mix(_mix(ntype_colors) ^ aggregates[ntype])
+            for ntype, ntype_colors in colors.items()
+        }
+
+    hashes = np.zeros(triangulations.batch_size, dtype=np.uint64)
+    for ntype in sorted(colors):
+        graph_ids = np.repeat(
+            np.arange(triangulations.batch_size),
+            triangulations.batch_num_nodes(ntype).numpy(),
+        )
+        ntype_hashes = np.zeros(triangulations.batch_size, dtype=np.uint64)
+        np.add.at(ntype_hashes, graph_ids, _mix(colors[ntype]))
+        hashes = _mix(hashes ^ ntype_hashes)
+    return hashes
+
+
+def deduplicate_triangulations(triangulations, n_iterations=N_ITERATIONS):
+    """
+    Groups the isomorphic triangulations of a batch
+
+    Returns
+    -------
+    Tuple:
+        unique_indices: np.ndarray
+            Index of the first triangulation of each group
+        inverse: np.ndarray
+            Group of each triangulation
+        counts: np.ndarray
+            Number of triangulations of each group
+    """
+    _, unique_indices, inverse, counts = np.unique(
+        hash_triangulations(triangulations, n_iterations),
+        return_index=True,
+        return_inverse=True,
+        return_counts=True,
+    )
+    return unique_indices, inverse, counts
+
+
+class TriangulationMemo:
+    """
+    Memoizes a function of triangulations by their hash, so it is evaluated
+    once per isomorphism class. The values must not depend on the node
+    labels, e.g. log rewards or triangulation logits, but not point logits.
+
+    Can replace a log_reward_fn directly:
+        log_reward_fn = TriangulationMemo(log_reward)
+        trainer = TrajectoryBalanceTrainer(agent, log_reward_fn)
+
+    Parameters
+    ----------
+    fn: Callable[[dgl.DGLHeteroGraph], Any]
+        Function of a single triangulation
+    n_iterations: int
+        Number of refinements of the hash, see hash_triangulations
+    """
+
+    def __init__(self, fn, n_iterations=N_ITERATIONS):
+        self.fn = fn
+        self.n_iterations = n_iterations
+        self.hits = 0
+        self.misses = 0
+        self._values = {}
+
+    def __len__(self):
+        return len(self._values)
+
+    def __call__(self, triangulation):
+        return self.map(triangulation)[0]
+
+    def map(self, triangulations):
+        """
+        Values of every triangulation of a batch, calling fn once for each
+        isomorphism class without a memoized value
+
+        Returns
+        -------
+        values: List
+        """
+        hashes = hash_triangulations(triangulations, self.n_iterations)
+        for index, key in enumerate(hashes.tolist()):
+            if key in self._values:
+                self.hits += 1
+                continue
+            self.misses += 1
+            self._values[key] = self.fn(
+                triangulations
+                if triangulations.batch_size == 1
+                else dgl.slice_batch(triangulations, index)
+            )
+        return [self._values[key] for key in hashes.tolist()]
+
+
+def _initial_colors(triangulations, ntype):
+    colors = np.full(
+        triangulations.num_nodes(ntype),
+        sorted(triangulations.ntypes).index(ntype),
+        dtype=np.uint64,
+    )
+    for feature in INVARIANT_FEATURES.get(ntype, ()):
+        values = triangulations.nodes[ntype].data[feature].numpy()
+        if feature == "angle_type" and values.ndim == 1:
+            # Angle type codes of compact storage, see compact_node_data
+            values = np.eye(N_ANGLE_TYPES)[values]
+        values = np.rint(values.reshape(len(colors), -1)).astype(np.int64)
+        for column in values.T:
+            colors = _mix(colors ^ column.view(np.uint64))
+    return colors
+
+
+def _mix(values):
+    """splitmix64 finalizer, a bijective mixing of uint64 values"""
+    values = values + np.uint64(0x9E3779B97F4A7C15)
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(
+        0xBF58476D1CE4E5B9
+    )
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(
+        0x94D049BB133111EB
+    )
+    return values ^ (values >> np.uint64(31))
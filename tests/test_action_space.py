@@ -0,0 +1,65 @@
+import dgl
+import numpy as np
+import tensorflow as tf
+
+from core.action_space import (
+    NEW_POINT,
+    build_action_space,
+    calculate_action_logits,
+    get_action,
+)
+from core.agent import _calculate_segment_pair_logits
+from core.environment import TERMINATE_ACTION
+from core.policy_network import HeteroGraphPolicyNetwork
+from core.trainer import _get_action_candidates
+
+
+def _expected_new_triangle_pair_logits(point_logits, endpoint_pair):
+    # The points of the new triangle have no logits yet and are taken as 0
+    point_logits = point_logits.numpy()[:, 0]
+    a0, a1 = endpoint_pair.numpy().T
+    seg_pair_logits = -np.abs(
+        np.tanh(point_logits[a0]) + np.tanh(point_logits[a1])
+    )
+    return seg_pair_logits[:, None].astype(np.float32)
+
+
+def test_action_space_indexes_the_endpoint_pair_combinations():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    triangulations = dgl.batch([triangulation] * 2)
+    combinations = _get_action_candidates(triangulations)
+    point_logits, _ = HeteroGraphPolicyNetwork()(triangulations)
+
+    action_space = build_action_space(combinations, 2)
+    action_logits = calculate_action_logits(action_space, point_logits)
+
+    n_pairs = [len(pairs) for pairs in combinations]
+    assert len(action_logits) == sum(n_pairs) + 2
+    offsets = np.cumsum([0] + n_pairs)
+    for action_type, pairs in enumerate(combinations):
+        if action_type < 2:
+            logits = _calculate_segment_pair_logits(point_logits, pairs[:, 1:])
+        else:
+            logits = _expected_new_triangle_pair_logits(
+                point_logits, pairs[:, 1:]
+            )
+        start, end = offsets[action_type], offsets[action_type + 1]
+        tf.debugging.assert_near(action_logits[start:end], logits[:, 0])
+        for index in [start, end - 1]:
+            chosen_type, points = get_action(action_space, index)
+            assert chosen_type == action_type
+            np.testing.assert_array_equal(points, pairs[index - start, 1:])
+        # The ranks restart in each triangulation
+        ranks = action_space.ranks[start:end].numpy()
+        graph_ids = action_space.graph_ids[start:end].numpy()
+        for graph in range(2):
+            np.testing.assert_array_equal(
+                ranks[graph_ids == graph],
+                np.arange(np.sum(graph_ids == graph)),
+            )
+
+    # Terminating comes last, without points
+    assert get_action(action_space, -1) == (TERMINATE_ACTION, None)
+    np.testing.assert_array_equal(action_space.point_indices[-2:], NEW_POINT)
+    np.testing.assert_array_equal(action_logits[-2:], 0)
+    assert bool(tf.reduce_all(action_space.has_actions[:, TERMINATE_ACTION]))
@@ -0,0 +1,63 @@
+import dgl
+import numpy as np
+import tensorflow as tf
+
+from core.agent import (
+    _calculate_batched_segment_pair_probabilities,
+    _calculate_segment_pair_probabilities,
+)
+from core.endpoint_pair_combinations import extract_endpoint_pair_combinations
+from core.sparse_endpoint_pair_combinations import (
+    extract_batched_endpoint_pair_combinations,
+)
+
+
+def _expected_segment_pair_probabilities(point_logits, segment_pair):
+    point_logits = point_logits.numpy()[:, 0]
+    a0, a1, b0, b1 = segment_pair.numpy().T
+    seg_pair_logits = -np.abs(
+        np.tanh(point_logits[a0] - point_logits[b0])
+        + np.tanh(point_logits[a1] - point_logits[b1])
+    )
+    probabilities = np.exp(seg_pair_logits) / np.exp(seg_pair_logits).sum()
+    return probabilities[:, None].astype(np.float32)
+
+
+def test_segment_pair_probabilities():
+    tf.random.set_seed(1337)
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    segment_pair = extract_endpoint_pair_combinations(triangulation)[0]
+    point_logits = tf.random.normal((triangulation.num_nodes("point"), 1))
+
+    probabilities = _calculate_segment_pair_probabilities(
+        point_logits, segment_pair
+    )
+
+    tf.debugging.assert_near(
+        probabilities,
+        _expected_segment_pair_probabilities(point_logits, segment_pair),
+    )
+
+
+def test_batched_segment_pair_probabilities_normalize_per_triangulation():
+    tf.random.set_seed(42)
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    triangulations = dgl.batch([triangulation] * 3)
+    segment_pairs = extract_batched_endpoint_pair_combinations(triangulations)[
+        1
+    ]
+    point_logits = tf.random.normal((triangulations.num_nodes("point"), 1))
+
+    probabilities = _calculate_batched_segment_pair_probabilities(
+        point_logits, segment_pairs, 3
+    )
+
+    for graph in range(3):
+        is_in_graph = tf.math.equal(segment_pairs[:, 0], graph)
+        tf.debugging.assert_near(
+            tf.boolean_mask(probabilities, is_in_graph),
+            _expected_segment_pair_probabilities(
+                point_logits,
+                tf.boolean_mask(segment_pairs, is_in_graph)[:, 1:],
+            ),
+        )
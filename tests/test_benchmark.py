@@ -0,0 +1,39 @@
+from benchmarks.benchmark import (
+    check_report,
+    run_benchmarks,
+    run_rollout_benchmark,
+)
+
+
+def test_report_flags_regressions():
+    report = run_benchmarks(
+        sizes=[4, 8], benchmarks=["environment_step"], n_repeats=2
+    )
+    results = report["results"]
+    assert [result["n_points"] for result in results] == [4, 8]
+    assert all(result["median_seconds"] > 0 for result in results)
+
+    assert check_report(report, {}) == []
+    # A baseline ten times as fast as the report
+    baseline = {
+        "results": [
+            {**result, "median_seconds": result["median_seconds"] / 10}
+            for result in results
+        ]
+    }
+    violations = check_report(
+        report,
+        {"environment_step": {"max_scaling_exponent": -100.0}},
+        baseline,
+    )
+    assert len(violations) == 3
+
+
+def test_rollout_benchmark_reports_throughput():
+    results = run_rollout_benchmark(
+        n_workers=[1], n_trajectories=2, n_envs=2, max_steps=2
+    )
+    assert [result["n_workers"] for result in results] == [1]
+    assert results[0]["trajectories_per_second"] > 0
+    assert results[0]["speedup"] == results[0]["efficiency"] == 1.0
+    assert results[0]["bytes_per_trajectory"] > 0
@@ -0,0 +1,58 @@
+from collections import defaultdict
+from copy import deepcopy
+
+import dgl
+import tensorflow as tf
+
+from core.endpoint_pair_combination_index import (
+    NEW_ENDPOINT_PAIR_TYPES,
+    EndpointPairCombinationIndex,
+)
+from core.endpoint_pair_combinations import extract_endpoint_pair_combinations
+
+
+def _recompute_from_scratch(index):
+    index = deepcopy(index)
+    index._current_pair_combos = [defaultdict(set), defaultdict(set)]
+    index._matched_by = [defaultdict(set), defaultdict(set)]
+    index._new_tri_pair_combos = [set() for _ in NEW_ENDPOINT_PAIR_TYPES]
+    index._lower_endpts_by_crossings = [defaultdict(set), defaultdict(set)]
+    for segment_type in range(2):
+        for endpts in index._get_lower_endpts_of_points(
+            segment_type, list(index._valid_neighbors[segment_type].keys())
+        ):
+            index._add_to_bucket(segment_type, endpts)
+    index._revalidate(list(index._boundary_segments_at_pt.keys()))
+    return index.combinations()
+
+
+def _assert_same_pairs(combinations, expected):
+    for pairs, expected_pairs in zip(combinations, expected):
+        tf.debugging.assert_equal(
+            pairs, tf.reshape(expected_pairs, (-1, pairs.shape[1]))
+        )
+
+
+def test_index_matches_extracted_combinations():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    index = EndpointPairCombinationIndex(triangulation)
+
+    _assert_same_pairs(
+        index.combinations(),
+        extract_endpoint_pair_combinations(triangulation),
+    )
+
+
+def test_incremental_updates_match_recomputed_combinations():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    index = EndpointPairCombinationIndex(triangulation)
+
+    for action_type in [0, 3, 1, 4, 2, 5]:
+        pairs = index.combinations()[action_type]
+        if action_type < 2:
+            index.glue_segments(action_type, pairs[0])
+        else:
+            index.add_triangle(action_type, pairs[-1])
+        _assert_same_pairs(
+            index.combinations(), _recompute_from_scratch(index)
+        )
@@ -1,7 +1,15 @@
 import dgl
+import pytest
 import tensorflow as tf
 
-from core.endpoint_pair_combinations import extract_endpoint_pair_combinations
+from core.endpoint_pair_combinations import (
+    POINT_PAIR_BYTES,
+    _compiled_extract_endpoint_pair_combinations,
+    extract_compiled_endpoint_pair_combinations,
+    extract_endpoint_pair_combinations,
+)
+from core.environment import TriangulationEnvironment
+from core.triangulation_generator import generate_triangulation
 
 
 def test():
@@ -29,3 +37,63 @@ def test0():
     policy = HeteroGraphPolicyNetwork()
     point_logits, triangulation_logits = policy(triangulation)
     point_logits
+
+
+def test_compiled_matches_eager_extraction():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+
+    combinations = extract_endpoint_pair_combinations(triangulation)
+    compiled_combinations = extract_compiled_endpoint_pair_combinations(
+        triangulation
+    )
+
+    for pairs, expected_pairs in zip(compiled_combinations, combinations):
+        tf.debugging.assert_equal(pairs, expected_pairs)
+
+
+def test_chunked_matches_dense_extraction():
+    for triangulation in [
+        dgl.load_graphs("./data/test_triangulation")[0][0],
+        generate_triangulation(64, seed=0),
+    ]:
+        combinations = extract_endpoint_pair_combinations(triangulation)
+        for chunked_combinations in [
+            extract_endpoint_pair_combinations(triangulation, chunk_size=1),
+            extract_endpoint_pair_combinations(triangulation, chunk_size=7),
+            extract_endpoint_pair_combinations(
+                triangulation, max_peak_bytes=2**19
+            ),
+        ]:
+            for pairs, expected_pairs in zip(
+                chunked_combinations, combinations
+            ):
+                tf.debugging.assert_equal(pairs, expected_pairs)
+
+
+def test_max_peak_bytes_below_point_pair_tensors_is_rejected():
+    triangulation = generate_triangulation(64, seed=0)
+    n_points = triangulation.num_nodes("point")
+
+    with pytest.raises(ValueError):
+        extract_endpoint_pair_combinations(
+            triangulation,
+            max_peak_bytes=POINT_PAIR_BYTES * (n_points + 3) * n_points,
+        )
+
+
+def test_compiled_extraction_is_traced_once_per_bucket():
+    environment = TriangulationEnvironment()
+    tss_triangle = environment.tss_triangle
+    stt_triangle = environment.stt_triangle
+
+    compiled_extractor = _compiled_extract_endpoint_pair_combinations
+
+    extract_compiled_endpoint_pair_combinations(tss_triangle)
+    n_traces = compiled_extractor.experimental_get_tracing_count()
+    combinations = extract_compiled_endpoint_pair_combinations(stt_triangle)
+
+    assert compiled_extractor.experimental_get_tracing_count() == n_traces
+    for pairs, expected_pairs in zip(
+        combinations, extract_endpoint_pair_combinations(stt_triangle)
+    ):
+        tf.debugging.assert_equal(pairs, expected_pairs)
@@ -1,6 +1,22 @@
+import dgl
 import tensorflow as tf
 
-from core.environment import TriangulationEnvironment
+from core.endpoint_pair_combinations import extract_endpoint_pair_combinations
+from core.profiling import _nbytes
+from core.sparse_endpoint_pair_combinations import (
+    extract_batched_endpoint_pair_combinations,
+)
+from core.triangulation_hash import hash_triangulations
+from core.environment import (
+    COMPACT_NODE_DATA_DTYPES,
+    TERMINATE_ACTION,
+    TriangulationEnvironment,
+    VecTriangulationEnvironment,
+    compact_node_data,
+    _create_triangle_data,
+    _get_base_triangle,
+    _update_triangulation_data,
+)
 
 #
 # def test_reset_gives_one_complete_triangle():
@@ -67,3 +83,221 @@ from core.environment import TriangulationEnvironment
 #
 #     tf.assert_equal(segment_data, expected_segment_data)
 #     tf.assert_equal(point_data, expected_point_data)
+
+
+def test_compact_storage_steps_like_float_storage():
+    vec_environments = [
+        VecTriangulationEnvironment(3, compact_storage=compact_storage)
+        for compact_storage in (False, True)
+    ]
+    all_states = []
+    for vec_environment in vec_environments:
+        tf.random.set_seed(1337)
+        all_states.append(vec_environment.reset())
+
+    for action_types in [[2, 3, 4], [5, 2, 3], [3, 4, 5], [0, 1, 2]]:
+        all_combinations = [
+            extract_batched_endpoint_pair_combinations(states)
+            for states in all_states
+        ]
+        for pairs, compact_pairs in zip(*all_combinations):
+            tf.debugging.assert_equal(compact_pairs, pairs)
+        actions = []
+        for graph, action_type in enumerate(action_types):
+            pairs = all_combinations[0][action_type]
+            pairs = tf.boolean_mask(pairs, tf.math.equal(pairs[:, 0], graph))
+            if pairs.shape[0] == 0:
+                actions.append((TERMINATE_ACTION, None))
+                continue
+            actions.append((action_type, pairs[0, 1:]))
+        all_states = [
+            vec_environment.step(actions)[0]
+            for vec_environment in vec_environments
+        ]
+
+        states, compact_states = all_states
+        node_data = {
+            ntype: states.nodes[ntype].data for ntype in states.ntypes
+        }
+        expected = compact_node_data(node_data)
+        for ntype, data in expected.items():
+            for key, value in data.items():
+                compact_value = compact_states.nodes[ntype].data[key]
+                assert (
+                    compact_value.dtype == COMPACT_NODE_DATA_DTYPES[ntype][key]
+                )
+                tf.debugging.assert_equal(compact_value, value)
+        assert _nbytes(expected) < _nbytes(node_data) / 3
+        assert (
+            hash_triangulations(compact_states).tolist()
+            == hash_triangulations(states).tolist()
+        )
+
+
+def _recompute_triangulation_data(triangulation):
+    graph = dgl.heterograph(
+        {
+            etype: triangulation.edges(etype=etype)
+            for etype in triangulation.canonical_etypes
+        },
+        num_nodes_dict={
+            ntype: triangulation.num_nodes(ntype)
+            for ntype in triangulation.ntypes
+        },
+    )
+    graph.nodes["segment"].data["segment_type"] = triangulation.nodes[
+        "segment"
+    ].data["segment_type"]
+    graph = _create_triangle_data(graph)
+    graph = _update_triangulation_data(graph)
+    return graph
+
+
+def _assert_same_triangulation_data(triangulation, expected):
+    for ntype in expected.ntypes:
+        for key, value in expected.nodes[ntype].data.items():
+            tf.debugging.assert_equal(
+                triangulation.nodes[ntype].data[key], value
+            )
+
+
+def test_reset_clones_stored_base_triangles():
+    environment = TriangulationEnvironment()
+    other_environment = TriangulationEnvironment()
+    assert environment.tss_triangle is other_environment.tss_triangle
+    assert environment.stt_triangle is other_environment.stt_triangle
+
+    state = environment.reset()
+    template = _get_base_triangle(
+        tuple(state.nodes["segment"].data["segment_type"].numpy().tolist())
+    )
+    assert state is not template
+    expected_boundary = template.nodes["segment"].data["boundary"]
+
+    state.nodes["segment"].data["boundary"] = tf.zeros(3)
+    state.add_nodes(1, ntype="point")
+
+    assert template.num_nodes("point") == 3
+    tf.debugging.assert_equal(
+        template.nodes["segment"].data["boundary"], expected_boundary
+    )
+    _assert_same_triangulation_data(
+        template, _recompute_triangulation_data(template)
+    )
+
+
+def test_step_adding_triangle_appends_glued_triangle():
+    environment = TriangulationEnvironment()
+    state = environment.reset()
+    endpoint_pairs = extract_endpoint_pair_combinations(state)[2][0]
+
+    new_state, done = environment.step((2, endpoint_pairs))
+
+    assert not done
+    assert new_state.num_nodes("triangle") == 2
+    assert new_state.num_nodes("angle") == 6
+    assert new_state.num_nodes("segment") == 5
+    assert new_state.num_nodes("point") == 4
+    tf.debugging.assert_equal(
+        tf.reduce_sum(new_state.nodes["segment"].data["boundary"]), 4.0
+    )
+    _assert_same_triangulation_data(
+        new_state, _recompute_triangulation_data(new_state)
+    )
+
+
+def test_step_keeps_data_and_combinations_consistent():
+    tf.random.set_seed(1337)
+    environment = TriangulationEnvironment(combination_index=True)
+    state = environment.reset()
+
+    for action_type in [3, 5, 2, 4, 3, 2, 0, 1]:
+        combinations = extract_endpoint_pair_combinations(state)
+        indexed_combinations = environment.combinations()
+        assert environment.combinations() is indexed_combinations
+        for pairs, expected_pairs in zip(indexed_combinations, combinations):
+            tf.debugging.assert_equal(
+                pairs, tf.reshape(expected_pairs, (-1, pairs.shape[1]))
+            )
+        pairs = combinations[action_type]
+        if pairs.shape[0] == 0:
+            continue
+        state, _ = environment.step((action_type, pairs[0]))
+        _assert_same_triangulation_data(
+            state, _recompute_triangulation_data(state)
+        )
+
+
+def test_step_terminates():
+    environment = TriangulationEnvironment()
+    state = environment.reset()
+
+    new_state, done = environment.step((TERMINATE_ACTION, None))
+
+    assert done
+    assert new_state is state
+
+
+def test_vec_step_matches_single_steps():
+    tf.random.set_seed(1337)
+    vec_environment = VecTriangulationEnvironment(3)
+    states = vec_environment.reset()
+    environments = []
+    for state in dgl.unbatch(states):
+        environment = TriangulationEnvironment()
+        environment.state = state
+        environments.append(environment)
+
+    for action_types in [[2, 3, 4], [5, 2, 3], [3, 4, 5], [0, 1, 2]]:
+        combinations = extract_batched_endpoint_pair_combinations(states)
+        point_offsets = tf.math.cumsum(
+            states.batch_num_nodes("point"), exclusive=True
+        )
+        actions = []
+        for graph, action_type in enumerate(action_types):
+            pairs = combinations[action_type]
+            pairs = tf.boolean_mask(pairs, tf.math.equal(pairs[:, 0], graph))
+            if pairs.shape[0] == 0:
+                actions.append((TERMINATE_ACTION, None))
+                continue
+            actions.append((action_type, pairs[0, 1:]))
+            environments[graph].step(
+                (action_type, pairs[0, 1:] - point_offsets[graph])
+            )
+        states, dones, _ = vec_environment.step(actions)
+
+        for graph, state in enumerate(dgl.unbatch(states)):
+            if dones[graph]:
+                assert state.num_nodes("triangle") == 1
+                environments[graph].state = state
+                continue
+            expected = environments[graph].state
+            for etype in expected.canonical_etypes:
+                for ids, expected_ids in zip(
+                    state.edges(etype=etype), expected.edges(etype=etype)
+                ):
+                    tf.debugging.assert_equal(ids, expected_ids)
+            _assert_same_triangulation_data(state, expected)
+
+
+def test_vec_step_resets_terminated_triangulations():
+    tf.random.set_seed(42)
+    vec_environment = VecTriangulationEnvironment(2)
+    states = vec_environment.reset()
+    pairs = extract_batched_endpoint_pair_combinations(states)[2]
+    pairs = tf.boolean_mask(pairs, tf.math.equal(pairs[:, 0], 1))
+
+    states, dones, terminal_states = vec_environment.step(
+        [(TERMINATE_ACTION, None), (2, pairs[0, 1:])]
+    )
+
+    tf.debugging.assert_equal(dones, tf.constant([True, False]))
+    assert len(terminal_states) == 1
+    assert terminal_states[0].num_nodes("triangle") == 1
+    tf.debugging.assert_equal(
+        states.batch_num_nodes("triangle"),
+        tf.constant([1, 2], dtype=tf.int64),
+    )
+    _assert_same_triangulation_data(
+        states, _recompute_triangulation_data(states)
+    )
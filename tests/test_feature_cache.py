@@ -0,0 +1,49 @@
+import dgl
+import tensorflow as tf
+
+from core.environment import TriangulationEnvironment
+from core.feature_cache import FeatureCache
+from core.policy_network import HeteroGraphPolicyNetwork
+from core.trainer import _get_action_candidates
+
+
+def test_cache_evicts_least_recently_used_values():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    environment = TriangulationEnvironment()
+    feature_cache = FeatureCache(max_size=2)
+
+    def n_nodes(state, ntype):
+        return state.num_nodes(ntype)
+
+    for ntype in ["point", "segment", "point", "triangle", "segment"]:
+        feature_cache.get_or_compute(triangulation, "n_nodes", n_nodes, ntype)
+    value = feature_cache.get_or_compute(
+        environment.tss_triangle, "n_nodes", n_nodes, "point"
+    )
+
+    assert value == 3
+    assert len(feature_cache) == 2
+    assert (feature_cache.hits, feature_cache.misses) == (1, 5)
+
+
+def test_shared_cache_hits_for_repeated_states():
+    feature_cache = FeatureCache()
+    environment = TriangulationEnvironment(feature_cache)
+    policy_network = HeteroGraphPolicyNetwork(feature_cache=feature_cache)
+    tss_triangle = environment.tss_triangle
+
+    for _ in range(2):
+        environment.state = tss_triangle
+        policy_network(tss_triangle)
+        pairs = _get_action_candidates(tss_triangle, feature_cache)[2]
+        next_state, _ = environment.step((2, pairs[0, 1:]))
+        next_state.nodes["segment"].data["boundary"] = tf.zeros(5)
+
+    # The features, the candidates and the transition are computed once
+    assert (feature_cache.hits, feature_cache.misses) == (4, 4)
+    # The cached next state is left untouched by the changes of the clones
+    environment.state = tss_triangle
+    next_state, _ = environment.step((2, pairs[0, 1:]))
+    tf.debugging.assert_equal(
+        tf.reduce_sum(next_state.nodes["segment"].data["boundary"]), 4.0
+    )
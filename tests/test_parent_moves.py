@@ -0,0 +1,358 @@
+import dgl
+import numpy as np
+import tensorflow as tf
+
+from core.agent import Agent
+from core.environment import (
+    TriangulationEnvironment,
+    _create_triangle_data,
+    _update_triangulation_data,
+)
+from core.parent_moves import (
+    count_parent_moves,
+    extract_batched_parent_moves,
+    uniform_log_backward_prob,
+)
+from core.trainer import TrajectoryBalanceTrainer, _get_action_candidates
+from core.triangulation_generator import generate_triangulation
+from core.triangulation_hash import hash_triangulations
+
+
+def _get_edges(triangulation):
+    return {
+        etype: [inds.numpy() for inds in triangulation.edges(etype=etype)]
+        for etype in triangulation.canonical_etypes
+    }
+
+
+def _build_triangulation(edges, num_nodes, segment_type):
+    triangulation = dgl.heterograph(
+        {
+            etype: tuple(tf.constant(inds, dtype=tf.int32) for inds in uv)
+            for etype, uv in edges.items()
+        },
+        num_nodes_dict=num_nodes,
+    )
+    triangulation.nodes["segment"].data["segment_type"] = tf.constant(
+        segment_type, dtype=tf.float32
+    )
+    return _update_triangulation_data(_create_triangle_data(triangulation))
+
+
+def _cut_segment(triangulation, segment, split_points):
+    """
+    Cuts an internal segment open, splitting its endpoints in split_points in
+    two. The new points come first, so that gluing the two segments again
+    merges them into the old points, and the two segments come first, so
+    that they are glued rather than parallel boundary segments.
+    """
+    edges = _get_edges(triangulation)
+    seg_in_tri = ("segment", "segment_in_triangle", "triangle")
+    has_point = ("segment", "segment_has_point", "point")
+    bounds_angle = ("segment", "segment_bounds_angle", "angle")
+    angle_at_point = ("angle", "angle_at_point", "point")
+    contains_angle = ("triangle", "triangle_contains_angle", "angle")
+    n_points = triangulation.num_nodes("point")
+    new_segment = triangulation.num_nodes("segment")
+
+    # The second triangle of the segment moves to the new segment
+    seg_inds, tri_inds = edges[seg_in_tri]
+    triangle = tri_inds[seg_inds == segment][1]
+    seg_inds[(seg_inds == segment) & (tri_inds == triangle)] = new_segment
+    tri_of_angle, angle_of_tri = edges[contains_angle]
+    angles = angle_of_tri[tri_of_angle == triangle]
+    bounding_segs, bounded_angles = edges[bounds_angle]
+    bounding_segs[
+        (bounding_segs == segment) & np.isin(bounded_angles, angles)
+    ] = new_segment
+
+    seg_of_pt, pt_of_seg = edges[has_point]
+    angle_inds, pt_inds = edges[angle_at_point]
+    endpts = pt_of_seg[seg_of_pt == segment]
+    new_endpts = endpts.copy()
+    n_new_points = 0
+    for k in np.flatnonzero(np.isin(endpts, split_points)):
+        # The angles at the endpoint on the side of the new segment, which
+        # are joined through the segments other than the cut one
+        angles_at_pt = angle_inds[pt_inds == endpts[k]]
+        side = np.intersect1d(angles_at_pt, angles)
+        while True:
+            side_segs = np.setdiff1d(
+                bounding_segs[np.isin(bounded_angles, side)],
+                [segment, new_segment],
+            )
+            grown = np.intersect1d(
+                angles_at_pt,
+                np.union1d(
+                    side, bounded_angles[np.isin(bounding_segs, side_segs)]
+                ),
+            )
+            if len(grown) == len(side):
+                break
+            side = grown
+        new_point = n_points + n_new_points
+        pt_inds[np.isin(angle_inds, side)] = new_point
+        pt_of_seg[np.isin(seg_of_pt, side_segs) & (pt_of_seg == endpts[k])] = (
+            new_point
+        )
+        new_endpts[k] = new_point
+        n_new_points += 1
+    edges[has_point] = [
+        np.append(seg_of_pt, [new_segment, new_segment]),
+        np.append(pt_of_seg, new_endpts),
+    ]
+    for etype in [has_point, angle_at_point]:
+        points = edges[etype][1]
+        edges[etype][1] = np.where(
+            points >= n_points, points - n_points, points + n_new_points
+        )
+
+    segments = np.arange(new_segment + 1)
+    segment_order = np.concatenate(
+        [
+            [segment, new_segment],
+            np.setdiff1d(segments, [segment, new_segment]),
+        ]
+    )
+    segment_labels = np.argsort(segment_order)
+    for etype in [seg_in_tri, has_point, bounds_angle]:
+        edges[etype][0] = segment_labels[edges[etype][0]]
+
+    num_nodes = {
+        ntype: triangulation.num_nodes(ntype) for ntype in triangulation.ntypes
+    }
+    num_nodes["point"] += n_new_points
+    num_nodes["segment"] += 1
+    segment_type = triangulation.nodes["segment"].data["segment_type"]
+    return _build_triangulation(
+        edges,
+        num_nodes,
+        np.append(segment_type.numpy(), segment_type.numpy()[segment])[
+            segment_order
+        ],
+    )
+
+
+def _remove_triangle(triangulation, triangle, segment, apex):
+    """Removes a triangle with its apex, leaving the segment on the boundary"""
+    _, tri_inds = triangulation.edges(etype="segment_in_triangle")
+    seg_inds, _ = triangulation.edges(etype="segment_in_triangle")
+    segments = seg_inds.numpy()[tri_inds.numpy() == triangle]
+    tri_of_angle, angle_inds = triangulation.edges(
+        etype="triangle_contains_angle"
+    )
+    parent = dgl.remove_nodes(
+        triangulation,
+        tf.constant(segments[segments != segment], dtype=tf.int32),
+        ntype="segment",
+    )
+    parent = dgl.remove_nodes(
+        parent,
+        tf.constant(
+            angle_inds.numpy()[tri_of_angle.numpy() == triangle],
+            dtype=tf.int32,
+        ),
+        ntype="angle",
+    )
+    parent = dgl.remove_nodes(
+        parent, tf.constant([triangle], dtype=tf.int32), ntype="triangle"
+    )
+    parent = dgl.remove_nodes(
+        parent, tf.constant([apex], dtype=tf.int32), ntype="point"
+    )
+    return _update_triangulation_data(_create_triangle_data(parent))
+
+
+def _is_connected(triangulation):
+    seg_inds, tri_inds = [
+        inds.numpy()
+        for inds in triangulation.edges(etype="segment_in_triangle")
+    ]
+    reached = np.zeros(triangulation.num_nodes("triangle"), dtype=bool)
+    reached[0] = True
+    while True:
+        segments = seg_inds[reached[tri_inds]]
+        grown = reached.copy()
+        grown[tri_inds[np.isin(seg_inds, segments)]] = True
+        if np.array_equal(grown, reached):
+            return bool(np.all(reached))
+        reached = grown
+
+
+def _assert_valid(triangulation):
+    assert _is_connected(triangulation)
+    n_triangles_per_seg = triangulation.out_degrees(
+        etype="segment_in_triangle"
+    ).numpy()
+    assert np.all((n_triangles_per_seg == 1) | (n_triangles_per_seg == 2))
+    seg_inds, pt_inds = triangulation.edges(etype="segment_has_point")
+    boundary = triangulation.nodes["segment"].data["boundary"].numpy()
+    n_boundary_segs = np.bincount(
+        pt_inds.numpy(),
+        weights=boundary[seg_inds.numpy()],
+        minlength=triangulation.num_nodes("point"),
+    )
+    # Every point is internal, or on the boundary between two segments
+    assert np.all((n_boundary_segs == 0) | (n_boundary_segs == 2))
+    n_light_crossings = (
+        triangulation.nodes["point"].data["n_light_cone_angle"].numpy()
+    )
+    assert np.all(n_light_crossings[n_boundary_segs == 0] == 4)
+    assert np.all(n_light_crossings <= 4)
+
+
+def _is_offered(parent, action_type, points, child):
+    """
+    Whether an action of that type on the given points of the parent leads
+    back to the child
+    """
+    environment = TriangulationEnvironment()
+    child_hash = hash_triangulations(child).tolist()
+    for row in _get_action_candidates(parent)[action_type].numpy()[:, 1:]:
+        if not np.all(np.isin(row, points)):
+            continue
+        environment.state = parent
+        try:
+            next_state, _ = environment.step((action_type, row))
+        except ValueError:
+            # The endpoint pairs of a segment paired with itself
+            continue
+        if hash_triangulations(next_state).tolist() == child_hash:
+            return True
+    return False
+
+
+def test_parent_moves_undo_the_actions():
+    triangulation = generate_triangulation(30, seed=0)
+    n_points = triangulation.num_nodes("point")
+    environment = TriangulationEnvironment()
+    combinations = _get_action_candidates(triangulation)
+    n_checked = 0
+    for action_type, pairs in enumerate(combinations):
+        for row in pairs.numpy()[:3, 1:]:
+            environment.state = triangulation
+            next_state, _ = environment.step((action_type, row))
+            cut_segments, removed_triangles = [
+                moves.numpy()
+                for moves in extract_batched_parent_moves(next_state)
+            ]
+            if action_type >= 2:
+                # The apex of the new triangle is the only new point
+                assert np.any(
+                    (removed_triangles[:, 1] == action_type)
+                    & (removed_triangles[:, 4] == n_points)
+                )
+                n_checked += 1
+                continue
+            a0, a1, b0, b1 = row
+            if a0 != b0 and a1 != b1:
+                # b0 and b1 are merged into a0 and a1
+                endpts = [a - (a > b0) - (a > b1) for a in (a0, a1)]
+                assert np.any(
+                    (cut_segments[:, 1] == action_type)
+                    & (cut_segments[:, 3] == min(endpts))
+                    & (cut_segments[:, 4] == max(endpts))
+                )
+                n_checked += 1
+                continue
+            # The closed point p, and the point b merged into a
+            p, a, b = (a0, a1, b1) if a0 == b0 else (a1, a0, b0)
+            assert np.any(
+                (cut_segments[:, 1] == action_type)
+                & (cut_segments[:, 3] == p - (p > b))
+                & (cut_segments[:, 4] == a - (a > b))
+            )
+            n_checked += 1
+    assert n_checked > 0
+
+    # The starting triangle has no parent
+    assert count_parent_moves(environment.tss_triangle).numpy().tolist() == [0]
+
+
+def test_parent_moves_lead_to_valid_parents():
+    environment = TriangulationEnvironment()
+    environment.state = generate_triangulation(12, seed=0)
+    children = []
+    # Gluing time-like segments with four distinct endpoints twice, which
+    # turns the disk into an annulus then a surface with more cycles, and
+    # adding a triangle
+    for action_type in [0, 0, 3]:
+        for row in _get_action_candidates(environment.state)[
+            action_type
+        ].numpy()[:, 1:]:
+            if action_type < 2 and len(set(row)) < 4:
+                continue
+            try:
+                environment.step((action_type, row))
+            except ValueError:
+                continue
+            children.append(environment.state)
+            break
+    assert len(children) == 3
+
+    n_four_distinct = 0
+    for child in children:
+        cut_segments, removed_triangles = [
+            moves.numpy() for moves in extract_batched_parent_moves(child)
+        ]
+        n_points = child.num_nodes("point")
+        boundary = child.nodes["segment"].data["boundary"].numpy()
+        seg_inds, pt_inds = [
+            inds.numpy() for inds in child.edges(etype="segment_has_point")
+        ]
+        is_boundary_point = np.zeros(n_points, dtype=bool)
+        is_boundary_point[pt_inds[boundary[seg_inds] == 1]] = True
+
+        for _, action_type, segment, p0, p1 in cut_segments:
+            split_points = [p for p in (p0, p1) if is_boundary_point[p]]
+            n_four_distinct += int(len(split_points) == 2)
+            parent = _cut_segment(child, segment, split_points)
+            _assert_valid(parent)
+            # The new points come first
+            n_new_points = len(split_points)
+            points = np.concatenate(
+                [np.arange(n_new_points), np.array([p0, p1]) + n_new_points]
+            )
+            assert _is_offered(parent, action_type, points, child)
+
+        for _, action_type, triangle, segment, apex in removed_triangles:
+            parent = _remove_triangle(child, triangle, segment, apex)
+            _assert_valid(parent)
+            endpts = pt_inds[seg_inds == segment]
+            assert _is_offered(
+                parent, action_type, endpts - (endpts > apex), child
+            )
+
+        # The internal segments between two boundary points that are left
+        # out split the triangulation in two when cut
+        for segment in np.flatnonzero(boundary == 0):
+            endpts = pt_inds[seg_inds == segment]
+            if np.all(is_boundary_point[endpts]) and (
+                segment not in cut_segments[:, 2]
+            ):
+                assert not _is_connected(_cut_segment(child, segment, endpts))
+    assert n_four_distinct > 0
+
+
+def test_uniform_log_backward_prob():
+    triangulations = [generate_triangulation(n, seed=n) for n in (3, 10, 30)]
+    n_parent_moves = count_parent_moves(dgl.batch(triangulations))
+    assert n_parent_moves.numpy().tolist() == [
+        int(count_parent_moves(triangulation)[0])
+        for triangulation in triangulations
+    ]
+
+    tf.random.set_seed(0)
+    trainer = TrajectoryBalanceTrainer(
+        Agent(),
+        lambda triangulation: 0.0,
+        log_backward_prob_fn=uniform_log_backward_prob,
+        n_envs=2,
+        max_steps=3,
+    )
+    trajectories = trainer.collect_trajectories(2)
+    for trajectory in trajectories:
+        log_backward_prob = uniform_log_backward_prob(trajectory)
+        assert np.isfinite(log_backward_prob)
+        assert log_backward_prob <= 0.0
+    assert np.isfinite(float(trainer.train_step(trajectories)))
@@ -0,0 +1,58 @@
+import dgl
+import numpy as np
+import tensorflow as tf
+
+from core.point_adjacency import (
+    construct_point_adjacency,
+    get_point_neighbors,
+    get_segment_points,
+)
+from core.triangulation_generator import generate_triangulation
+
+
+def test_point_adjacency_matches_incidence_product():
+    for triangulation in [
+        dgl.load_graphs("./data/test_triangulation")[0][0],
+        generate_triangulation(100, seed=0),
+    ]:
+        n_points = triangulation.num_nodes("point")
+        segment_to_point_adj = tf.sparse.to_dense(
+            tf.sparse.reorder(triangulation.adj(etype="segment_has_point"))
+        )
+        segment_data = triangulation.nodes["segment"].data
+        valid_segments = tf.reshape(segment_data["boundary"], [1, -1]) * (
+            tf.transpose(
+                tf.one_hot(tf.cast(segment_data["segment_type"], tf.int32), 2)
+            )
+        )
+        vseg_to_pt = tf.expand_dims(valid_segments, 2) * segment_to_point_adj
+        expected_adjacency = tf.linalg.matmul(
+            vseg_to_pt, vseg_to_pt, transpose_a=True
+        ) - tf.linalg.diag(tf.reduce_sum(vseg_to_pt, axis=-2))
+
+        segment_points = get_segment_points(triangulation)
+        adjacency = construct_point_adjacency(
+            segment_points, valid_segments, n_points
+        )
+        tf.debugging.assert_equal(adjacency, expected_adjacency)
+
+        # The neighbours in CSR form are the nonzero entries, with their
+        # multiplicity
+        for segment_type in [None, 0, 1]:
+            point_neighbors = get_point_neighbors(triangulation, segment_type)
+            if segment_type is None:
+                dense_adjacency = construct_point_adjacency(
+                    segment_points, tf.ones(len(segment_points)), n_points
+                )
+            else:
+                dense_adjacency = adjacency[segment_type]
+            counts = np.zeros((n_points, n_points))
+            np.add.at(
+                counts,
+                (
+                    point_neighbors.value_rowids().numpy(),
+                    point_neighbors.values.numpy(),
+                ),
+                1,
+            )
+            np.testing.assert_array_equal(counts, dense_adjacency.numpy())
@@ -0,0 +1,80 @@
+import dgl
+import tensorflow as tf
+
+from core.policy_network import (
+    HeteroGraphPolicyNetwork,
+    _get_required_relations,
+    _prepare_local_features,
+    prepare_fused_inputs,
+)
+
+
+def test_fused_call_matches_call():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    triangulation = dgl.batch([triangulation] * 3)
+    policy = HeteroGraphPolicyNetwork()
+
+    point_logits, triangulation_logits = policy(triangulation)
+    fused_point_logits, fused_triangulation_logits = policy.fused_call(
+        prepare_fused_inputs(triangulation)
+    )
+
+    tf.debugging.assert_near(fused_point_logits, point_logits, atol=1e-6)
+    tf.debugging.assert_near(
+        fused_triangulation_logits, triangulation_logits, atol=1e-6
+    )
+
+
+def test_pruned_local_layers_match_full_local_layers():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    policy = HeteroGraphPolicyNetwork()
+    local_features = _prepare_local_features(triangulation)
+
+    point_logits = policy._call_local_layers(triangulation, local_features)
+    hidden = policy.local_layer_1(triangulation, local_features)
+    hidden = policy.local_layer_2(triangulation, hidden)
+    hidden = policy.local_layer_3(triangulation, hidden)
+
+    tf.debugging.assert_equal(point_logits, hidden["point"])
+
+
+def test_required_relations_skip_unreachable_relations():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    canonical_etypes = tuple(triangulation.canonical_etypes)
+
+    required_relations = _get_required_relations(
+        (
+            (
+                "segment_in_triangle",
+                "segment_has_point",
+                "segment_bounds_angle",
+                "angle_at_point",
+            ),
+            ("angle_at_point",),
+        ),
+        canonical_etypes,
+    )
+
+    # The triangle output of the first layer never reaches the points
+    assert required_relations == (
+        tuple(
+            etype
+            for etype in canonical_etypes
+            if etype[1]
+            in ("segment_has_point", "segment_bounds_angle", "angle_at_point")
+        ),
+        tuple(
+            etype for etype in canonical_etypes if etype[1] == "angle_at_point"
+        ),
+    )
+
+
+def test_required_relations_keep_every_relation_of_the_policy():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    policy = HeteroGraphPolicyNetwork()
+
+    required_relations = policy._get_required_relations(
+        tuple(triangulation.canonical_etypes)
+    )
+
+    assert [len(relations) for relations in required_relations] == [5, 2, 1]
@@ -0,0 +1,60 @@
+import json
+
+import dgl
+
+from core.endpoint_pair_combinations import (
+    extract_compiled_endpoint_pair_combinations,
+    extract_endpoint_pair_combinations,
+)
+from core.environment import TriangulationEnvironment
+from core.policy_network import HeteroGraphPolicyNetwork
+from core.profiling import Profiler
+from core.trainer import _get_action_candidates
+
+
+def test_profiler_records_stages(tmp_path):
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    policy_network = HeteroGraphPolicyNetwork()
+    environment = TriangulationEnvironment()
+
+    # Nothing is recorded outside of the profiler
+    extract_endpoint_pair_combinations(triangulation)
+    with Profiler() as profiler:
+        extract_endpoint_pair_combinations(triangulation)
+        extract_endpoint_pair_combinations(triangulation)
+        policy_network(triangulation)
+        pairs = _get_action_candidates(triangulation)[2]
+        environment.state = triangulation
+        environment.step((2, pairs[0, 1:]))
+    extract_endpoint_pair_combinations(triangulation)
+
+    stats = {row["stage"]: row for row in profiler.summary()}
+    assert stats["extractor"]["calls"] == 2
+    assert stats["extractor.endpoint_pair_filter"]["calls"] == 2
+    assert stats["extractor.where_combinations"]["mean_output_bytes"] > 0
+    assert stats["policy_network.hetero_graph_conv"]["calls"] == 3
+    assert stats["environment.apply_actions"]["calls"] == 1
+    # The inner stages are excluded from the self time
+    assert (
+        stats["extractor"]["self_seconds"]
+        < stats["extractor"]["total_seconds"]
+    )
+    assert "extractor.endpoint_adjacency" in profiler.table()
+
+    path = tmp_path / "trace.json"
+    profiler.save_chrome_trace(path)
+    with open(path) as file:
+        events = json.load(file)["traceEvents"]
+    assert len(events) == sum(row["calls"] for row in stats.values())
+    assert all(event["ph"] == "X" for event in events)
+
+
+def test_profiler_skips_traced_stages():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    with Profiler() as profiler:
+        extract_compiled_endpoint_pair_combinations(triangulation)
+
+    # The inner stages only run while tracing
+    assert [row["stage"] for row in profiler.summary()] == [
+        "extractor.compiled"
+    ]
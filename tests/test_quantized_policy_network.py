@@ -0,0 +1,106 @@
+import dgl
+import pytest
+import tensorflow as tf
+
+from core.policy_network import (
+    HeteroGraphPolicyNetwork,
+    _compute_global_features,
+    _compute_local_features,
+    prepare_fused_inputs,
+)
+from core.quantized_policy_network import (
+    WEIGHT_DTYPES,
+    QuantizedPolicyNetwork,
+    logit_drift_report,
+    prepare_quantized_inputs,
+)
+
+
+def test_compact_node_data_gives_the_same_features():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    fused_inputs = prepare_fused_inputs(triangulation)
+    quantized_inputs = prepare_quantized_inputs(triangulation)
+
+    assert quantized_inputs["node_data"]["angle"]["angle_type"].shape == (
+        triangulation.num_nodes("angle"),
+    )
+    local_features = _compute_local_features(fused_inputs["node_data"])
+    compact_local_features = _compute_local_features(
+        quantized_inputs["node_data"]
+    )
+    for ntype, features in local_features.items():
+        tf.debugging.assert_equal(compact_local_features[ntype], features)
+    tf.debugging.assert_equal(
+        _compute_global_features(
+            quantized_inputs["node_data"], quantized_inputs["batch_num_nodes"]
+        ),
+        _compute_global_features(
+            fused_inputs["node_data"], fused_inputs["batch_num_nodes"]
+        ),
+    )
+
+
+def test_quantized_logits_stay_close_to_float32():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    triangulations = dgl.batch([triangulation] * 3)
+    policy_network = HeteroGraphPolicyNetwork()
+    with pytest.raises(ValueError):
+        QuantizedPolicyNetwork(policy_network)
+    policy_network.fused_call(prepare_fused_inputs(triangulations))
+    with pytest.raises(ValueError):
+        QuantizedPolicyNetwork(policy_network, "float16")
+
+    for weight_dtype in WEIGHT_DTYPES:
+        quantized_policy_network = QuantizedPolicyNetwork(
+            policy_network, weight_dtype
+        )
+        report = logit_drift_report(
+            policy_network, quantized_policy_network, triangulations
+        )
+
+        assert 0 < report["max_point_logit_drift"] < 0.1
+        assert 0 < report["max_triangulation_logit_drift"] < 0.1
+        assert report["weight_bytes"] < report["float32_weight_bytes"]
+        assert report["node_data_bytes"] < report["float32_node_data_bytes"]
+        point_logits, triangulation_logits = (
+            quantized_policy_network.fused_call(
+                prepare_fused_inputs(triangulations)
+            )
+        )
+        assert point_logits.dtype == triangulation_logits.dtype == tf.float32
+        assert triangulation_logits.shape == (3, 7)
+
+
+def test_requantize_keeps_the_traces():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    fused_inputs = prepare_fused_inputs(triangulation)
+    policy_network = HeteroGraphPolicyNetwork()
+    policy_network.fused_call(fused_inputs)
+
+    for weight_dtype in WEIGHT_DTYPES:
+        quantized_policy_network = QuantizedPolicyNetwork(
+            policy_network, weight_dtype
+        )
+        quantized_policy_network.fused_call(fused_inputs)
+        compiled_call = quantized_policy_network._compiled_fused_call
+        n_traces = compiled_call.experimental_get_tracing_count()
+
+        for _ in range(2):
+            policy_network.set_weights(
+                [2 * weights for weights in policy_network.get_weights()]
+            )
+            quantized_policy_network.requantize(policy_network)
+            point_logits, triangulation_logits = (
+                quantized_policy_network.fused_call(fused_inputs)
+            )
+            # Same logits as a new copy of the updated weights
+            expected_point_logits, expected_triangulation_logits = (
+                QuantizedPolicyNetwork(
+                    policy_network, weight_dtype
+                ).fused_call(fused_inputs)
+            )
+            tf.debugging.assert_equal(point_logits, expected_point_logits)
+            tf.debugging.assert_equal(
+                triangulation_logits, expected_triangulation_logits
+            )
+        assert compiled_call.experimental_get_tracing_count() == n_traces
@@ -0,0 +1,70 @@
+import dgl
+import numpy as np
+import tensorflow as tf
+
+from core.replay_buffer import (
+    PrioritizedReplayBuffer,
+    SumTree,
+    decode_triangulations,
+    encode_triangulations,
+)
+
+
+def test_decoded_triangulations_have_same_data():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    triangulations = dgl.batch([triangulation] * 2)
+
+    decoded = decode_triangulations(encode_triangulations(triangulations))
+
+    for ntype in triangulations.ntypes:
+        tf.debugging.assert_equal(
+            decoded.batch_num_nodes(ntype),
+            triangulations.batch_num_nodes(ntype),
+        )
+    for etype in triangulations.canonical_etypes:
+        tf.debugging.assert_equal(
+            decoded.batch_num_edges(etype),
+            triangulations.batch_num_edges(etype),
+        )
+    # The angles are derived in another order than the original ones
+    for ntype in ("point", "segment", "triangle"):
+        for key, value in triangulations.nodes[ntype].data.items():
+            tf.debugging.assert_equal(decoded.nodes[ntype].data[key], value)
+    for key, value in triangulations.nodes["angle"].data.items():
+        tf.debugging.assert_equal(
+            np.sort(decoded.nodes["angle"].data[key].numpy(), axis=0),
+            np.sort(value.numpy(), axis=0),
+        )
+
+
+def test_sum_tree_samples_proportionally_to_priorities():
+    sum_tree = SumTree(6)
+    priorities = np.array([1.0, 0.0, 2.0, 3.0, 0.0, 4.0])
+    sum_tree.update(np.arange(6), priorities)
+    sum_tree.update([0], [0.0])
+
+    indices = sum_tree.find(np.linspace(0, sum_tree.total, 9000)[:-1])
+
+    np.testing.assert_allclose(sum_tree.total, 9.0)
+    np.testing.assert_allclose(
+        np.bincount(indices, minlength=6) / len(indices),
+        [0.0, 0.0, 2 / 9, 3 / 9, 0.0, 4 / 9],
+        atol=1e-3,
+    )
+
+
+def test_replay_buffer_replaces_oldest_triangulations():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    buffer = PrioritizedReplayBuffer(capacity=3, seed=0)
+
+    buffer.add(dgl.batch([triangulation] * 2), [1.0, 1.0])
+    indices = buffer.add(dgl.batch([triangulation] * 2), [0.0, 2.0])
+    triangulations, sampled, probabilities = buffer.sample(8)
+
+    assert len(buffer) == 3
+    np.testing.assert_equal(indices, [2, 0])
+    assert set(sampled.tolist()) == {0, 1}
+    np.testing.assert_allclose(
+        probabilities, np.where(sampled == 0, 2 / 3, 1 / 3)
+    )
+    assert triangulations.batch_size == 8
@@ -0,0 +1,30 @@
+import numpy as np
+
+from core.agent import Agent
+from core.environment import TERMINATE_ACTION
+from core.rollout_workers import RolloutWorkers
+from core.trainer import TrajectoryBalanceTrainer, log_n_triangles
+
+
+def test_trainer_trains_on_worker_trajectories():
+    trainer = TrajectoryBalanceTrainer(
+        Agent(), log_n_triangles, n_envs=2, max_steps=3
+    )
+    policy_network = trainer.agent.policy_network
+    # Creates the variables of the policy network
+    trainer.collect_trajectories(1)
+
+    with RolloutWorkers(
+        policy_network, log_n_triangles, n_workers=2, max_steps=3, seed=0
+    ) as workers:
+        trajectories = workers.get_trajectories(2, timeout=120)
+        history = trainer.train(
+            n_iterations=2, batch_size=2, rollout_workers=workers
+        )
+
+    assert len(history) == 2
+    assert all(np.isfinite(record["loss"]) for record in history)
+    for trajectory in trajectories:
+        assert len(trajectory.actions) == len(trajectory.states) <= 4
+        assert trajectory.actions[-1][0] == TERMINATE_ACTION
+        assert trajectory.log_reward == log_n_triangles(trajectory.states[-1])
@@ -0,0 +1,40 @@
+import dgl
+import tensorflow as tf
+
+from core.endpoint_pair_combinations import extract_endpoint_pair_combinations
+from core.sparse_endpoint_pair_combinations import (
+    extract_batched_endpoint_pair_combinations,
+    extract_sparse_endpoint_pair_combinations,
+)
+
+
+def _assert_same_combinations(triangulation):
+    expected = extract_endpoint_pair_combinations(triangulation)
+    combinations = extract_sparse_endpoint_pair_combinations(triangulation)
+    for pairs, expected_pairs in zip(combinations, expected):
+        tf.debugging.assert_equal(
+            tf.reshape(pairs, (-1, expected_pairs.shape[1])), expected_pairs
+        )
+
+
+def test_sparse_combinations_match_dense_combinations():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    _assert_same_combinations(triangulation)
+
+
+def test_batched_combinations_match_combinations_of_each_triangulation():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    n_points = triangulation.num_nodes("point")
+    triangulations = dgl.batch([triangulation] * 3)
+
+    expected = extract_endpoint_pair_combinations(triangulation)
+    combinations = extract_batched_endpoint_pair_combinations(triangulations)
+    for pairs, expected_pairs in zip(combinations, expected):
+        expected_pairs = tf.reshape(expected_pairs, (-1, pairs.shape[1] - 1))
+        for graph in range(3):
+            pairs_of_graph = tf.gather_nd(
+                pairs, tf.where(tf.math.equal(pairs[:, 0], graph))
+            )
+            tf.debugging.assert_equal(
+                pairs_of_graph[:, 1:] - graph * n_points, expected_pairs
+            )
@@ -0,0 +1,84 @@
+import dgl
+import numpy as np
+import tensorflow as tf
+
+from core.action_space import masked_action_log_softmax
+from core.agent import Agent
+from core.environment import TERMINATE_ACTION, TriangulationEnvironment
+from core.policy_network import prepare_fused_inputs
+from core.trainer import (
+    TrajectoryBalanceTrainer,
+    _get_action_candidates,
+    _get_action_space,
+    log_n_triangles,
+)
+
+
+def test_action_log_probs_are_normalized_per_triangulation():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    triangulations = dgl.batch([triangulation] * 2)
+    agent = Agent()
+    point_logits, triangulation_logits = agent.policy_network.fused_call(
+        prepare_fused_inputs(triangulations)
+    )
+
+    action_space = _get_action_space(triangulations)
+    log_probs = masked_action_log_softmax(
+        action_space,
+        point_logits,
+        triangulation_logits,
+        tf.constant([False, True]),
+    )
+    graph_ids, action_types = action_space.graph_ids, action_space.action_types
+
+    total_probs = tf.math.unsorted_segment_sum(
+        tf.math.exp(log_probs), graph_ids, 2
+    )
+    tf.debugging.assert_near(total_probs, tf.ones(2))
+    # The second triangulation can only terminate
+    is_terminating = tf.math.logical_and(
+        tf.math.equal(graph_ids, 1),
+        tf.math.equal(action_types, TERMINATE_ACTION),
+    )
+    tf.debugging.assert_near(
+        tf.boolean_mask(log_probs, is_terminating), tf.zeros(1)
+    )
+
+
+def test_collected_trajectories_replay_in_environment():
+    tf.random.set_seed(1337)
+    trainer = TrajectoryBalanceTrainer(
+        Agent(), log_n_triangles, n_envs=3, max_steps=4
+    )
+
+    trajectories = trainer.collect_trajectories(3)
+
+    assert len(trajectories) >= 3
+    for trajectory in trajectories:
+        assert len(trajectory.actions) <= 5
+        assert trajectory.actions[-1][0] == TERMINATE_ACTION
+        for state, next_state, (action_type, rank) in zip(
+            trajectory.states, trajectory.states[1:], trajectory.actions
+        ):
+            environment = TriangulationEnvironment()
+            environment.state = state
+            pairs = _get_action_candidates(state)[action_type]
+            new_state, _ = environment.step((action_type, pairs[rank, 1:]))
+            for ntype in next_state.ntypes:
+                assert new_state.num_nodes(ntype) == next_state.num_nodes(
+                    ntype
+                )
+
+
+def test_train_updates_log_z():
+    tf.random.set_seed(42)
+    trainer = TrajectoryBalanceTrainer(
+        Agent(), log_n_triangles, n_envs=4, max_steps=3
+    )
+
+    history = trainer.train(n_iterations=2, batch_size=4)
+
+    assert len(history) == 2
+    assert all(np.isfinite(record["loss"]) for record in history)
+    assert all(record["trajectories_per_second"] > 0 for record in history)
+    assert float(trainer.log_z) != 0.0
@@ -0,0 +1,66 @@
+import dgl
+import numpy as np
+import tensorflow as tf
+
+from core.agent import Agent
+from core.trainer import TrajectorySampler, log_n_triangles
+from core.trajectory_store import TrajectoryStore
+
+
+def _assert_same_states(states, expected_states):
+    assert len(states) == len(expected_states)
+    for state, expected in zip(states, expected_states):
+        for etype in expected.canonical_etypes:
+            for ids, expected_ids in zip(
+                state.edges(etype=etype), expected.edges(etype=etype)
+            ):
+                tf.debugging.assert_equal(ids, expected_ids)
+        for ntype in expected.ntypes:
+            assert set(state.nodes[ntype].data) == set(
+                expected.nodes[ntype].data
+            )
+            for key, value in expected.nodes[ntype].data.items():
+                tf.debugging.assert_equal(state.nodes[ntype].data[key], value)
+
+
+def test_read_trajectories_matches_appended_trajectories(tmp_path):
+    tf.random.set_seed(1337)
+    sampler = TrajectorySampler(
+        Agent().policy_network, log_n_triangles, n_envs=3, max_steps=6
+    )
+    trajectories = sampler.sample(6)
+
+    store = TrajectoryStore(str(tmp_path))
+    store.append(trajectories[:2])
+    store.append(trajectories[2:])
+    # Reopening maps the files written by the other instance
+    store = TrajectoryStore(str(tmp_path))
+
+    assert store.n_trajectories == len(trajectories)
+    assert store.n_states == sum(len(t.states) for t in trajectories)
+    indices = np.arange(len(trajectories))[::-1]
+    for trajectory, expected in zip(
+        store.read_trajectories(indices),
+        [trajectories[index] for index in indices],
+    ):
+        assert trajectory.actions == expected.actions
+        np.testing.assert_allclose(trajectory.log_reward, expected.log_reward)
+        np.testing.assert_allclose(
+            trajectory.log_probs, expected.log_probs, rtol=1e-6
+        )
+        _assert_same_states(trajectory.states, expected.states)
+
+    steps = np.arange(store.n_states)[::-1]
+    states, actions, _ = store.read_steps(steps)
+    expected_states = [
+        state for trajectory in trajectories for state in trajectory.states
+    ]
+    expected_actions = [
+        action for trajectory in trajectories for action in trajectory.actions
+    ]
+    _assert_same_states(
+        dgl.unbatch(states), [expected_states[step] for step in steps]
+    )
+    assert [tuple(action) for action in actions.tolist()] == [
+        expected_actions[step] for step in steps
+    ]
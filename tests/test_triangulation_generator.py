@@ -0,0 +1,99 @@
+import numpy as np
+
+from core.environment import TSS_SEGMENT_TYPES
+from core.feature_cache import state_key
+from core.replay_buffer import decode_triangulations
+from core.trainer import _get_action_candidates
+from core.triangulation_generator import (
+    MAX_LIGHT_CONE_CROSSINGS,
+    TriangulationGenerator,
+    generate_triangulation,
+)
+
+
+def test_generate_triangulation():
+    triangulation = generate_triangulation(2000, seed=0)
+    assert triangulation.num_nodes("point") == 2000
+    assert state_key(triangulation) == state_key(
+        generate_triangulation(2000, seed=0)
+    )
+
+    # Local causality: the internal points have exactly four light cone
+    # crossings, the boundary points at most four
+    segments, points = [
+        ids.numpy() for ids in triangulation.edges(etype="segment_has_point")
+    ]
+    boundary = triangulation.nodes["segment"].data["boundary"].numpy()
+    is_boundary_point = np.zeros(2000, dtype=bool)
+    is_boundary_point[points[boundary[segments].ravel() > 0]] = True
+    n_light_cone_angles = (
+        triangulation.nodes["point"].data["n_light_cone_angle"].numpy().ravel()
+    )
+    assert not is_boundary_point.all()
+    assert np.all(
+        n_light_cone_angles[~is_boundary_point] == MAX_LIGHT_CONE_CROSSINGS
+    )
+    assert np.all(n_light_cone_angles <= MAX_LIGHT_CONE_CROSSINGS)
+
+
+def test_generator_moves_are_valid_actions():
+    rng = np.random.default_rng(0)
+    generator = TriangulationGenerator(TSS_SEGMENT_TYPES)
+    for _ in range(20):
+        encoding = generator.encode()
+        candidates = [
+            set(map(tuple, combinations.numpy()[:, 1:].tolist()))
+            for combinations in _get_action_candidates(
+                decode_triangulations([encoding])
+            )
+        ]
+        # Generator point ids to the ids of the encoding
+        is_kept = np.ones(len(generator.point_segments), dtype=bool)
+        is_kept[list(generator._removed_points)] = False
+        point_ids = (np.cumsum(is_kept) - 1).tolist()
+
+        closable_points = [
+            point
+            for point in range(len(generator.point_segments))
+            if is_kept[point] and generator.closable_segments(point)
+        ]
+        if closable_points:
+            point = closable_points[0]
+            segment, other_segment = generator.closable_segments(point)
+            p, a, b = [
+                point_ids[q]
+                for q in (
+                    point,
+                    generator._other_point(segment, point),
+                    generator._other_point(other_segment, point),
+                )
+            ]
+            # Either pair of segments, with either orientation
+            assert {
+                (p, a, p, b),
+                (p, b, p, a),
+                (a, p, b, p),
+                (b, p, a, p),
+            } & candidates[generator.segment_types[segment]]
+            generator.close_point(point)
+            continue
+
+        segment = generator.boundary_segments[
+            rng.integers(len(generator.boundary_segments))
+        ]
+        options = generator.triangle_options(segment)
+        assert options
+        p0, p1 = [point_ids[q] for q in generator.segment_points[segment]]
+        segment_type = generator.segment_types[segment]
+        u1, u2 = options[rng.integers(len(options))]
+        # New triangle action and glued endpoints of each option
+        action_type, pairs = {
+            (0, 1, 1): (2, {(p0, p1), (p1, p0)}),
+            (1, 1, 0): (3, {(p0, p1)}),
+            (1, 0, 1): (3, {(p1, p0)}),
+            (0, 0, 1): (4, {(p0, p1)}),
+            (0, 1, 0): (4, {(p1, p0)}),
+            (1, 0, 0): (5, {(p0, p1), (p1, p0)}),
+        }[(segment_type, u1, u2)]
+        assert pairs & candidates[action_type]
+        generator.add_triangle(segment, u1, u2)
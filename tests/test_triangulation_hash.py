@@ -0,0 +1,81 @@
+import dgl
+import numpy as np
+import tensorflow as tf
+
+from core.environment import TriangulationEnvironment
+from core.triangulation_hash import (
+    TriangulationMemo,
+    deduplicate_triangulations,
+    hash_triangulations,
+)
+
+
+def _relabel(triangulation, seed):
+    """Copy of a triangulation with permuted node and edge ids"""
+    rng = np.random.default_rng(seed)
+    new_ids = {
+        ntype: rng.permutation(triangulation.num_nodes(ntype))
+        for ntype in triangulation.ntypes
+    }
+    graph_data = {}
+    for src_type, etype, dst_type in triangulation.canonical_etypes:
+        src, dst = [ids.numpy() for ids in triangulation.edges(etype=etype)]
+        order = rng.permutation(len(src))
+        graph_data[(src_type, etype, dst_type)] = (
+            tf.constant(new_ids[src_type][src][order], dtype=tf.int32),
+            tf.constant(new_ids[dst_type][dst][order], dtype=tf.int32),
+        )
+    relabeled = dgl.heterograph(
+        graph_data,
+        num_nodes_dict={
+            ntype: triangulation.num_nodes(ntype)
+            for ntype in triangulation.ntypes
+        },
+        idtype=tf.int32,
+    )
+    for ntype in triangulation.ntypes:
+        old_ids = np.argsort(new_ids[ntype])
+        for key, value in triangulation.nodes[ntype].data.items():
+            relabeled.nodes[ntype].data[key] = tf.gather(value, old_ids)
+    return relabeled
+
+
+def test_hash_is_invariant_to_relabeling():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    environment = TriangulationEnvironment()
+    triangulations = dgl.batch(
+        [
+            triangulation,
+            _relabel(triangulation, seed=0),
+            _relabel(triangulation, seed=1),
+            environment.tss_triangle,
+            environment.stt_triangle,
+        ]
+    )
+
+    hashes = hash_triangulations(triangulations)
+
+    assert hashes[0] == hashes[1] == hashes[2]
+    assert len(set(hashes.tolist())) == 3
+
+
+def test_memo_evaluates_once_per_isomorphism_class():
+    triangulation = dgl.load_graphs("./data/test_triangulation")[0][0]
+    triangulations = dgl.batch(
+        [
+            triangulation,
+            TriangulationEnvironment().tss_triangle,
+            _relabel(triangulation, seed=0),
+        ]
+    )
+    memo = TriangulationMemo(lambda state: state.num_nodes("triangle"))
+
+    values = memo.map(triangulations)
+    value = memo(triangulation)
+
+    assert values == [triangulation.num_nodes("triangle"), 1, values[0]]
+    assert value == values[0]
+    assert (memo.hits, memo.misses) == (2, 2)
+    _, inverse, counts = deduplicate_triangulations(triangulations)
+    assert inverse[0] == inverse[2] != inverse[1]
+    assert sorted(counts.tolist()) == [1, 2]